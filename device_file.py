@@ -0,0 +1,173 @@
+'''
+Compact, versioned file format for kmc_dn devices, used by kmc_dn.saveSelf,
+kmc_dn.loadSelf and the archives of many devices (save_devices,
+load_devices and pack_device_files in kmc_dopant_networks).
+
+A file holds one or more devices, each as a dict of attributes (see
+kmc_dn.device_data). numpy arrays are stored raw, everything else (ints,
+floats, strings, lists, tuples, numpy scalars) in the header. Layout:
+
+    magic       8 bytes, MAGIC
+    version     uint32 little endian, FORMAT_VERSION
+    header size uint32 little endian
+    header      utf-8 JSON, {'version': ..., 'devices': [...]}
+    data        the raw arrays, each aligned to ALIGNMENT bytes
+
+Every device in the header is {'name': ..., 'attributes': {...},
+'arrays': {name: {'dtype', 'shape', 'offset'}}}, with offsets relative
+to the start of the data. The header is the index of the file: it is read
+without touching the data, and the arrays can be memory mapped.
+
+Files of an older version can always be read, files of a newer version
+raise a ValueError.
+'''
+
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'KMCDN\x00\x00\x00'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+
+def is_device_file(path):
+    '''
+    Whether path is a device file, as opposed to e.g. a pickled .kmc file.
+    '''
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _encode(value):
+    '''
+    Returns value as JSON compatible data. Tuples, numpy scalars and numpy
+    arrays (inside lists) are tagged, so that _decode restores their type.
+    '''
+    if isinstance(value, (bool, int, float, str)) or value is None:
+        return value
+    if isinstance(value, np.generic):
+        return {'__numpy__': value.dtype.str, 'value': value.item()}
+    if isinstance(value, np.ndarray):
+        return {'__ndarray__': value.dtype.str, 'value': value.tolist()}
+    if isinstance(value, tuple):
+        return {'__tuple__': [_encode(item) for item in value]}
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    raise TypeError(f"Can not store {type(value).__name__} in a device file")
+
+
+def _decode(value):
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    if isinstance(value, dict):
+        if '__tuple__' in value:
+            return tuple(_decode(item) for item in value['__tuple__'])
+        if '__numpy__' in value:
+            return np.dtype(value['__numpy__']).type(value['value'])
+        if '__ndarray__' in value:
+            return np.array(value['value'], dtype=value['__ndarray__'])
+    return value
+
+
+def _aligned(offset):
+    return -(-offset//ALIGNMENT)*ALIGNMENT
+
+
+def write_devices(path, devices):
+    '''
+    Writes devices, a list of (name, attributes dict), to path. Arrays
+    (except object arrays) are stored raw, other values in the header.
+    '''
+    header = {'version':FORMAT_VERSION, 'devices':[]}
+    arrays = []
+    offset = 0
+    for name, data in devices:
+        entry = {'name':name, 'attributes':{}, 'arrays':{}}
+        for key, value in data.items():
+            if isinstance(value, np.ndarray) and not value.dtype.hasobject:
+                value = np.ascontiguousarray(value)
+                offset = _aligned(offset)
+                entry['arrays'][key] = {'dtype':value.dtype.str,
+                                        'shape':list(value.shape),
+                                        'offset':offset}
+                arrays.append((offset, value))
+                offset += value.nbytes
+            else:
+                entry['attributes'][key] = _encode(value)
+        header['devices'].append(entry)
+
+    encoded = json.dumps(header).encode('utf-8')
+    start = _aligned(len(MAGIC) + 8 + len(encoded))
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<II', FORMAT_VERSION, len(encoded)))
+        f.write(encoded)
+        for offset, value in arrays:
+            f.seek(start + offset)
+            f.write(value.tobytes())
+
+
+def _read_header(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a device file")
+    version, size = struct.unpack('<II', f.read(8))
+    if version > FORMAT_VERSION:
+        raise ValueError(f"Device file version {version} is newer than the "
+                         f"supported version {FORMAT_VERSION}")
+    header = json.loads(f.read(size).decode('utf-8'))
+    return header, _aligned(len(MAGIC) + 8 + size)
+
+
+def read_header(path):
+    '''
+    Returns the header (index) of a device file: its version and per
+    device the name, the attributes that are stored in the header and
+    the dtype, shape and offset of the arrays.
+    '''
+    with open(path, 'rb') as f:
+        return _read_header(f)[0]
+
+
+def read_devices(path, names=None, mmap=False):
+    '''
+    Reads the devices of a device file as a list of (name, attributes
+    dict).
+
+    Input arguments
+    ===============
+    path; string
+        The device file.
+    names; list of strings
+        Only read these devices, in this order. default: all devices.
+    mmap; bool
+        Memory map the arrays instead of reading them. They are mapped
+        copy-on-write, so changing them does not change the file.
+    '''
+    with open(path, 'rb') as f:
+        header, start = _read_header(f)
+        entries = {entry['name']:entry for entry in header['devices']}
+        if names is None:
+            names = [entry['name'] for entry in header['devices']]
+        devices = []
+        for name in names:
+            entry = entries[name]
+            data = {key:_decode(value)
+                    for key, value in entry['attributes'].items()}
+            for key, array in entry['arrays'].items():
+                dtype = np.dtype(array['dtype'])
+                shape = tuple(array['shape'])
+                count = int(np.prod(shape))
+                if count == 0:
+                    data[key] = np.zeros(shape, dtype=dtype)
+                elif mmap:
+                    data[key] = np.memmap(path, dtype=dtype, mode='c',
+                                          offset=start + array['offset'],
+                                          shape=shape)
+                else:
+                    f.seek(start + array['offset'])
+                    data[key] = np.fromfile(f, dtype=dtype,
+                                            count=count).reshape(shape)
+            devices.append((name, data))
+    return devices
@@ -1,6 +1,7 @@
 import kmc_dopant_networks as kmc_dn
 import kmc_dopant_networks_utils as kmc_utils
 import dn_animation as anim
+import simulation_pool
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -69,6 +70,7 @@ class dn_search():
         self.genetic_allowed_overlap = 65
         self.order_distance_function = dn_search.degreeDistance
         self.parallel = 0
+        self.pool = None
 
 
     def init_search(self):
@@ -95,11 +97,73 @@ class dn_search():
         self.expected_error =  self.simulation_strategy[index]['expected_error']
         self.threshold_error =  self.simulation_strategy[index]['threshold_error']
 
-    def evaluate_error(self, dn):
+    def addScreeningTier(self, strategy):
+        '''
+        Inserts a cheap, approximate simulation strategy in front of 
+        self.simulation_strategy and starts the search from it.
+        :param strategy:
+            dict with the same keys as the entries of self.simulation_strategy.
+        '''
+        self.simulation_strategy.insert(0, strategy)
+        self.setStrategy(0)
+
+    def usePool(self, pool):
+        '''
+        Simulates the dopant networks of a generation in parallel on a
+        simulation_pool.SimulationPool, with the current strategy.
+        :param pool:
+            SimulationPool to use, or None to simulate serially again.
+        '''
+        self.pool = pool
+        self.parallel = pool.processes if pool is not None else 0
+
+    def simulate_test(self, dn, test_index, extend=False):
+        '''
+        Simulates dn with the current strategy, for the test whose voltages
+        are already applied. If the same test of dn was simulated before with
+        a resumable go function, that simulation is continued: a higher 
+        strategy then only costs the missing hops. If the test was already
+        simulated on self.pool (see parallel_simulation), that result is used.
+        :param dn:
+            Dopant network to be simulated.
+        :param test_index:
+            Index of the test, simulations are continued per test.
+        :param extend:
+            If True the hops of the strategy are added to the earlier
+            simulation, even if it already has that many hops.
+        '''
+        args = self.simulation_args
+        if getattr(dn, 'search_states', None) is None:
+            dn.search_states = {}
+        pool_results = getattr(dn, 'pool_results', None)
+        if pool_results and test_index in pool_results:
+            result = pool_results.pop(test_index)
+            simulation_pool.SimulationPool.apply_result(dn, result)
+            dn.search_states[test_index] = result.get('simulation_state')
+            return
+        state = dn.search_states.get(test_index)
+        if (self.simulation_func == "go_simulation" and state is not None
+                and state.get('requested_function') == args.get('goSpecificFunction', "wrapperSimulateRecord")
+                and np.array_equal(state['E_constant'], dn.E_constant)):
+            hops = args['hops'] if extend else args['hops'] - state['hops']
+            if hops <= 0:
+                dn.current = state['electrode_occupation']/state['time']
+                return
+            getattr(dn, self.simulation_func)(**dict(args, hops=hops, resume=state))
+        else:
+            getattr(dn, self.simulation_func)(**args)
+        if self.simulation_func == "go_simulation":
+            dn.search_states[test_index] = dn.simulation_state
+        else:
+            dn.search_states[test_index] = None
+
+    def evaluate_error(self, dn, extend=False):
         '''
         Evaluates the error of som kmc_dn object, relative to the test set given in self.
         :param dn:
             Dopant network to be evaluated.
+        :param extend:
+            See simulate_test.
         :returns:
             score for the evaluation.
         '''
@@ -112,7 +176,7 @@ class dn_search():
                 dn.electrodes[i][3] = electrodes[i]
             dn.update_V()
             execpted_currents = test[1]
-            getattr(dn, self.simulation_func)(**self.simulation_args)
+            self.simulate_test(dn, j, extend)
             for index, current in execpted_currents:
                 diff = math.fabs(dn.current[index]-current)
                 diffs.append(diff)
@@ -121,6 +185,7 @@ class dn_search():
     def validate_error(self, dn):
         '''
         Validate the error of some dopant network object. In validation we use the last strategy, which is reserved for most accuracy.
+        Earlier simulations of dn are extended, so repeated validations keep improving the estimate.
         :param dn:
             Dopant network to be validated.
         :returns:
@@ -129,7 +194,7 @@ class dn_search():
         diffs = []
         cur_strat = self.current_strategy
         self.setStrategy(len(self.simulation_strategy)-1)
-        error = self.evaluate_error(dn)
+        error = self.evaluate_error(dn, extend=True)
         self.setStrategy(cur_strat)
         return error
         
@@ -191,12 +256,18 @@ class dn_search():
         '''
             Yields neighbours of current state. Used by greedy and simulated annealing algorithms.
             This is the implementation for dopant placement search.
+            A single copy of self.dn is moved with apply_move, the move is
+            undone when the next neighbour is requested, so a neighbour is only
+            valid until then (the searches accept it and stop iterating).
         '''
         N = self.dn.N + self.dn.M
         shifts = [(self.x_resolution, 0), (-self.x_resolution, 0), (0, self.y_resolution), (0, -self.y_resolution), (self.x_resolution, self.y_resolution), (-self.x_resolution, self.y_resolution), (-self.x_resolution, -self.y_resolution), (self.x_resolution, -self.y_resolution)]
         options = [(i, shifts[j][0], shifts[j][1]) for i in range(N) for j in range(len(shifts))]
         indexes = [x for x in range(len(options))]
         random.shuffle(indexes)
+        newDn = self.dn.copy()
+        newDn.search_states = None
+        newDn.pool_results = None
         for index in indexes:
             option = options[index]
             if option[0] < self.dn.N:
@@ -206,23 +277,17 @@ class dn_search():
                 donor = self.dn.donors[option[0]-self.dn.N]
                 pos = (donor[0]+option[1], donor[1]+option[2])
             if self.doesPositionFit(pos[0], pos[1]):
-                newDn = kmc_dn.kmc_dn(self.dn.N, self.dn.M, self.xdim, 
-                    self.ydim, 0, electrodes = self.dn.electrodes, 
-                    acceptors=self.dn.acceptors, donors=self.dn.donors, copy_from=self.dn)
-                newDn.xCoords = self.dn.xCoords.copy()
-                newDn.yCoords = self.dn.yCoords.copy()
-
                 newDn.xCoords[option[0]] = pos[0]
                 newDn.yCoords[option[0]] = pos[1]
-                if option[0] < self.dn.N:
-                    newDn.acceptors[option[0]][0] = pos[0]
-                    newDn.acceptors[option[0]][1] = pos[1]
-                else:
-                    newDn.donors[option[0]-self.dn.N][0] = pos[0]
-                    newDn.donors[option[0]-self.dn.N][1] = pos[1]
-                newDn.initialize( dopant_placement=False, charge_placement=False)
+                newDn.apply_move(option[0], pos)
                 yield newDn, option[0], pos
 
+                # Rejected, back to the position of self.dn
+                newDn.undo()
+                newDn.xCoords[option[0]] = self.dn.xCoords[option[0]]
+                newDn.yCoords[option[0]] = self.dn.yCoords[option[0]]
+                newDn.search_states = None
+
 
 
     def doesPositionFit(self, x, y):
@@ -404,7 +469,24 @@ class dn_search():
         return best, self.current_strategy, self.validations
 
     def parallel_simulation(self, dns):
-        return #Must be implemented in inheriting class
+        '''
+        Simulates all tests of dns on self.pool with the current strategy.
+        The results are used by simulate_test in the next evaluate_error of
+        each dn. Inheriting classes can implement their own.
+        '''
+        if self.pool is None:
+            return
+        futures = []
+        for dn in dns:
+            for j in range(self.use_tests):
+                for i in range(len(self.tests[j][0])):
+                    dn.electrodes[i][3] = self.tests[j][0][i]
+                dn.update_V()
+                futures.append((dn, j, self.pool.submit(dn, self.simulation_func, **self.simulation_args)))
+        for dn, j, future in futures:
+            if getattr(dn, 'pool_results', None) is None:
+                dn.pool_results = {}
+            dn.pool_results[j] = future.result()
 
 
 #Genetic search
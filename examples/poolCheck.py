@@ -0,0 +1,51 @@
+'''
+Checks simulation_pool.SimulationPool against serial go_simulation, the
+way dn_search.parallel_simulation uses it: the voltages of the same
+kmc_dn are changed in place right after every submit. Each job has to
+run with the voltages at its submission, so the pooled currents must
+equal the serial ones within the noise of the simulation. Per test the
+largest difference is printed relative to the largest serial current of
+all tests.
+
+Run from the repository root after building libSimulation.so.
+'''
+
+import kmc_dopant_networks as kmc_dn
+from simulation_pool import SimulationPool
+import numpy as np
+
+#%% Parameters
+fileName = 'thesis_indrek/tests/XOR_wide/test0.kmc'
+hops = int(2E5)
+tolerance = 0.2  # Relative to the largest current of all tests
+
+def main():
+    dn = kmc_dn.kmc_dn(10, 1, 1, 1, 0, electrodes = np.zeros((8, 4)))
+    dn.loadSelf(fileName)
+    voltages = dn.electrodes[:, 3].copy()
+    tests = [voltages, -voltages, 0*voltages, voltages/2]
+
+    #%% Pooled
+    with SimulationPool() as pool:
+        futures = []
+        for test in tests:
+            dn.electrodes[:, 3] = test
+            dn.update_V()
+            futures.append(pool.submit(dn, 'go_simulation', hops = hops))
+        pooled = [future.result()['current'] for future in futures]
+
+    #%% Serial
+    serial = []
+    for test in tests:
+        dn.electrodes[:, 3] = test
+        dn.update_V()
+        dn.go_simulation(hops = hops)
+        serial.append(dn.current.copy())
+    scale = np.abs(serial).max()
+    for i, (current, expected) in enumerate(zip(pooled, serial)):
+        difference = np.abs(current - expected).max()/scale
+        print('Test %d: relative difference %.3f %s'%(
+            i, difference, 'ok' if difference < tolerance else 'MISMATCH'))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+package main
+
+import "math/rand"
+
+// controlVariateCache holds, for a single state, the cumulative rates, the
+// expected charge that enters every electrode with the next hop and the
+// expected duration of the state.
+type controlVariateCache struct {
+    probList []float32
+    expectedCharge []float64
+    expectedTime float64
+}
+
+/*
+controlVariateSimulate is simulate that also accumulates control variates for
+the current. For every state that is visited the expected charge the next
+hop brings into every electrode is
+    sum over transitions of rate * (1 if to is the electrode, -1 if from is) / a_0,
+the mean-field current of calcAverageCurrent evaluated at the occupation of
+the state, and the expected duration of the state is 1/a_0. Summed over the
+hops of a block they have exactly the same mean as the charge that was
+counted and the time that passed, but a much smaller variance, so their
+differences are control variates with a known mean of zero.
+The hops are split in len(block_time) blocks of equal length. For every
+block b it stores the counted charge in block_charge[b*NElectrodes+p], the
+expected charge in block_expected[b*NElectrodes+p], the duration in
+block_time[b] and the expected duration in block_expected_time[b]. The
+coefficients are estimated from these blocks, see kmc_dn.go_simulation.
+*/
+func controlVariateSimulate(NSites int, NElectrodes int, nu float32, kT float32, I_0 float32, R float32,
+        occupation []bool, distances [][]float32, E_constant []float32, transitions_constant [][]float32,
+        electrode_occupation []float64, site_energies []float32, hops int, block_charge []float64,
+        block_expected []float64, block_time []float64, block_expected_time []float64, rng *rand.Rand,
+        stats *simulationStats) float64 {
+    N := NSites + NElectrodes
+    transitions := make([]transition, 0, N*N)
+    for i := 0; i < N; i++ {
+        for j := 0; j < N; j++ {
+            if transitions_constant[i][j] > 0 {
+                transitions = append(transitions, transition{i, j, 0})
+            }
+        }
+    }
+
+    for i := 0; i < NSites; i++ {
+        acceptor_interaction := float32(0)
+        for j := 0; j < NSites; j++ {
+            if j != i && !occupation[j] {
+                acceptor_interaction+= 1/distances[i][j]
+            }
+        }
+        site_energies[i] = E_constant[i] - I_0*R*acceptor_interaction
+    }
+    for i := 0; i < NElectrodes; i++ {
+        electrode_occupation[i] = 0.0
+    }
+
+    // States are stored once they are seen for the second time, like in
+    // simulate with the lowest reuse threshold.
+    keys := newStateKeys(NSites)
+    allStates := make(map[string]*controlVariateCache)
+    seen := make(map[string]bool)
+    blocks := len(block_time)
+    time := float64(0)
+    for b := 0; b < blocks; b++ {
+        blockHops := hops/blocks
+        if b < hops%blocks {
+            blockHops++
+        }
+        charge := block_charge[b*NElectrodes:(b+1)*NElectrodes]
+        expected := block_expected[b*NElectrodes:(b+1)*NElectrodes]
+        for k := 0; k < NElectrodes; k++ {
+            charge[k] = -electrode_occupation[k]
+            expected[k] = 0
+        }
+        block_time[b] = 0
+        block_expected_time[b] = 0
+
+        for ; blockHops > 0; blockHops-- {
+            packed := keys.pack(occupation)
+            state, ok := allStates[string(packed)]
+            if ok {
+                if stats != nil {
+                    stats.cacheHits++
+                }
+            } else {
+                state = &controlVariateCache{make([]float32, len(transitions)), make([]float64, NElectrodes), 0}
+                calcTransitionList(transitions, distances, occupation, site_energies, R, I_0, kT, nu, NSites, N, transitions_constant)
+                for i, trans := range transitions {
+                    if i == 0 {
+                        state.probList[0] = trans.rate
+                    } else {
+                        state.probList[i] = state.probList[i-1] + trans.rate
+                    }
+                    if trans.from >= NSites {
+                        state.expectedCharge[trans.from-NSites] -= float64(trans.rate)
+                    }
+                    if trans.to >= NSites {
+                        state.expectedCharge[trans.to-NSites] += float64(trans.rate)
+                    }
+                }
+                totalRate := float64(state.probList[len(state.probList)-1])
+                for k := 0; k < NElectrodes; k++ {
+                    state.expectedCharge[k] /= totalRate
+                }
+                state.expectedTime = 1/totalRate
+                if seen[string(packed)] {
+                    allStates[string(packed)] = state
+                } else {
+                    seen[string(packed)] = true
+                }
+                if stats != nil {
+                    stats.rateRecomputations++
+                }
+            }
+
+            time_step := rng.ExpFloat64() / float64(state.probList[len(state.probList)-1])
+            block_time[b] += time_step
+            block_expected_time[b] += state.expectedTime
+            for k := 0; k < NElectrodes; k++ {
+                expected[k] += state.expectedCharge[k]
+            }
+            event := getRandomEvent(rng, state.probList)
+            makeJump(occupation, electrode_occupation, site_energies, distances, R, I_0,
+                NSites, transitions[event].from, transitions[event].to)
+        }
+        for k := 0; k < NElectrodes; k++ {
+            charge[k] += electrode_occupation[k]
+        }
+        time += block_time[b]
+    }
+    return time
+}
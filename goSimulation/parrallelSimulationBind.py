@@ -4,7 +4,7 @@ import numpy as np
 import time as time_lib
 import sys
 sys.path.insert(0,'./goSimulation')
-from goSimulation.pythonBind import flattenDouble, getGoSlice, GoSlice, getSliceValues
+from goSimulation.pythonBind import flattenDouble, getGoSlice, GoSlice, getSliceValues, getGoFunction
 
 class parrallelSimulation():
     def __init__(self):
@@ -56,11 +56,9 @@ class parrallelSimulation():
         for attr_name in ['N_acceptors', 'N_electrodes', 'nu', 'kT', 'I_0', 'hops','R', 'time', 'occupation',
             'electrode_occupation', 'E_constant', 'distances', 'transitions_constant', 'site_energies']:
             setattr(self, 'go_%s'%(attr_name), getGoSlice(getattr(self, attr_name)))
-        lib = cdll.LoadLibrary("./goSimulation/libSimulation.so")
-        lib.parallelSimulations.argtypes = [GoSlice]*14
-        lib.parallelSimulations.restype = c_longlong
+        parallelSimulations = getGoFunction("parallelSimulations", [GoSlice]*14, c_longlong)
 
-        done = lib.parallelSimulations(self.go_N_acceptors, self.go_N_electrodes, 
+        done = parallelSimulations(self.go_N_acceptors, self.go_N_electrodes, 
             self.go_nu, self.go_kT, self.go_I_0, self.go_R, self.go_occupation, self.go_distances,
             self.go_E_constant, self.go_transitions_constant, self.go_electrode_occupation,
             self.go_hops, self.go_time, self.go_site_energies)
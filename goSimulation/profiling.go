@@ -0,0 +1,115 @@
+package main
+
+import "C"
+import (
+	"os"
+	"runtime"
+	"runtime/pprof"
+	"sync"
+	"time"
+)
+
+var profileMtx sync.Mutex
+var profilePath string
+var cpuProfile *os.File
+
+/*
+startProfile starts a CPU profile of everything the library does until
+stopProfile is called. The CPU profile is written to <path>.cpu and on
+stopProfile a heap profile is written to <path>.heap. Both can be read with
+go tool pprof libSimulation.so <path>.cpu.
+Returns 0 on success, -1 if a profile is already running and -2 if the file
+can not be created.
+*/
+//export startProfile
+func startProfile(path *C.char) int {
+	profileMtx.Lock()
+	defer profileMtx.Unlock()
+	if cpuProfile != nil {
+		return -1
+	}
+	p := C.GoString(path)
+	f, err := os.Create(p + ".cpu")
+	if err != nil {
+		return -2
+	}
+	if err := pprof.StartCPUProfile(f); err != nil {
+		f.Close()
+		return -1
+	}
+	cpuProfile = f
+	profilePath = p
+	return 0
+}
+
+// stopProfile stops the profile started by startProfile and writes the heap
+// profile. Returns 0 on success, -1 if no profile was running and -2 if the
+// heap profile could not be written.
+//export stopProfile
+func stopProfile() int {
+	profileMtx.Lock()
+	defer profileMtx.Unlock()
+	if cpuProfile == nil {
+		return -1
+	}
+	pprof.StopCPUProfile()
+	cpuProfile.Close()
+	cpuProfile = nil
+
+	f, err := os.Create(profilePath + ".heap")
+	if err != nil {
+		return -2
+	}
+	defer f.Close()
+	runtime.GC()
+	if err := pprof.WriteHeapProfile(f); err != nil {
+		return -2
+	}
+	return 0
+}
+
+// Number of values written to the stats slice of a wrapper.
+const statsLength = 7
+
+/*
+simulationStats collects counters of a single wrapper call. They are
+written to the trailing stats slice of the wrapper as
+[hops, wall time (s), hops/s, cache hits, rate recomputations, mallocs,
+allocated bytes]. Cache hits are hops that reused a stored probability list,
+rate recomputations are hops that calculated all rates. The
+allocation counters are taken from the Go runtime and therefore include
+other simulations that run at the same time.
+*/
+type simulationStats struct {
+	start              time.Time
+	startMallocs       uint64
+	startBytes         uint64
+	cacheHits          uint64
+	rateRecomputations uint64
+}
+
+func startStats() *simulationStats {
+	var mem runtime.MemStats
+	runtime.ReadMemStats(&mem)
+	return &simulationStats{start: time.Now(), startMallocs: mem.Mallocs, startBytes: mem.TotalAlloc}
+}
+
+func (s *simulationStats) store(out []float64, hops int) {
+	if len(out) < statsLength {
+		return
+	}
+	seconds := time.Since(s.start).Seconds()
+	var mem runtime.MemStats
+	runtime.ReadMemStats(&mem)
+	out[0] = float64(hops)
+	out[1] = seconds
+	if seconds > 0 {
+		out[2] = float64(hops) / seconds
+	} else {
+		out[2] = 0
+	}
+	out[3] = float64(s.cacheHits)
+	out[4] = float64(s.rateRecomputations)
+	out[5] = float64(mem.Mallocs - s.startMallocs)
+	out[6] = float64(mem.TotalAlloc - s.startBytes)
+}
@@ -1,8 +1,45 @@
 from ctypes import *
 from numpy import float64
+from contextlib import contextmanager
+import threading
 import numpy as np
 import time as time_lib
 
+libraryPath = "./goSimulation/libSimulation.so"
+_library = None
+_libraryLock = threading.Lock()
+_functions = {}
+
+def getLibrary():
+    '''
+    Loads the go library once (relative to the working directory, like
+    before) and returns it.
+    '''
+    global _library
+    with _libraryLock:
+        if _library is None:
+            _library = cdll.LoadLibrary(libraryPath)
+        return _library
+
+def getGoFunction(name, argtypes, restype=c_double):
+    '''
+    Returns the exported go function name with the given argtypes and
+    restype. Every signature gets its own function object, so threads that
+    call the same function with different signatures do not change each
+    others argtypes. ctypes releases the GIL during the call and the go
+    functions are re-entrant, so simulations in several threads run in
+    parallel.
+    '''
+    key = (name, tuple(argtypes), restype)
+    library = getLibrary()
+    with _libraryLock:
+        if key not in _functions:
+            function = library[name]
+            function.argtypes = list(argtypes)
+            function.restype = restype
+            _functions[key] = function
+        return _functions[key]
+
 def flattenDouble(arr2):
     d = len(arr2[0])
     arr = []
@@ -30,6 +67,13 @@ class GoSlice(Structure):
                 ("len", c_longlong), ("cap", c_longlong)]
                 
 
+class GoSliceUint64(Structure):
+    _fields_ = [("data", POINTER(c_uint64)),
+                ("len", c_longlong), ("cap", c_longlong)]
+
+def getEmptyGoSliceUint64(length):
+    return GoSliceUint64((c_uint64 * length)(), length, length)
+
 def getSliceValues(slice, log=False):
     r = []
     for i in range(slice.len):
@@ -46,9 +90,86 @@ def getDeflattenedSliceValues(slice, d1, d2):
             count+=1
     return r
 
+# Functions that take the trailing [rng_hi, rng_lo, resume] state slice and
+# can therefore be continued from where an earlier call stopped.
+resumableFunctions = ["wrapperSimulate", "wrapperSimulatePruned", "wrapperSimulateRecord",
+    "wrapperSimulateParallel", "wrapperSimulateCached"]
+
+# Functions that fill a trailing stats slice with the counters in statNames.
+statsFunctions = resumableFunctions
+statNames = ["hops", "wall_time", "hops_per_second", "cache_hits",
+    "rate_recomputations", "mallocs", "allocated_bytes"]
+
+@contextmanager
+def goProfile(path):
+    '''
+    Profiles all go simulations inside the with block. A CPU profile is
+    written to <path>.cpu and a heap profile to <path>.heap, which can be
+    inspected with
+        go tool pprof goSimulation/libSimulation.so <path>.cpu
+    '''
+    startProfile = getGoFunction("startProfile", [c_char_p], c_longlong)
+    stopProfile = getGoFunction("stopProfile", [], c_longlong)
+    result = startProfile(path.encode())
+    if result == -1:
+        raise RuntimeError("A go profile is already running")
+    if result == -2:
+        raise IOError("Could not create %s.cpu"%(path))
+    try:
+        yield
+    finally:
+        stopProfile()
+
+class ReuseCache():
+    '''
+    A persistent reuse cache in the go library. Simulations with
+    wrapperSimulateCached and the same ReuseCache reuse the transition rates
+    of the states that earlier calls with exactly the same configuration
+    (energies, voltages, geometry and constants) stored, instead of starting
+    with an empty cache every call. Every configuration gets its own table,
+    the least recently used tables are dropped to stay within budget bytes.
+    '''
+    def __init__(self, budget=2**30):
+        self.budget = int(budget)
+        self.handle = getGoFunction("newReuseCache", [c_longlong], c_longlong)(self.budget)
+
+    def info(self):
+        '''
+        Returns a dict with the number of configurations, stored states and
+        bytes in the cache.
+        '''
+        newInfo = getGoSlice(np.zeros(3))
+        if getGoFunction("reuseCacheInfo", [c_longlong, GoSlice], c_longlong)(self.handle, newInfo) == -1:
+            raise ValueError("The reuse cache is closed")
+        return dict(zip(["configurations", "states", "bytes"], getSliceValues(newInfo)))
+
+    def close(self):
+        '''
+        Frees the cache, later simulations with it use a cache per call.
+        '''
+        if self.handle is not None and _library is not None:
+            getGoFunction("freeReuseCache", [c_longlong], c_longlong)(self.handle)
+        self.handle = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
 def callGoSimulation(N_acceptors, N_electrodes, nu, kT, I_0, R, time, occupation, 
 		distances , E_constant, site_energies, transitions_constant, transitions, 
-        problist, electrode_occupation, hops, record, goSpecificFunction, prune_threshold=0.0):
+        problist, electrode_occupation, hops, record, goSpecificFunction, prune_threshold=0.0,
+        workers=0, rng_state=None, stats=None, reuse_cache=None):
+    '''
+    rng_state is only used by the resumableFunctions. It is a list
+    [rng_hi, rng_lo, resume]. If resume is 1 the simulation continues from
+    occupation with the given random state, otherwise it starts from an empty
+    system. After the call the list holds the state to continue from.
+    If stats is a dict and goSpecificFunction is one of the statsFunctions,
+    it is filled with the counters in statNames.
+    reuse_cache is the ReuseCache of wrapperSimulateCached.
+    '''
     newDistances, d, s = flattenDouble(distances)
     N = N_acceptors + N_electrodes
     newTransConstants, _, tcs = flattenDouble(transitions_constant)
@@ -61,24 +182,53 @@ def callGoSimulation(N_acceptors, N_electrodes, nu, kT, I_0, R, time, occupation
     traffic = getGoSlice(np.zeros(N*N))
     average_occupation = getGoSlice(np.zeros(N_acceptors))
     newElectrode_occupation = getGoSlice(electrode_occupation)
-    lib = cdll.LoadLibrary("./goSimulation/libSimulation.so")
-    getattr(lib, goSpecificFunction).argtypes = [c_longlong, c_longlong, c_double, c_double, c_double, c_double, c_double,
+    argtypes = [c_longlong, c_longlong, c_double, c_double, c_double, c_double, c_double,
         GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, c_int, c_bool, GoSlice, GoSlice]
 
-    getattr(lib, goSpecificFunction).restype = c_double
     #printSlice(newElectrode_occupation)
     args = [N_acceptors, N_electrodes, nu, kT, I_0, R, time, newOccupation, 
 		newDistances , newE_constant, newTransConstants, newElectrode_occupation, 
         newSite_energies, hops, record, traffic, average_occupation]
     if goSpecificFunction == "wrapperSimulatePruned":
-        getattr(lib, goSpecificFunction).argtypes = [c_longlong, c_longlong, c_double, c_double, c_double, c_double, c_double, c_double,
+        argtypes = [c_longlong, c_longlong, c_double, c_double, c_double, c_double, c_double, c_double,
             GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, c_int, c_bool, GoSlice, GoSlice]
 
         args = [N_acceptors, N_electrodes, prune_threshold, nu, kT, I_0, R, time, newOccupation, 
 		    newDistances , newE_constant, newTransConstants, newElectrode_occupation, 
             newSite_energies, hops, record, traffic, average_occupation]
+    if goSpecificFunction == "wrapperSimulateParallel":
+        argtypes = [c_longlong, c_longlong, c_longlong, c_double, c_double, c_double, c_double, c_double,
+            GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, c_int, c_bool, GoSlice, GoSlice]
+
+        args = [N_acceptors, N_electrodes, workers, nu, kT, I_0, R, time, newOccupation, 
+		    newDistances , newE_constant, newTransConstants, newElectrode_occupation, 
+            newSite_energies, hops, record, traffic, average_occupation]
+    if goSpecificFunction == "wrapperSimulateCached":
+        handle = reuse_cache.handle if reuse_cache is not None and reuse_cache.handle is not None else 0
+        argtypes = [c_longlong, c_longlong, c_longlong, c_double, c_double, c_double, c_double, c_double,
+            GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, c_int, c_bool, GoSlice, GoSlice]
+
+        args = [N_acceptors, N_electrodes, handle, nu, kT, I_0, R, time, newOccupation, 
+		    newDistances , newE_constant, newTransConstants, newElectrode_occupation, 
+            newSite_energies, hops, record, traffic, average_occupation]
+
+    if goSpecificFunction in resumableFunctions:
+        if rng_state is None:
+            rng_state = [0.0, 0.0, 0.0]
+        newState = getGoSlice(rng_state)
+        argtypes.append(GoSlice)
+        args.append(newState)
 
-    time = getattr(lib, goSpecificFunction)(*args)
+    if goSpecificFunction in statsFunctions:
+        newStats = getGoSlice(np.zeros(len(statNames)))
+        argtypes.append(GoSlice)
+        args.append(newStats)
+
+    time = getGoFunction(goSpecificFunction, argtypes)(*args)
+    if goSpecificFunction in resumableFunctions:
+        rng_state[:] = getSliceValues(newState)
+    if goSpecificFunction in statsFunctions and stats is not None:
+        stats.update(zip(statNames, getSliceValues(newStats)))
     #printSlice (newElectrode_occupation)
     rElectrode_occupation = np.array([int(i) for i in getSliceValues(newElectrode_occupation)])
     occupation = np.array([int(i) for i in getSliceValues(newOccupation)])
@@ -90,3 +240,257 @@ def callGoSimulation(N_acceptors, N_electrodes, nu, kT, I_0, R, time, occupation
         return time, occupation, rElectrode_occupation, np.array(getDeflattenedSliceValues(traffic, N, N)), np.array(getSliceValues(average_occupation))
 
 
+
+def callGoConductance(N_acceptors, N_electrodes, nu, kT, I_0, R, time, occupation, 
+		distances , E_constant, site_energies, transitions_constant, 
+        electrode_occupation, hops, blocks, stats=None):
+    '''
+    Calls wrapperSimulateConductance, which simulates hops in blocks of
+    equal hop count. Returns the total time, the final occupation, the
+    charge that entered every electrode per block (blocks x N_electrodes)
+    and the duration of every block.
+    '''
+    newDistances, d, s = flattenDouble(distances)
+    N = N_acceptors + N_electrodes
+    newTransConstants, _, tcs = flattenDouble(transitions_constant)
+    newDistances = GoSlice(newDistances, s, s)
+    newTransConstants = GoSlice(newTransConstants, tcs, tcs)
+    newOccupation = getGoSlice(occupation)
+    newE_constant = getGoSlice(E_constant)
+    newSite_energies = getGoSlice(site_energies)
+    traffic = getGoSlice(np.zeros(N*N))
+    average_occupation = getGoSlice(np.zeros(N_acceptors))
+    newElectrode_occupation = getGoSlice(electrode_occupation)
+    block_charge = getGoSlice(np.zeros(blocks*N_electrodes))
+    block_time = getGoSlice(np.zeros(blocks))
+    newStats = getGoSlice(np.zeros(len(statNames)))
+    wrapperSimulateConductance = getGoFunction("wrapperSimulateConductance", [c_longlong, c_longlong, c_double, c_double, c_double, c_double, c_double,
+        GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, c_int, c_bool, GoSlice, GoSlice, 
+        GoSlice, GoSlice, GoSlice])
+
+    time = wrapperSimulateConductance(N_acceptors, N_electrodes, nu, kT, I_0, R, time, newOccupation, 
+		newDistances , newE_constant, newTransConstants, newElectrode_occupation, 
+        newSite_energies, hops, False, traffic, average_occupation, 
+        block_charge, block_time, newStats)
+    if stats is not None:
+        stats.update(zip(statNames, getSliceValues(newStats)))
+    occupation = np.array([int(i) for i in getSliceValues(newOccupation)])
+    return (time, occupation, 
+            np.array(getSliceValues(block_charge)).reshape((blocks, N_electrodes)),
+            np.array(getSliceValues(block_time)))
+
+def callGoSensitivity(N_acceptors, N_electrodes, nu, kT, I_0, R, time, occupation, 
+		distances , E_constant, site_energies, transitions_constant, 
+        electrode_occupation, hops, blocks, voltage_gradient, rng_state=None, 
+        stats=None):
+    '''
+    Calls wrapperSimulateSensitivity. voltage_gradient is the 
+    (N_acceptors+N_electrodes) x N_electrodes matrix dE_i/dV_k. 
+    Returns the total time, the final occupation and per block the charge 
+    that entered every electrode, the duration and the likelihood ratio 
+    score to every electrode voltage (blocks x N_electrodes).
+    rng_state works like in callGoSimulation.
+    '''
+    newDistances, d, s = flattenDouble(distances)
+    N = N_acceptors + N_electrodes
+    newTransConstants, _, tcs = flattenDouble(transitions_constant)
+    newGradient, _, gs = flattenDouble(voltage_gradient)
+    newDistances = GoSlice(newDistances, s, s)
+    newTransConstants = GoSlice(newTransConstants, tcs, tcs)
+    newGradient = GoSlice(newGradient, gs, gs)
+    newOccupation = getGoSlice(occupation)
+    newE_constant = getGoSlice(E_constant)
+    newSite_energies = getGoSlice(site_energies)
+    traffic = getGoSlice(np.zeros(N*N))
+    average_occupation = getGoSlice(np.zeros(N_acceptors))
+    newElectrode_occupation = getGoSlice(electrode_occupation)
+    block_charge = getGoSlice(np.zeros(blocks*N_electrodes))
+    block_time = getGoSlice(np.zeros(blocks))
+    block_score = getGoSlice(np.zeros(blocks*N_electrodes))
+    if rng_state is None:
+        rng_state = [0.0, 0.0, 0.0]
+    newState = getGoSlice(rng_state)
+    newStats = getGoSlice(np.zeros(len(statNames)))
+    wrapperSimulateSensitivity = getGoFunction("wrapperSimulateSensitivity", [c_longlong, c_longlong, c_double, c_double, c_double, c_double, c_double,
+        GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, c_int, c_bool, GoSlice, GoSlice, 
+        GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, GoSlice])
+
+    time = wrapperSimulateSensitivity(N_acceptors, N_electrodes, nu, kT, I_0, R, time, newOccupation, 
+		newDistances , newE_constant, newTransConstants, newElectrode_occupation, 
+        newSite_energies, hops, False, traffic, average_occupation, 
+        newGradient, block_charge, block_time, block_score, newState, newStats)
+    rng_state[:] = getSliceValues(newState)
+    if stats is not None:
+        stats.update(zip(statNames, getSliceValues(newStats)))
+    occupation = np.array([int(i) for i in getSliceValues(newOccupation)])
+    return (time, occupation, 
+            np.array(getSliceValues(block_charge)).reshape((blocks, N_electrodes)),
+            np.array(getSliceValues(block_time)),
+            np.array(getSliceValues(block_score)).reshape((blocks, N_electrodes)))
+
+def callGoControlVariate(N_acceptors, N_electrodes, nu, kT, I_0, R, time, occupation, 
+		distances , E_constant, site_energies, transitions_constant, 
+        electrode_occupation, hops, blocks, rng_state=None, stats=None):
+    '''
+    Calls wrapperSimulateControlVariate. Returns the total time, the final
+    occupation and per block the charge that entered every electrode, the
+    expected charge (both blocks x N_electrodes), the duration and the
+    expected duration. rng_state works like in callGoSimulation.
+    '''
+    newDistances, d, s = flattenDouble(distances)
+    N = N_acceptors + N_electrodes
+    newTransConstants, _, tcs = flattenDouble(transitions_constant)
+    newDistances = GoSlice(newDistances, s, s)
+    newTransConstants = GoSlice(newTransConstants, tcs, tcs)
+    newOccupation = getGoSlice(occupation)
+    newE_constant = getGoSlice(E_constant)
+    newSite_energies = getGoSlice(site_energies)
+    traffic = getGoSlice(np.zeros(N*N))
+    average_occupation = getGoSlice(np.zeros(N_acceptors))
+    newElectrode_occupation = getGoSlice(electrode_occupation)
+    block_charge = getGoSlice(np.zeros(blocks*N_electrodes))
+    block_expected = getGoSlice(np.zeros(blocks*N_electrodes))
+    block_time = getGoSlice(np.zeros(blocks))
+    block_expected_time = getGoSlice(np.zeros(blocks))
+    if rng_state is None:
+        rng_state = [0.0, 0.0, 0.0]
+    newState = getGoSlice(rng_state)
+    newStats = getGoSlice(np.zeros(len(statNames)))
+    wrapperSimulateControlVariate = getGoFunction("wrapperSimulateControlVariate", [c_longlong, c_longlong, c_double, c_double, c_double, c_double, c_double,
+        GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, c_int, c_bool, GoSlice, GoSlice, 
+        GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, GoSlice])
+
+    time = wrapperSimulateControlVariate(N_acceptors, N_electrodes, nu, kT, I_0, R, time, newOccupation, 
+		newDistances , newE_constant, newTransConstants, newElectrode_occupation, 
+        newSite_energies, hops, False, traffic, average_occupation, 
+        block_charge, block_expected, block_time, block_expected_time, newState, newStats)
+    rng_state[:] = getSliceValues(newState)
+    if stats is not None:
+        stats.update(zip(statNames, getSliceValues(newStats)))
+    occupation = np.array([int(i) for i in getSliceValues(newOccupation)])
+    return (time, occupation, 
+            np.array(getSliceValues(block_charge)).reshape((blocks, N_electrodes)),
+            np.array(getSliceValues(block_expected)).reshape((blocks, N_electrodes)),
+            np.array(getSliceValues(block_time)),
+            np.array(getSliceValues(block_expected_time)))
+
+def callGoTrajectory(N_acceptors, N_electrodes, nu, kT, I_0, R, time, occupation, 
+		distances , E_constant, site_energies, transitions_constant, 
+        electrode_occupation, hops, blocks, max_records, rng_state=None, 
+        stats=None):
+    '''
+    Calls wrapperSimulateTrajectory, which records per block the time spent
+    in every state and the transitions taken. Returns the total time, the
+    final occupation, the block durations, the residences as 
+    (block, state key, time) and the jumps as 
+    (block, state key, from, to, count), all numpy arrays. At most 
+    max_records residences and jumps are kept, a ValueError is raised if
+    more were needed. rng_state works like in callGoSimulation.
+    '''
+    newDistances, d, s = flattenDouble(distances)
+    N = N_acceptors + N_electrodes
+    newTransConstants, _, tcs = flattenDouble(transitions_constant)
+    newDistances = GoSlice(newDistances, s, s)
+    newTransConstants = GoSlice(newTransConstants, tcs, tcs)
+    newOccupation = getGoSlice(occupation)
+    newE_constant = getGoSlice(E_constant)
+    newSite_energies = getGoSlice(site_energies)
+    traffic = getGoSlice(np.zeros(N*N))
+    average_occupation = getGoSlice(np.zeros(N_acceptors))
+    newElectrode_occupation = getGoSlice(electrode_occupation)
+    block_time = getGoSlice(np.zeros(blocks))
+    residence_keys = getEmptyGoSliceUint64(max_records)
+    residence_values = GoSlice((c_double * (2*max_records))(), 2*max_records, 2*max_records)
+    jump_keys = getEmptyGoSliceUint64(max_records)
+    jump_values = GoSlice((c_double * (4*max_records))(), 4*max_records, 4*max_records)
+    sizes = getGoSlice(np.zeros(2))
+    if rng_state is None:
+        rng_state = [0.0, 0.0, 0.0]
+    newState = getGoSlice(rng_state)
+    newStats = getGoSlice(np.zeros(len(statNames)))
+    wrapperSimulateTrajectory = getGoFunction("wrapperSimulateTrajectory", [c_longlong, c_longlong, c_double, c_double, c_double, c_double, c_double,
+        GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, c_int, c_bool, GoSlice, GoSlice, 
+        GoSlice, GoSliceUint64, GoSlice, GoSliceUint64, GoSlice, GoSlice, GoSlice, GoSlice])
+
+    time = wrapperSimulateTrajectory(N_acceptors, N_electrodes, nu, kT, I_0, R, time, newOccupation, 
+		newDistances , newE_constant, newTransConstants, newElectrode_occupation, 
+        newSite_energies, hops, False, traffic, average_occupation, 
+        block_time, residence_keys, residence_values, jump_keys, jump_values,
+        sizes, newState, newStats)
+    rng_state[:] = getSliceValues(newState)
+    if stats is not None:
+        stats.update(zip(statNames, getSliceValues(newStats)))
+    n_residences, n_jumps = [int(i) for i in getSliceValues(sizes)]
+    if n_residences > max_records or n_jumps > max_records:
+        raise ValueError("The trajectory needed %d records, but max_records is %d"
+                         %(max(n_residences, n_jumps), max_records))
+    occupation = np.array([int(i) for i in getSliceValues(newOccupation)])
+    res_values = np.ctypeslib.as_array(residence_values.data, (2*max_records,))
+    res_values = res_values[:2*n_residences].reshape((n_residences, 2)).copy()
+    res_keys = np.ctypeslib.as_array(residence_keys.data, (max_records,))[:n_residences].copy()
+    j_values = np.ctypeslib.as_array(jump_values.data, (4*max_records,))
+    j_values = j_values[:4*n_jumps].reshape((n_jumps, 4)).copy()
+    j_keys = np.ctypeslib.as_array(jump_keys.data, (max_records,))[:n_jumps].copy()
+    residences = (res_values[:, 0].astype(int), res_keys, res_values[:, 1])
+    jumps = (j_values[:, 0].astype(int), j_keys, j_values[:, 1].astype(int), 
+             j_values[:, 2].astype(int), j_values[:, 3])
+    return (time, occupation, np.array(getSliceValues(block_time)), 
+            residences, jumps)
+
+def callGoStateHistogram(N_acceptors, N_electrodes, nu, kT, I_0, R, time, occupation, 
+		distances , E_constant, site_energies, transitions_constant, 
+        electrode_occupation, hops, max_states, top_k, rng_state=None, 
+        stats=None):
+    '''
+    Calls wrapperSimulateStateHistogram, which counts the visits of and the
+    time spent in every state. Returns the total time, the final occupation,
+    the electrode occupation, the top_k most visited states as packed
+    occupation keys 
+    (states x ceil(N_acceptors/64) uint64 array, acceptor i is bit i%64 of
+    word i/64), their visit counts and residence times, and 
+    [tracked states, visits of untracked states, time in untracked states].
+    At most max_states states are tracked. rng_state works like in
+    callGoSimulation.
+    '''
+    newDistances, d, s = flattenDouble(distances)
+    N = N_acceptors + N_electrodes
+    words = (N_acceptors + 63)//64
+    newTransConstants, _, tcs = flattenDouble(transitions_constant)
+    newDistances = GoSlice(newDistances, s, s)
+    newTransConstants = GoSlice(newTransConstants, tcs, tcs)
+    newOccupation = getGoSlice(occupation)
+    newE_constant = getGoSlice(E_constant)
+    newSite_energies = getGoSlice(site_energies)
+    traffic = getGoSlice(np.zeros(N*N))
+    average_occupation = getGoSlice(np.zeros(N_acceptors))
+    newElectrode_occupation = getGoSlice(electrode_occupation)
+    keys = getEmptyGoSliceUint64(words*top_k)
+    counts = GoSlice((c_double * top_k)(), top_k, top_k)
+    residence = GoSlice((c_double * top_k)(), top_k, top_k)
+    sizes = getGoSlice(np.zeros(3))
+    if rng_state is None:
+        rng_state = [0.0, 0.0, 0.0]
+    newState = getGoSlice(rng_state)
+    newStats = getGoSlice(np.zeros(len(statNames)))
+    wrapperSimulateStateHistogram = getGoFunction("wrapperSimulateStateHistogram", [c_longlong, c_longlong, c_longlong, 
+        c_double, c_double, c_double, c_double, c_double,
+        GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, GoSlice, c_int, c_bool, GoSlice, GoSlice, 
+        GoSliceUint64, GoSlice, GoSlice, GoSlice, GoSlice, GoSlice])
+
+    time = wrapperSimulateStateHistogram(N_acceptors, N_electrodes, max_states, nu, kT, I_0, R, time, newOccupation, 
+		newDistances , newE_constant, newTransConstants, newElectrode_occupation, 
+        newSite_energies, hops, False, traffic, average_occupation, 
+        keys, counts, residence, sizes, newState, newStats)
+    rng_state[:] = getSliceValues(newState)
+    if stats is not None:
+        stats.update(zip(statNames, getSliceValues(newStats)))
+    sizes = getSliceValues(sizes)
+    n_states = min(int(sizes[0]), top_k)
+    occupation = np.array([int(i) for i in getSliceValues(newOccupation)])
+    state_keys = np.ctypeslib.as_array(keys.data, (words*top_k,))
+    state_keys = state_keys[:words*n_states].reshape((n_states, words)).copy()
+    state_counts = np.ctypeslib.as_array(counts.data, (top_k,))[:n_states].astype(np.int64)
+    state_time = np.ctypeslib.as_array(residence.data, (top_k,))[:n_states].copy()
+    rElectrode_occupation = np.array([int(i) for i in getSliceValues(newElectrode_occupation)])
+    return (time, occupation, rElectrode_occupation, state_keys, state_counts, 
+            state_time, np.array(sizes))
@@ -0,0 +1,224 @@
+package main
+
+import "C"
+import (
+	"math"
+	"sync"
+	"sync/atomic"
+)
+
+// Approximate memory use of the map entries, on top of the probability
+// list and the key (8 bytes per 64 sites, see stateKeys) itself.
+const storedStateOverhead = 64
+const countedStateOverhead = 16
+
+/*
+reuseTable is the state reuse cache of simulate: the stored probability
+lists and how often every state was seen. States are keyed by their exact
+occupation (stateKeys), so states of large systems never share an entry,
+not even across calls. Without a reuseCache a table only lives for a
+single call. A reuseCache keeps one table per configuration (fingerprint)
+so that later calls with the same configuration start with a hot cache.
+*/
+type reuseTable struct {
+	allProbs               map[string]*probabilities
+	countProbs             map[string]uint16
+	countStorage           uint64
+	reuseThreshold         uint16
+	reuseThresholdIncrease uint64
+	bytes                  int64
+	states                 int64
+	lastUsed               uint64
+	users                  int
+	busy                   sync.Mutex
+	cache                  *reuseCache
+}
+
+func newReuseTable(cache *reuseCache) *reuseTable {
+	return &reuseTable{
+		allProbs:               make(map[string]*probabilities),
+		countProbs:             make(map[string]uint16),
+		reuseThreshold:         1,
+		reuseThresholdIncrease: 100000,
+		cache:                  cache,
+	}
+}
+
+// reserve accounts for bytes more memory in the table. It returns false,
+// and reserves nothing, if the budget of the cache does not allow it.
+func (t *reuseTable) reserve(bytes int64) bool {
+	if t.cache == nil {
+		t.bytes += bytes
+		return true
+	}
+	return t.cache.reserve(t, bytes)
+}
+
+// count registers a sighting of state key (see stateKeys) and returns how
+// often it was seen before.
+func (t *reuseTable) count(key []byte) (uint16, bool) {
+	val, ok := t.countProbs[string(key)]
+	if ok {
+		if val < math.MaxUint16 {
+			t.countProbs[string(key)]++
+		}
+	} else if t.reserve(int64(countedStateOverhead + len(key))) {
+		t.countProbs[string(key)] = 1
+	}
+	return val, ok
+}
+
+// store stores the probability list of state key, if the budget allows it.
+func (t *reuseTable) store(key []byte, probList []float32) {
+	if !t.reserve(int64(4*len(probList) + storedStateOverhead + len(key))) {
+		return
+	}
+	t.allProbs[string(key)] = &probabilities{probList}
+	atomic.AddInt64(&t.states, 1)
+	t.countStorage++
+	if t.countStorage > t.reuseThresholdIncrease {
+		t.reuseThreshold++
+		t.reuseThresholdIncrease += 100000
+	}
+}
+
+/*
+reuseCache is a persistent reuse cache, shared by all simulations that are
+given its handle. It holds a reuseTable per configuration fingerprint and
+stays within a memory budget: when a table has to grow beyond it, the least
+recently used other tables are dropped, and if that is not enough the
+table stops storing states.
+*/
+type reuseCache struct {
+	mtx    sync.Mutex
+	budget int64
+	bytes  int64
+	tick   uint64
+	tables map[uint64]*reuseTable
+}
+
+var cacheMtx sync.Mutex
+var caches = make(map[int64]*reuseCache)
+var nextCacheHandle int64 = 1
+
+// acquire returns the table of fingerprint, locked for the caller until
+// release is called.
+func (c *reuseCache) acquire(fingerprint uint64) *reuseTable {
+	c.mtx.Lock()
+	t, ok := c.tables[fingerprint]
+	if !ok {
+		t = newReuseTable(c)
+		c.tables[fingerprint] = t
+	}
+	c.tick++
+	t.lastUsed = c.tick
+	t.users++
+	c.mtx.Unlock()
+	t.busy.Lock()
+	return t
+}
+
+func (c *reuseCache) release(t *reuseTable) {
+	t.busy.Unlock()
+	c.mtx.Lock()
+	t.users--
+	c.mtx.Unlock()
+}
+
+func (c *reuseCache) reserve(t *reuseTable, bytes int64) bool {
+	c.mtx.Lock()
+	defer c.mtx.Unlock()
+	for c.bytes+bytes > c.budget {
+		// Drop the least recently used table that is not in use
+		var oldestKey uint64
+		var oldest *reuseTable
+		for key, other := range c.tables {
+			if other.users == 0 && (oldest == nil || other.lastUsed < oldest.lastUsed) {
+				oldestKey, oldest = key, other
+			}
+		}
+		if oldest == nil {
+			return false
+		}
+		delete(c.tables, oldestKey)
+		c.bytes -= oldest.bytes
+	}
+	c.bytes += bytes
+	t.bytes += bytes
+	return true
+}
+
+func getReuseCache(handle int64) *reuseCache {
+	cacheMtx.Lock()
+	defer cacheMtx.Unlock()
+	return caches[handle]
+}
+
+/*
+configurationFingerprint hashes (FNV-1a) everything the rates depend on,
+so that a table is only reused for the exact same configuration.
+*/
+func configurationFingerprint(values ...[]float32) uint64 {
+	hash := uint64(14695981039346656037)
+	for _, list := range values {
+		for _, v := range list {
+			hash ^= uint64(math.Float32bits(v))
+			hash *= 1099511628211
+		}
+		hash ^= uint64(len(list))
+		hash *= 1099511628211
+	}
+	return hash
+}
+
+func flatten32(m [][]float32) []float32 {
+	r := make([]float32, 0, len(m)*len(m))
+	for _, row := range m {
+		r = append(r, row...)
+	}
+	return r
+}
+
+// newReuseCache creates a persistent reuse cache that uses at most budget
+// bytes and returns its handle.
+//export newReuseCache
+func newReuseCache(budget int64) int64 {
+	cacheMtx.Lock()
+	defer cacheMtx.Unlock()
+	handle := nextCacheHandle
+	nextCacheHandle++
+	caches[handle] = &reuseCache{budget: budget, tables: make(map[uint64]*reuseTable)}
+	return handle
+}
+
+// freeReuseCache drops the cache of handle. Returns -1 if there is none.
+//export freeReuseCache
+func freeReuseCache(handle int64) int64 {
+	cacheMtx.Lock()
+	defer cacheMtx.Unlock()
+	if _, ok := caches[handle]; !ok {
+		return -1
+	}
+	delete(caches, handle)
+	return 0
+}
+
+// reuseCacheInfo writes [configurations, stored states, bytes] of the cache
+// of handle to info. Returns -1 if there is no such cache.
+//export reuseCacheInfo
+func reuseCacheInfo(handle int64, info []float64) int64 {
+	c := getReuseCache(handle)
+	if c == nil || len(info) < 3 {
+		return -1
+	}
+	c.mtx.Lock()
+	defer c.mtx.Unlock()
+	states := int64(0)
+	for _, t := range c.tables {
+		states += atomic.LoadInt64(&t.states)
+	}
+	info[0] = float64(len(c.tables))
+	info[1] = float64(states)
+	info[2] = float64(c.bytes)
+	return 0
+}
@@ -0,0 +1,145 @@
+package main
+
+import "math/rand"
+
+// sensitivityCache holds, for a single state, the cumulative rates and the
+// derivative of the total rate to every electrode voltage.
+type sensitivityCache struct {
+    probList []float32
+    dTotalRate []float64
+}
+
+// hopEnergy is the energy difference of a hop, exactly as calcTransitionList
+// uses it.
+func hopEnergy(from int, to int, NSites int, site_energies []float32, distances [][]float32,
+        R float32, I_0 float32) float32 {
+    if from < NSites && to < NSites {
+        return site_energies[to] - site_energies[from] - I_0*R/distances[from][to]
+    }
+    return site_energies[to] - site_energies[from]
+}
+
+// addLogRateGradient adds d ln(rate)/dV_k of the hop from -> to, times
+// weight, to out. gradient[i*NElectrodes+k] is dE_i/dV_k. The rate only
+// depends on the voltages if dE > 0, it is then nu*exp(-dE/kT).
+func addLogRateGradient(out []float64, weight float64, from int, to int, NElectrodes int,
+        gradient []float64, kT float32) {
+    for k := 0; k < NElectrodes; k++ {
+        out[k] -= weight*(gradient[to*NElectrodes+k] - gradient[from*NElectrodes+k])/float64(kT)
+    }
+}
+
+/*
+sensitivitySimulate is simulate with likelihood ratio (score function)
+estimators of the derivative of the currents to the electrode voltages.
+The hops are split in len(block_time) blocks of equal length. For every
+block b it stores the charge that entered each electrode in
+block_charge[b*NElectrodes+p], the duration in block_time[b], and the score
+of the block with respect to V_k
+    S_bk = sum over hops of d ln a_hop/dV_k - integral of d a_0/dV_k dt
+in block_score[b*NElectrodes+k], where a_hop is the rate of the hop that
+was made and a_0 the total rate. The covariance of charges and scores over
+blocks then estimates dI_p/dV_k, see kmc_dn.current_sensitivity. Only
+correlations within a block are taken into account, so blocks have to last
+longer than the correlation time of the system. The variance of the scores
+grows with the block length, so they should not be much longer either.
+*/
+func sensitivitySimulate(NSites int, NElectrodes int, nu float32, kT float32, I_0 float32, R float32,
+        occupation []bool, distances [][]float32, E_constant []float32, transitions_constant [][]float32,
+        electrode_occupation []float64, site_energies []float32, hops int, gradient []float64,
+        block_charge []float64, block_time []float64, block_score []float64, rng *rand.Rand,
+        stats *simulationStats) float64 {
+    N := NSites + NElectrodes
+    transitions := make([]transition, 0, N*N)
+    for i := 0; i < N; i++ {
+        for j := 0; j < N; j++ {
+            if transitions_constant[i][j] > 0 {
+                transitions = append(transitions, transition{i, j, 0})
+            }
+        }
+    }
+
+    for i := 0; i < NSites; i++ {
+        acceptor_interaction := float32(0)
+        for j := 0; j < NSites; j++ {
+            if j != i && !occupation[j] {
+                acceptor_interaction+= 1/distances[i][j]
+            }
+        }
+        site_energies[i] = E_constant[i] - I_0*R*acceptor_interaction
+    }
+    for i := 0; i < NElectrodes; i++ {
+        electrode_occupation[i] = 0.0
+    }
+
+    // States are stored once they are seen for the second time, like in
+    // simulate with the lowest reuse threshold.
+    keys := newStateKeys(NSites)
+    allStates := make(map[string]*sensitivityCache)
+    seen := make(map[string]bool)
+    blocks := len(block_time)
+    time := float64(0)
+    for b := 0; b < blocks; b++ {
+        blockHops := hops/blocks
+        if b < hops%blocks {
+            blockHops++
+        }
+        score := block_score[b*NElectrodes:(b+1)*NElectrodes]
+        charge := block_charge[b*NElectrodes:(b+1)*NElectrodes]
+        for k := 0; k < NElectrodes; k++ {
+            score[k] = 0
+            charge[k] = -electrode_occupation[k]
+        }
+        block_time[b] = 0
+
+        for ; blockHops > 0; blockHops-- {
+            packed := keys.pack(occupation)
+            state, ok := allStates[string(packed)]
+            if ok {
+                if stats != nil {
+                    stats.cacheHits++
+                }
+            } else {
+                state = &sensitivityCache{make([]float32, len(transitions)), make([]float64, NElectrodes)}
+                calcTransitionList(transitions, distances, occupation, site_energies, R, I_0, kT, nu, NSites, N, transitions_constant)
+                for i, trans := range transitions {
+                    if i == 0 {
+                        state.probList[0] = trans.rate
+                    } else {
+                        state.probList[i] = state.probList[i-1] + trans.rate
+                    }
+                    if trans.rate > 0 && hopEnergy(trans.from, trans.to, NSites, site_energies, distances, R, I_0) > 0 {
+                        addLogRateGradient(state.dTotalRate, float64(trans.rate), trans.from, trans.to, NElectrodes, gradient, kT)
+                    }
+                }
+                if seen[string(packed)] {
+                    allStates[string(packed)] = state
+                } else {
+                    seen[string(packed)] = true
+                }
+                if stats != nil {
+                    stats.rateRecomputations++
+                }
+            }
+
+            time_step := rng.ExpFloat64() / float64(state.probList[len(state.probList)-1])
+            block_time[b] += time_step
+            for k := 0; k < NElectrodes; k++ {
+                score[k] -= state.dTotalRate[k]*time_step
+            }
+            event := getRandomEvent(rng, state.probList)
+            from := transitions[event].from
+            to := transitions[event].to
+            if hopEnergy(from, to, NSites, site_energies, distances, R, I_0) > 0 {
+                addLogRateGradient(score, 1.0, from, to, NElectrodes, gradient, kT)
+            }
+            makeJump(occupation, electrode_occupation, site_energies, distances, R, I_0,
+                NSites, from, to)
+        }
+        for k := 0; k < NElectrodes; k++ {
+            charge[k] += electrode_occupation[k]
+        }
+        time += block_time[b]
+    }
+    return time
+}
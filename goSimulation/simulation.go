@@ -1,11 +1,12 @@
 package main
 
 import (
+    "encoding/binary"
     "fmt"
     "math"
     "math/rand"
-    "io/ioutil" 
-    "encoding/json"
+    "runtime"
+    "sync"
     )
 //import "sort"
 
@@ -37,6 +38,42 @@ func getKey(boolAr []bool) uint64 {
     return r
 }
 
+/*
+stateKeys makes the keys of the state caches: the exact packed occupation
+of packOccupation. getKey only keeps the last 64 sites, so with more sites
+different states would share a key and each others rates. pack reuses a
+buffer, the returned bytes are only valid until the next call. Index maps
+with string(packed), which does not allocate, and only convert to a string
+to store a key.
+*/
+type stateKeys struct {
+    words int
+    buffer []byte
+}
+
+func newStateKeys(NSites int) *stateKeys {
+    words := (NSites + 63)/64
+    return &stateKeys{words, make([]byte, 8*words)}
+}
+
+func (k *stateKeys) pack(occupation []bool) []byte {
+    for w := 0; w < k.words; w++ {
+        end := 64*(w+1)
+        if end > len(occupation) {
+            end = len(occupation)
+        }
+        var word uint64
+        for i := end - 1; i >= 64*w; i-- {
+            word <<= 1
+            if occupation[i] {
+                word |= 1
+            }
+        }
+        binary.LittleEndian.PutUint64(k.buffer[8*w:], word)
+    }
+    return k.buffer
+}
+
 func transition_possible(i int, j int, NSites int, occupation []bool) bool {
     if i == j {
         return false
@@ -139,29 +176,38 @@ type transition struct {
     rate float32;
 }
 
-type reuseLog struct {
-    Reuses []uint64
-    States []int
+// resumableSource is a splitmix64 random source. Its complete state is a
+// single uint64, so a simulation can be stopped and later continued with
+// exactly the random stream it would otherwise have used.
+type resumableSource struct {
+    state uint64
 }
 
-func logReuseToJson(reuses []uint64, states []int, file_name string){
-    var log_list []reuseLog
-    data, err := ioutil.ReadFile(file_name)
-    if err == nil {
-        err2 := json.Unmarshal(data, &log_list)
-        if err2 != nil {
-            fmt.Printf("opening config file %s", err2.Error())
-        }
-    }
+func (s *resumableSource) Uint64() uint64 {
+    s.state += 0x9E3779B97F4A7C15
+    z := s.state
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EB
+    return z ^ (z >> 31)
+}
+
+func (s *resumableSource) Int63() int64 {
+    return int64(s.Uint64() >> 1)
+}
+
+func (s *resumableSource) Seed(seed int64) {
+    s.state = uint64(seed)
+}
 
-    log := reuseLog {reuses, states}
-    log_list = append(log_list, log)
-    logjson, _ := json.Marshal(log_list)
-    _ = ioutil.WriteFile(file_name, logjson, 0644)
+// newRandom returns a generator on a fresh resumableSource, seeded from the
+// global source.
+func newRandom() (*rand.Rand, *resumableSource) {
+    source := &resumableSource{rand.Uint64()}
+    return rand.New(source), source
 }
 
-func getRandomEvent(probList []float32) int {
-    eventRand := rand.Float32() * probList[len(probList)-1]
+func getRandomEvent(rng *rand.Rand, probList []float32) int {
+    eventRand := rng.Float32() * probList[len(probList)-1]
     event := 0
     e_step := int(len(probList)/2)
     i := e_step
@@ -186,15 +232,131 @@ func getRandomEvent(probList []float32) int {
     }
     return event
 }
+// Below parallelRateThreshold transitions the goroutine hand-off costs more
+// than the rate calculation itself, so rateTeams are only made above it.
+const parallelRateThreshold = 4096
+const maxRateWorkers = 8
+
+// rateTeam recalculates the rates of one simulation and builds its
+// cumulative probList with a small fixed team of goroutines. Every worker
+// owns one block of the transition list. In the first phase each worker
+// calculates the rates and a local prefix sum of its block, after which the
+// block sums are scanned serially and added to the blocks in a second phase.
+type rateTeam struct {
+    workers int
+    bounds []int
+    blockSums []float32
+    offsets []float32
+    start []chan int
+    done sync.WaitGroup
+
+    transitions []transition
+    probList []float32
+    distances [][]float32
+    occupation []bool
+    site_energies []float32
+    transitions_constant [][]float32
+    R, I_0, kT, nu float32
+    NSites, N int
+}
 
+// newRateTeam returns nil if the transition list is too small to gain from
+// parallelism, in which case the serial path should be used.
+func newRateTeam(workers int, transitions []transition) *rateTeam {
+    if workers <= 0 {
+        workers = runtime.NumCPU()
+    }
+    if workers > maxRateWorkers {
+        workers = maxRateWorkers
+    }
+    if workers < 2 || len(transitions) < parallelRateThreshold {
+        return nil
+    }
+    team := &rateTeam{workers: workers, transitions: transitions}
+    team.bounds = make([]int, workers+1)
+    for w := 0; w <= workers; w++ {
+        team.bounds[w] = w*len(transitions)/workers
+    }
+    team.blockSums = make([]float32, workers)
+    team.offsets = make([]float32, workers)
+    team.start = make([]chan int, workers)
+    // Block 0 is handled by the calling goroutine itself.
+    for w := 1; w < workers; w++ {
+        team.start[w] = make(chan int)
+        go team.work(w)
+    }
+    return team
+}
+
+func (team *rateTeam) work(w int) {
+    for phase := range team.start[w] {
+        team.runPhase(w, phase)
+        team.done.Done()
+    }
+}
 
-  
+func (team *rateTeam) runPhase(w int, phase int) {
+    lo, hi := team.bounds[w], team.bounds[w+1]
+    if phase == 1 {
+        calcTransitionList(team.transitions[lo:hi], team.distances, team.occupation, team.site_energies,
+            team.R, team.I_0, team.kT, team.nu, team.NSites, team.N, team.transitions_constant)
+        sum := float32(0)
+        for i := lo; i < hi; i++ {
+            sum += team.transitions[i].rate
+            team.probList[i] = sum
+        }
+        team.blockSums[w] = sum
+    } else {
+        offset := team.offsets[w]
+        for i := lo; i < hi; i++ {
+            team.probList[i] += offset
+        }
+    }
+}
 
+func (team *rateTeam) runAll(phase int) {
+    team.done.Add(team.workers-1)
+    for w := 1; w < team.workers; w++ {
+        team.start[w] <- phase
+    }
+    team.runPhase(0, phase)
+    team.done.Wait()
+}
+
+// update fills probList with the cumulative rates of all transitions for the
+// current occupation. It is equivalent to calcTransitionList followed by a
+// serial prefix sum.
+func (team *rateTeam) update(probList []float32, distances [][]float32, occupation []bool,
+    site_energies []float32, R float32, I_0 float32, kT float32, nu float32, NSites int,
+    N int, transitions_constant [][]float32) {
+    team.probList = probList
+    team.distances = distances
+    team.occupation = occupation
+    team.site_energies = site_energies
+    team.transitions_constant = transitions_constant
+    team.R, team.I_0, team.kT, team.nu = R, I_0, kT, nu
+    team.NSites, team.N = NSites, N
+
+    team.runAll(1)
+    offset := float32(0)
+    for w := 0; w < team.workers; w++ {
+        team.offsets[w] = offset
+        offset += team.blockSums[w]
+    }
+    team.runAll(2)
+}
+
+func (team *rateTeam) stop() {
+    for w := 1; w < team.workers; w++ {
+        close(team.start[w])
+    }
+}
 
 func simulate(NSites int, NElectrodes int, nu float32, kT float32, I_0 float32, R float32,
         occupation []bool, distances [][]float32, E_constant []float32, transitions_constant [][]float32,
         electrode_occupation []float64, site_energies []float32, hops int, record_problist bool, record bool, 
-        traffic []float64, average_occupation []float64, transition_cut_constant float32) float64 {
+        traffic []float64, average_occupation []float64, transition_cut_constant float32, workers int,
+        rng *rand.Rand, stats *simulationStats, table *reuseTable) float64 {
     N := NSites + NElectrodes
     transitions := make([]transition, 0, N*N)
     largest_tc := float32(0)
@@ -216,11 +378,25 @@ func simulate(NSites int, NElectrodes int, nu float32, kT float32, I_0 float32,
     if transition_cut_constant > 0 {
         //fmt.Printf("Transition list size: %d", len(transitions))
     }
+
+    // workers == 1 keeps the original serial path.
+    var team *rateTeam
+    if workers != 1 {
+        team = newRateTeam(workers, transitions)
+    }
+    if team != nil {
+        defer team.stop()
+    }
     
 
     //occupation_time := make([]float64, NSites)
-    allProbs := make(map[uint64]*probabilities)
-    countProbs := make(map[uint64]uint16)
+    // The reuse cache only lives for this call, unless a persistent table
+    // is passed in (see reuseCache.go).
+    if table == nil {
+        table = newReuseTable(nil)
+    }
+    allProbs := table.allProbs
+    keys := newStateKeys(NSites)
 
     //fmt.Printf("Site energies at start: %v\n", site_energies)
     for i := 0; i < NSites; i++ {
@@ -239,70 +415,45 @@ func simulate(NSites int, NElectrodes int, nu float32, kT float32, I_0 float32,
     time := float64(0)
 
     countReuses := uint64(0)
-    countStorage := uint64(0)
-    reuseThreshold := uint16(1)
-    reuseThresholdIncrease := uint64(100000)
-    countResighting := uint64(0)
-    reuses := make([]uint64, 30)
-	states := make([]int, 30)
-    showStep := 10
-    showIndex := 0
     for hop := 0; hop < hops; hop++ {
         var probList []float32
         ok := false
-        var key64 uint64
+        var packed []byte
         if record_problist {
             var val *probabilities
-            key64 = getKey(occupation)
-            val, ok = allProbs[key64]
+            packed = keys.pack(occupation)
+            val, ok = allProbs[string(packed)]
             if ok {
                 probList = val.probList
                 countReuses++
-                countResighting++
             }
         }
         if !ok {
-            calcTransitionList(transitions, distances, occupation, site_energies, R, I_0, kT, nu, NSites, N, transitions_constant)
-    
             probList = make([]float32, len(transitions))
+            if team != nil {
+                team.update(probList, distances, occupation, site_energies, R, I_0, kT, nu, NSites, N, transitions_constant)
+            } else {
+                calcTransitionList(transitions, distances, occupation, site_energies, R, I_0, kT, nu, NSites, N, transitions_constant)
 
-
-            for i,trans := range transitions {
-                if i == 0 {
-                    probList[0] = trans.rate
-                } else {
-                    probList[i] = probList[i-1] + trans.rate
+                for i,trans := range transitions {
+                    if i == 0 {
+                        probList[0] = trans.rate
+                    } else {
+                        probList[i] = probList[i-1] + trans.rate
+                    }
                 }
             }
 
             if record_problist {
-                val, ok := countProbs[key64]
-                if ok {
-                    countResighting++
-                    countProbs[key64]++
-                    if val >= reuseThreshold {
-                        newProbability := probabilities{probList}
-                        allProbs[key64] = &newProbability
-                        countStorage++
-                        if countStorage > reuseThresholdIncrease {
-                            reuseThreshold++
-                            reuseThresholdIncrease+=100000
-                        }
-                    }
-                } else {
-                    countProbs[key64] = 1
+                val, ok := table.count(packed)
+                if ok && val >= table.reuseThreshold {
+                    table.store(packed, probList)
                 }
             }
         }
-        time_step := rand.ExpFloat64() / float64(probList[len(probList)-1])
+        time_step := rng.ExpFloat64() / float64(probList[len(probList)-1])
         time += time_step
-        event := getRandomEvent(probList)
-        if hop % showStep == showStep - 1{
-            showStep*=10
-            reuses[showIndex] = countResighting
-            states[showIndex] = len(countProbs)
-            showIndex+=1
-        }
+        event := getRandomEvent(rng, probList)
         from := transitions[event].from
         to := transitions[event].to
 
@@ -319,7 +470,10 @@ func simulate(NSites int, NElectrodes int, nu float32, kT float32, I_0 float32,
             NSites, from, to)
     }
 
-    logReuseToJson(reuses, states, "reusing.log")
+    if stats != nil {
+        stats.cacheHits += countReuses
+        stats.rateRecomputations += uint64(hops) - countReuses
+    }
 
     return time
 }
@@ -359,6 +513,7 @@ func simulateRecordPlus(NSites int, NElectrodes int, nu float32, kT float32, I_0
 
     countReuses := uint64(0)
     countStorage := uint64(0)
+    rng, _ := newRandom()
     for hop := 0; hop < hops; hop++ {
 
         var probList []float32
@@ -411,9 +566,9 @@ func simulateRecordPlus(NSites int, NElectrodes int, nu float32, kT float32, I_0
                 }
             }
         }
-        time_step := rand.ExpFloat64() / float64(probList[len(probList)-1])
+        time_step := rng.ExpFloat64() / float64(probList[len(probList)-1])
         time += time_step
-        event := getRandomEvent(probList)
+        event := getRandomEvent(rng, probList)
 
         from := transitions[event].from
         to := transitions[event].to
@@ -431,168 +586,11 @@ func simulateRecordPlus(NSites int, NElectrodes int, nu float32, kT float32, I_0
     return time
 }
 
-func simulateReturnStatecount(NSites int, NElectrodes int, nu float32, kT float32, I_0 float32, R float32,
-    occupation []bool, distances [][]float32, E_constant []float32, transitions_constant [][]float32,
-    electrode_occupation []float64, site_energies []float32, hops int, record_problist bool, record bool, 
-    traffic []float64, average_occupation []float64, transition_cut_constant float32) map[uint64]uint32 {
-    N := NSites + NElectrodes
-    transitions := make([]transition, 0, N*N)
-    largest_tc := float32(0)
-    for i := 0; i < len(transitions_constant); i++ {
-        for j := 0; j < len(transitions_constant[i]); j++ {
-            if largest_tc < transitions_constant[i][j] {
-                largest_tc = transitions_constant[i][j]
-            }
-        }
-    }
-
-    for i := 0; i < len(transitions_constant); i++ {
-        for j := 0; j < len(transitions_constant[i]); j++ {
-            if transitions_constant[i][j] > (transition_cut_constant*largest_tc) {
-                transitions = append(transitions, transition{i, j, 0})
-            }
-        }
-    }
-    if transition_cut_constant > 0 {
-        //fmt.Printf("Transition list size: %d", len(transitions))
-    }
-
-
-    //occupation_time := make([]float64, NSites)
-    allProbs := make(map[uint64]*probabilities)
-    countProbs := make(map[uint64]uint32)
-
-    //fmt.Printf("Site energies at start: %v\n", site_energies)
-    for i := 0; i < NSites; i++ {
-        acceptor_interaction := float32(0)
-        for j := 0; j < NSites; j++ {
-            if j != i && !occupation[j] {
-                acceptor_interaction+= 1/distances[i][j]
-            }
-        }
-        site_energies[i] = E_constant[i] - I_0*R*acceptor_interaction
-    }
-
-    for i := 0; i < NElectrodes; i++ {
-        electrode_occupation[i] = 0.0
-    }
-    time := float64(0)
-
-    countReuses := uint64(0)
-    countStorage := uint64(0)
-    reuseThreshold := uint32(1)
-    reuseThresholdIncrease := uint64(100000)
-    /*countResighting := uint64(0)
-    reuses := make([]uint64, 30)
-    states := make([]int, 30)
-    showStep := 2
-    showIndex := 0*/
-    for hop := 0; hop < hops; hop++ {
-        var probList []float32
-        ok := false
-        var key64 uint64
-        if record_problist {
-            var val *probabilities
-            key64 = getKey(occupation)
-            val, ok = allProbs[key64]
-            if ok {
-                probList = val.probList
-                countReuses++
-                countProbs[key64]++
-                //countResighting++
-            }
-        }
-        if !ok {
-            calcTransitionList(transitions, distances, occupation, site_energies, R, I_0, kT, nu, NSites, N, transitions_constant)
-
-            probList = make([]float32, len(transitions))
-
-
-            for i,trans := range transitions {
-                if i == 0 {
-                    probList[0] = trans.rate
-                } else {
-                    probList[i] = probList[i-1] + trans.rate
-                }
-            }
-
-            if record_problist {
-                val, ok := countProbs[key64]
-                if ok {
-                    //countResighting++
-                    countProbs[key64]++
-                    if val >= reuseThreshold {
-                        newProbability := probabilities{probList}
-                        allProbs[key64] = &newProbability
-                        countStorage++
-                        if countStorage > reuseThresholdIncrease {
-                            reuseThreshold++
-                            reuseThresholdIncrease+=100000
-                        }
-                    }
-                } else {
-                    countProbs[key64] = 1
-                }
-            }
-        }
-        time_step := rand.ExpFloat64() / float64(probList[len(probList)-1])
-        time += time_step
-        eventRand := rand.Float32() * probList[len(probList)-1]
-        event := 0
-        e_step := int(len(probList)/2)
-        i := e_step
-        for true {
-            if e_step >= 2 {
-                e_step = e_step/2
-            }
-            if probList[i] < eventRand {
-                i+=e_step
-                if i >= len(probList) {
-                    i = len(probList) - 1
-                }
-            } else if (i>0 && probList[i-1] >= eventRand) {
-                i-=e_step
-                if i < 0 {
-                    i = 0
-                }
-            } else {
-                event = i
-                break
-            }
-        }
-        /*if hop % showStep == showStep - 1{
-            showStep*=2
-            reuses[showIndex] = countResighting
-            states[showIndex] = len(countProbs)
-            showIndex+=1
-        }*/
-        from := transitions[event].from
-        to := transitions[event].to
-
-        if record {
-            traffic[from*N+to]+=1
-            traffic[to*N+from]-=1
-            for i := 0; i < NSites; i++ {
-                if occupation[i] {
-                    average_occupation[i]+=time_step
-                }
-            }
-        }
-
-        makeJump(occupation, electrode_occupation, site_energies, distances, R, I_0, 
-            NSites, from, to)
-
-    }
-
-    //logReuseToJson(reuses, states, "reusing.log")
-
-    return countProbs
-}
-
 func simulateCombined(NSites int, NElectrodes int, nu float32, kT float32, I_0 float32, R float32,
     occupation []bool, distances [][]float32, E_constant []float32, transitions_constant [][]float32,
     electrode_occupation []float64, site_energies []float32, hops int, traffic []float64, average_occupation []float64) float64 {
     N := NSites + NElectrodes
+    rng, _ := newRandom()
     transitions := make([][]float32, N)
     //occupation_time := make([]float64, NSites)
 
@@ -631,9 +629,9 @@ func simulateCombined(NSites int, NElectrodes int, nu float32, kT float32, I_0 f
                 }
             }
         }
-        time_step := rand.ExpFloat64() / float64(probList[len(probList)-1])
+        time_step := rng.ExpFloat64() / float64(probList[len(probList)-1])
         time += time_step
-        eventRand := rand.Float32() * probList[len(probList)-1]
+        eventRand := rng.Float32() * probList[len(probList)-1]
         event := 0
         for i := 0; i < len(probList); i++ {
             if probList[i] >= eventRand {
@@ -10,6 +10,14 @@ import (
     "encoding/json"
 )
 
+/*
+All exported functions are safe to call from several threads at the same
+time, ctypes releases the GIL during the call. Every call works on its own
+copies of the arrays, its own random generator (newRandom or the resumed
+state) and its own caches. The only package-level state is the Log counter
+below and the profiler, both are guarded by a mutex. Slices that are passed
+in must not be shared between calls that run at the same time.
+*/
 var count int
 var mtx sync.Mutex
 
@@ -80,17 +88,59 @@ func printAverageExpRandom(){
 	logListToJson(list_f, "Ln1Rand.log")
 }
 
+/*
+The simulate based wrappers take a trailing state slice of length 3 that
+makes simulations resumable: the two 32-bit halves of the resumableSource
+state and a flag. If the flag is 1 the simulation continues from the given
+random state and occupation, otherwise it starts a fresh random stream from
+an empty system like before. On return the slice holds the random state to
+continue from and occupation holds the final occupation. The returned time
+and electrode_occupation only cover the hops of this call.
+*/
+func resumeFromState(state []float64, occupation []float64, NSites int64) (*rand.Rand, *resumableSource, []bool) {
+	bool_occupation := make([]bool, NSites)
+	if len(state) < 3 || state[2] != 1 {
+		rng, source := newRandom()
+		return rng, source, bool_occupation
+	}
+	for i := int64(0); i < NSites; i++ {
+		bool_occupation[i] = occupation[i] > 0
+	}
+	source := &resumableSource{uint64(state[0])<<32 | uint64(state[1])}
+	return rand.New(source), source, bool_occupation
+}
+
+func storeState(state []float64, source *resumableSource, occupation []float64, bool_occupation []bool) {
+	if len(state) >= 3 {
+		state[0] = float64(source.state >> 32)
+		state[1] = float64(source.state & 0xFFFFFFFF)
+		state[2] = 1
+	}
+	for i := 0; i < len(bool_occupation); i++ {
+		if bool_occupation[i] {
+			occupation[i] = 1.0
+		} else {
+			occupation[i] = 0.0
+		}
+	}
+}
+
 //export wrapperSimulate
 func wrapperSimulate(NSites int64, NElectrodes int64, nu float64, kT float64, I_0 float64, R float64,
 		occupation []float64, distances []float64, E_constant []float64, transitions_constant []float64,
-		electrode_occupation []float64, site_energies []float64, hops int, record bool, traffic []float64, average_occupation []float64) float64 {
+		electrode_occupation []float64, site_energies []float64, hops int, record bool, traffic []float64, average_occupation []float64,
+		state []float64, stats []float64) float64 {
 	//Log(fmt.Sprintf("%d %d", NSites, NElectrodes))
 	newDistances := deFlattenFloatTo32(distances, NSites+NElectrodes, NSites+NElectrodes)
 	newConstants := deFlattenFloatTo32(transitions_constant, NSites+NElectrodes, NSites+NElectrodes)
-	bool_occupation := make([]bool, NSites)
+	simStats := startStats()
+	rng, source, bool_occupation := resumeFromState(state, occupation, NSites)
 	//printAverageExpRandom();
 	time := simulate(int(NSites), int(NElectrodes), float32(nu), float32(kT), float32(I_0), float32(R), bool_occupation, 
-		newDistances , toFloat32(E_constant), newConstants, electrode_occupation, toFloat32(site_energies), hops, false, record, traffic, average_occupation, 0)
+		newDistances , toFloat32(E_constant), newConstants, electrode_occupation, toFloat32(site_energies), hops, false, record, traffic, average_occupation, 0, 1,
+		rng, simStats, nil)
+	storeState(state, source, occupation, bool_occupation)
+	simStats.store(stats, hops)
 
 	return time
 }
@@ -99,12 +149,183 @@ func wrapperSimulate(NSites int64, NElectrodes int64, nu float64, kT float64, I_
 func wrapperSimulatePruned(NSites int64, NElectrodes int64, prune_threshold float64, nu float64, kT float64, I_0 float64, R float64,
 	occupation []float64, distances []float64, E_constant []float64, transitions_constant []float64,
 	electrode_occupation []float64, site_energies []float64, hops int, record bool, traffic []float64, 
-	average_occupation []float64) float64 {
+	average_occupation []float64, state []float64, stats []float64) float64 {
 	newDistances := deFlattenFloatTo32(distances, NSites+NElectrodes, NSites+NElectrodes)
 	newConstants := deFlattenFloatTo32(transitions_constant, NSites+NElectrodes, NSites+NElectrodes)
+	simStats := startStats()
+	rng, source, bool_occupation := resumeFromState(state, occupation, NSites)
+	time := simulate(int(NSites), int(NElectrodes), float32(nu), float32(kT), float32(I_0), float32(R), bool_occupation, 
+		newDistances , toFloat32(E_constant), newConstants, electrode_occupation, toFloat32(site_energies), hops, false, record, traffic, average_occupation, float32(prune_threshold), 1,
+		rng, simStats, nil)
+	storeState(state, source, occupation, bool_occupation)
+	simStats.store(stats, hops)
+
+	return time
+}
+
+/*
+wrapperSimulateConductance is meant for zero bias. It simulates hops in
+len(block_time) consecutive blocks of equal hop count, continuing the
+occupation and random stream from block to block. For every block b the
+charge that entered electrode p is stored in block_charge[b*NElectrodes+p]
+and its duration in block_time[b]. The fluctuations of these charges give
+the linear conductance matrix, see kmc_dn.conductance_matrix.
+Returns the total simulated time, electrode_occupation holds the charges of
+the last block.
+*/
+//export wrapperSimulateConductance
+func wrapperSimulateConductance(NSites int64, NElectrodes int64, nu float64, kT float64, I_0 float64, R float64,
+	occupation []float64, distances []float64, E_constant []float64, transitions_constant []float64,
+	electrode_occupation []float64, site_energies []float64, hops int, record bool, traffic []float64,
+	average_occupation []float64, block_charge []float64, block_time []float64, stats []float64) float64 {
+	simStats := startStats()
+	newDistances := deFlattenFloatTo32(distances, NSites+NElectrodes, NSites+NElectrodes)
+	newConstants := deFlattenFloatTo32(transitions_constant, NSites+NElectrodes, NSites+NElectrodes)
+	newE_constant := toFloat32(E_constant)
+	newSite_energies := toFloat32(site_energies)
 	bool_occupation := make([]bool, NSites)
+	rng, _ := newRandom()
+	// The blocks share their reuse cache
+	table := newReuseTable(nil)
+
+	blocks := len(block_time)
+	time := 0.0
+	for b := 0; b < blocks; b++ {
+		blockHops := hops/blocks
+		if b < hops%blocks {
+			blockHops++
+		}
+		block_time[b] = simulate(int(NSites), int(NElectrodes), float32(nu), float32(kT), float32(I_0), float32(R), bool_occupation,
+			newDistances , newE_constant, newConstants, electrode_occupation, newSite_energies, blockHops, true, record, traffic,
+			average_occupation, 0, 1, rng, simStats, table)
+		time += block_time[b]
+		for p := int64(0); p < NElectrodes; p++ {
+			block_charge[int64(b)*NElectrodes+p] = electrode_occupation[p]
+		}
+	}
+	for i := int64(0); i < NSites; i++ {
+		if bool_occupation[i] {
+			occupation[i] = 1.0
+		} else {
+			occupation[i] = 0.0
+		}
+	}
+	simStats.store(stats, hops)
+
+	return time
+}
+
+/*
+wrapperSimulateSensitivity simulates hops in len(block_time) blocks and
+stores per block the electrode charges, the duration and the likelihood
+ratio scores to every electrode voltage, see sensitivitySimulate.
+gradient is the flattened (NSites+NElectrodes) x NElectrodes matrix
+dE_i/dV_k. record is not supported, traffic and average_occupation are
+left untouched. Like the resumable wrappers it continues from occupation
+and state if state[2] is 1 and stores the state to continue from.
+*/
+//export wrapperSimulateSensitivity
+func wrapperSimulateSensitivity(NSites int64, NElectrodes int64, nu float64, kT float64, I_0 float64, R float64,
+	occupation []float64, distances []float64, E_constant []float64, transitions_constant []float64,
+	electrode_occupation []float64, site_energies []float64, hops int, record bool, traffic []float64,
+	average_occupation []float64, gradient []float64, block_charge []float64, block_time []float64,
+	block_score []float64, state []float64, stats []float64) float64 {
+	simStats := startStats()
+	newDistances := deFlattenFloatTo32(distances, NSites+NElectrodes, NSites+NElectrodes)
+	newConstants := deFlattenFloatTo32(transitions_constant, NSites+NElectrodes, NSites+NElectrodes)
+	rng, source, bool_occupation := resumeFromState(state, occupation, NSites)
+	time := sensitivitySimulate(int(NSites), int(NElectrodes), float32(nu), float32(kT), float32(I_0), float32(R), bool_occupation,
+		newDistances , toFloat32(E_constant), newConstants, electrode_occupation, toFloat32(site_energies), hops, gradient,
+		block_charge, block_time, block_score, rng, simStats)
+	storeState(state, source, occupation, bool_occupation)
+	simStats.store(stats, hops)
+
+	return time
+}
+
+/*
+wrapperSimulateControlVariate simulates hops in len(block_time) blocks and
+stores per block the counted and the expected electrode charges and the
+duration and its expectation, see controlVariateSimulate. record is not
+supported, traffic and average_occupation are left untouched. Like the
+resumable wrappers it continues from occupation and state if state[2] is 1
+and stores the state to continue from.
+*/
+//export wrapperSimulateControlVariate
+func wrapperSimulateControlVariate(NSites int64, NElectrodes int64, nu float64, kT float64, I_0 float64, R float64,
+	occupation []float64, distances []float64, E_constant []float64, transitions_constant []float64,
+	electrode_occupation []float64, site_energies []float64, hops int, record bool, traffic []float64,
+	average_occupation []float64, block_charge []float64, block_expected []float64, block_time []float64,
+	block_expected_time []float64, state []float64, stats []float64) float64 {
+	simStats := startStats()
+	newDistances := deFlattenFloatTo32(distances, NSites+NElectrodes, NSites+NElectrodes)
+	newConstants := deFlattenFloatTo32(transitions_constant, NSites+NElectrodes, NSites+NElectrodes)
+	rng, source, bool_occupation := resumeFromState(state, occupation, NSites)
+	time := controlVariateSimulate(int(NSites), int(NElectrodes), float32(nu), float32(kT), float32(I_0), float32(R), bool_occupation,
+		newDistances , toFloat32(E_constant), newConstants, electrode_occupation, toFloat32(site_energies), hops,
+		block_charge, block_expected, block_time, block_expected_time, rng, simStats)
+	storeState(state, source, occupation, bool_occupation)
+	simStats.store(stats, hops)
+
+	return time
+}
+
+/*
+wrapperSimulateCached is wrapperSimulateRecord with the persistent reuse
+cache of cache_handle (see newReuseCache). The states stored by earlier
+calls with exactly the same configuration are reused, so repeated
+simulations of a configuration start with a hot cache. An unknown handle
+falls back to a cache for this call only.
+*/
+//export wrapperSimulateCached
+func wrapperSimulateCached(NSites int64, NElectrodes int64, cache_handle int64, nu float64, kT float64, I_0 float64, R float64,
+	occupation []float64, distances []float64, E_constant []float64, transitions_constant []float64,
+	electrode_occupation []float64, site_energies []float64, hops int, record bool, traffic []float64, average_occupation []float64,
+	state []float64, stats []float64) float64 {
+	newDistances := deFlattenFloatTo32(distances, NSites+NElectrodes, NSites+NElectrodes)
+	newConstants := deFlattenFloatTo32(transitions_constant, NSites+NElectrodes, NSites+NElectrodes)
+	newE_constant := toFloat32(E_constant)
+	newSite_energies := toFloat32(site_energies)
+	simStats := startStats()
+	var table *reuseTable
+	if cache := getReuseCache(cache_handle); cache != nil {
+		fingerprint := configurationFingerprint(newE_constant, newSite_energies[NSites:], flatten32(newDistances),
+			flatten32(newConstants), []float32{float32(nu), float32(kT), float32(I_0), float32(R)})
+		table = cache.acquire(fingerprint)
+		defer cache.release(table)
+	}
+	rng, source, bool_occupation := resumeFromState(state, occupation, NSites)
 	time := simulate(int(NSites), int(NElectrodes), float32(nu), float32(kT), float32(I_0), float32(R), bool_occupation, 
-		newDistances , toFloat32(E_constant), newConstants, electrode_occupation, toFloat32(site_energies), hops, false, record, traffic, average_occupation, float32(prune_threshold))
+		newDistances , newE_constant, newConstants, electrode_occupation, newSite_energies, hops, true, record, traffic, average_occupation,
+		0, 1, rng, simStats, table)
+	storeState(state, source, occupation, bool_occupation)
+	simStats.store(stats, hops)
+
+	return time
+}
+
+/*
+wrapperSimulateTrajectory records the residence times and transitions of a
+trajectory per block, see trajectorySimulate. record is not supported,
+traffic and average_occupation are left untouched. Like the resumable
+wrappers it continues from occupation and state if state[2] is 1 and
+stores the state to continue from.
+*/
+//export wrapperSimulateTrajectory
+func wrapperSimulateTrajectory(NSites int64, NElectrodes int64, nu float64, kT float64, I_0 float64, R float64,
+	occupation []float64, distances []float64, E_constant []float64, transitions_constant []float64,
+	electrode_occupation []float64, site_energies []float64, hops int, record bool, traffic []float64,
+	average_occupation []float64, block_time []float64, residence_keys []uint64, residence_values []float64,
+	jump_keys []uint64, jump_values []float64, sizes []float64, state []float64, stats []float64) float64 {
+	simStats := startStats()
+	newDistances := deFlattenFloatTo32(distances, NSites+NElectrodes, NSites+NElectrodes)
+	newConstants := deFlattenFloatTo32(transitions_constant, NSites+NElectrodes, NSites+NElectrodes)
+	rng, source, bool_occupation := resumeFromState(state, occupation, NSites)
+	time := trajectorySimulate(int(NSites), int(NElectrodes), float32(nu), float32(kT), float32(I_0), float32(R), bool_occupation,
+		newDistances , toFloat32(E_constant), newConstants, electrode_occupation, toFloat32(site_energies), hops, block_time,
+		residence_keys, residence_values, jump_keys, jump_values, sizes, rng, simStats)
+	storeState(state, source, occupation, bool_occupation)
+	simStats.store(stats, hops)
 
 	return time
 }
@@ -127,25 +348,42 @@ return time
 //export wrapperSimulateRecord
 func wrapperSimulateRecord(NSites int64, NElectrodes int64, nu float64, kT float64, I_0 float64, R float64, 
 	occupation []float64, distances []float64, E_constant []float64, transitions_constant []float64,
-	electrode_occupation []float64, site_energies []float64, hops int, record bool, traffic []float64, average_occupation []float64) float64 {
+	electrode_occupation []float64, site_energies []float64, hops int, record bool, traffic []float64, average_occupation []float64,
+	state []float64, stats []float64) float64 {
 	newDistances := deFlattenFloatTo32(distances, NSites+NElectrodes, NSites+NElectrodes)
 	newConstants := deFlattenFloatTo32(transitions_constant, NSites+NElectrodes, NSites+NElectrodes)
 
-	bool_occupation := make([]bool, NSites)
-	for i := int64(0); i < NSites; i++{
-		if false {//occupation[i] > 0{
-			bool_occupation[i] = true
-		} else {
-			bool_occupation[i] = false
-		}
-	}
+	simStats := startStats()
+	rng, source, bool_occupation := resumeFromState(state, occupation, NSites)
 	time := simulate(int(NSites), int(NElectrodes), float32(nu), float32(kT), float32(I_0), float32(R), bool_occupation, 
 	newDistances , toFloat32(E_constant), newConstants, electrode_occupation, toFloat32(site_energies), hops, true, record, traffic, average_occupation,
-	0)
+	0, 1, rng, simStats, nil)
+	storeState(state, source, occupation, bool_occupation)
+	simStats.store(stats, hops)
 
 return time
 }
 
+//export wrapperSimulateParallel
+func wrapperSimulateParallel(NSites int64, NElectrodes int64, workers int64, nu float64, kT float64, I_0 float64, R float64,
+	occupation []float64, distances []float64, E_constant []float64, transitions_constant []float64,
+	electrode_occupation []float64, site_energies []float64, hops int, record bool, traffic []float64,
+	average_occupation []float64, state []float64, stats []float64) float64 {
+	// Same as wrapperSimulateRecord, but rates are recalculated by a team of
+	// workers goroutines (workers <= 0 picks one per core, at most 8).
+	newDistances := deFlattenFloatTo32(distances, NSites+NElectrodes, NSites+NElectrodes)
+	newConstants := deFlattenFloatTo32(transitions_constant, NSites+NElectrodes, NSites+NElectrodes)
+	simStats := startStats()
+	rng, source, bool_occupation := resumeFromState(state, occupation, NSites)
+	time := simulate(int(NSites), int(NElectrodes), float32(nu), float32(kT), float32(I_0), float32(R), bool_occupation, 
+		newDistances , toFloat32(E_constant), newConstants, electrode_occupation, toFloat32(site_energies), hops, true, record, traffic, average_occupation,
+		0, int(workers), rng, simStats, nil)
+	storeState(state, source, occupation, bool_occupation)
+	simStats.store(stats, hops)
+
+	return time
+}
+
 //export wrapperSimulateRecordPlus
 func wrapperSimulateRecordPlus(NSites int64, NElectrodes int64, nu float64, kT float64, I_0 float64, R float64, 
 	occupation []float64, distances []float64, E_constant []float64, transitions_constant []float64,
@@ -168,51 +406,46 @@ func wrapperSimulateRecordPlus(NSites int64, NElectrodes int64, nu float64, kT f
 return time
 }
 
-//export analyzeStateOverlap
-func analyzeStateOverlap(NSites int64, NElectrodes int64, nu float64, kT float64, I_0 float64, R float64, 
+/*
+wrapperSimulateStateHistogram simulates hops and exports the visited states:
+the k = len(counts) most visited states, sorted by visit count, with their
+packed occupation in keys[w*k:...] (see packOccupation, w =
+ceil(NSites/64) words per state), their visit count in counts and the
+total time spent in them in residence. At most max_states states are
+tracked during the simulation. sizes is set to [tracked states, visits of
+untracked states, time in untracked states]. record is not supported,
+traffic and average_occupation are left untouched. Like the resumable
+wrappers it continues from occupation and state if state[2] is 1 and
+stores the state to continue from.
+*/
+//export wrapperSimulateStateHistogram
+func wrapperSimulateStateHistogram(NSites int64, NElectrodes int64, max_states int64, nu float64, kT float64, I_0 float64, R float64,
 	occupation []float64, distances []float64, E_constant []float64, transitions_constant []float64,
-	electrode_occupation []float64, site_energies []float64, hops int, record bool, traffic []float64, average_occupation []float64) float64 {
+	electrode_occupation []float64, site_energies []float64, hops int, record bool, traffic []float64,
+	average_occupation []float64, keys []uint64, counts []float64, residence []float64, sizes []float64,
+	state []float64, stats []float64) float64 {
+	simStats := startStats()
 	newDistances := deFlattenFloatTo32(distances, NSites+NElectrodes, NSites+NElectrodes)
 	newConstants := deFlattenFloatTo32(transitions_constant, NSites+NElectrodes, NSites+NElectrodes)
-	bool_occupation := make([]bool, NSites)
-	for i := int64(0); i < NSites; i++{
-		if occupation[i] > 0{
-			bool_occupation[i] = true
-		} else {
-			bool_occupation[i] = false
-		}
-	}
-	state_count := simulateReturnStatecount(int(NSites), int(NElectrodes), float32(nu), float32(kT), float32(I_0), float32(R), bool_occupation, 
-		newDistances , toFloat32(E_constant), newConstants, electrode_occupation, toFloat32(site_energies), hops, true, record, traffic, average_occupation,
-		0)
-	fmt.Printf("Number of states in original: %d", len(state_count))
-	for j := 0; j < 10; j++ {
-		for i := int64(0); i < NSites; i++{
-			if occupation[i] > 0{
-				bool_occupation[i] = true
-			} else {
-				bool_occupation[i] = false
-			}
+	rng, source, bool_occupation := resumeFromState(state, occupation, NSites)
+	time, histogram := stateHistogramSimulate(int(NSites), int(NElectrodes), float32(nu), float32(kT), float32(I_0), float32(R), bool_occupation,
+		newDistances , toFloat32(E_constant), newConstants, electrode_occupation, toFloat32(site_energies), hops, int(max_states),
+		sizes[1:3], rng, simStats)
+	storeState(state, source, occupation, bool_occupation)
+	simStats.store(stats, hops)
+
+	words := int(NSites + 63)/64
+	for s, visits := range topStates(histogram) {
+		if s >= len(counts) {
+			break
 		}
-		other_state_count := simulateReturnStatecount(int(NSites), int(NElectrodes), float32(nu), float32(kT), float32(I_0), float32(R), bool_occupation, 
-		newDistances , toFloat32(E_constant), newConstants, electrode_occupation, toFloat32(site_energies), hops, true, record, traffic, average_occupation,
-		0)
-		overlap := uint32(0)
-		for key, val :=  range state_count {
-			val2, ok := other_state_count[key]
-			if ok {
-				if val > val2 {
-					overlap += uint32(val2)
-				} else {
-					overlap += uint32(val)
-				}
-			}
-		}
-		fmt.Printf("The number of keys in new try:%d\n%d: The overlap for %d hops was %d\n\n", len(other_state_count), j, hops, overlap)
+		unpackKey(visits.key, keys[s*words:(s+1)*words])
+		counts[s] = float64(visits.count)
+		residence[s] = visits.time
 	}
+	sizes[0] = float64(len(histogram))
 
-
-return 0
+	return time
 }
 
 //export wrapperSimulateProbability
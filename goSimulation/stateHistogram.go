@@ -0,0 +1,146 @@
+package main
+
+import (
+    "math/rand"
+    "sort"
+)
+
+// stateVisits is an entry of the state histogram of stateHistogramSimulate.
+type stateVisits struct {
+    key string
+    count uint64
+    time float64
+    probList []float32
+}
+
+/*
+packOccupation packs occupation into words 64 bit words, site i is bit i%64
+of word i/64. Unlike getKey it is exact for any number of sites. The words
+are returned as a string, so that they can be used as a map key.
+*/
+func packOccupation(occupation []bool, words int, buffer []byte) string {
+    keys := stateKeys{words, buffer[:8*words]}
+    return string(keys.pack(occupation))
+}
+
+/*
+stateHistogramSimulate is simulate that keeps, for every state that is
+visited, how often it was visited and the total time spent in it. At most
+max_states states are tracked, the visits and time of states that are seen
+after that are summed in untracked (visits, time). The rates of a tracked
+state are stored once it is visited for the second time. Returns the total
+time and the tracked states.
+*/
+func stateHistogramSimulate(NSites int, NElectrodes int, nu float32, kT float32, I_0 float32, R float32,
+        occupation []bool, distances [][]float32, E_constant []float32, transitions_constant [][]float32,
+        electrode_occupation []float64, site_energies []float32, hops int, max_states int,
+        untracked []float64, rng *rand.Rand, stats *simulationStats) (float64, map[string]*stateVisits) {
+    N := NSites + NElectrodes
+    transitions := make([]transition, 0, N*N)
+    for i := 0; i < N; i++ {
+        for j := 0; j < N; j++ {
+            if transitions_constant[i][j] > 0 {
+                transitions = append(transitions, transition{i, j, 0})
+            }
+        }
+    }
+
+    for i := 0; i < NSites; i++ {
+        acceptor_interaction := float32(0)
+        for j := 0; j < NSites; j++ {
+            if j != i && !occupation[j] {
+                acceptor_interaction+= 1/distances[i][j]
+            }
+        }
+        site_energies[i] = E_constant[i] - I_0*R*acceptor_interaction
+    }
+    for i := 0; i < NElectrodes; i++ {
+        electrode_occupation[i] = 0.0
+    }
+
+    words := (NSites + 63)/64
+    buffer := make([]byte, 8*words)
+    histogram := make(map[string]*stateVisits)
+    untracked[0] = 0
+    untracked[1] = 0
+    time := float64(0)
+    for hop := 0; hop < hops; hop++ {
+        key := packOccupation(occupation, words, buffer)
+        visits, tracked := histogram[key]
+        if !tracked && len(histogram) < max_states {
+            visits = &stateVisits{key: key}
+            histogram[key] = visits
+            tracked = true
+        }
+
+        var probList []float32
+        if tracked && visits.probList != nil {
+            probList = visits.probList
+            if stats != nil {
+                stats.cacheHits++
+            }
+        } else {
+            calcTransitionList(transitions, distances, occupation, site_energies, R, I_0, kT, nu, NSites, N, transitions_constant)
+            probList = make([]float32, len(transitions))
+            for i, trans := range transitions {
+                if i == 0 {
+                    probList[0] = trans.rate
+                } else {
+                    probList[i] = probList[i-1] + trans.rate
+                }
+            }
+            if tracked && visits.count > 0 {
+                visits.probList = probList
+            }
+            if stats != nil {
+                stats.rateRecomputations++
+            }
+        }
+
+        time_step := rng.ExpFloat64() / float64(probList[len(probList)-1])
+        time += time_step
+        if tracked {
+            visits.count++
+            visits.time += time_step
+        } else {
+            untracked[0]++
+            untracked[1] += time_step
+        }
+        event := getRandomEvent(rng, probList)
+        makeJump(occupation, electrode_occupation, site_energies, distances, R, I_0,
+            NSites, transitions[event].from, transitions[event].to)
+    }
+    return time, histogram
+}
+
+/*
+topStates returns the states of histogram sorted by visit count, then by
+residence time, most visited first.
+*/
+func topStates(histogram map[string]*stateVisits) []*stateVisits {
+    states := make([]*stateVisits, 0, len(histogram))
+    for _, visits := range histogram {
+        states = append(states, visits)
+    }
+    sort.Slice(states, func(a, b int) bool {
+        if states[a].count != states[b].count {
+            return states[a].count > states[b].count
+        }
+        if states[a].time != states[b].time {
+            return states[a].time > states[b].time
+        }
+        return states[a].key < states[b].key
+    })
+    return states
+}
+
+// unpackKey writes the packed key of a state to words little endian 64 bit
+// words.
+func unpackKey(key string, words []uint64) {
+    for w := range words {
+        words[w] = 0
+        for b := 0; b < 8; b++ {
+            words[w] |= uint64(key[8*w+b]) << uint(8*b)
+        }
+    }
+}
@@ -0,0 +1,127 @@
+package main
+
+import "math/rand"
+
+type jumpKey struct {
+    state uint64
+    event int
+}
+
+/*
+trajectorySimulate records the sufficient statistics of a trajectory, from
+which currents at other energies can be estimated by reweighting the path
+(see kmc_dn.reweight). The hops are split in len(block_time) blocks of
+equal length. For every block it writes
+ - per visited state the total time spent in it: residence_keys[r] is the
+   state (getKey) and residence_values[2r:2r+2] is [block, time],
+ - per state and transition the number of times it was taken: jump_keys[j]
+   is the state and jump_values[4j:4j+4] is [block, from, to, count],
+and block_time[b] is the duration of block b. Entries beyond the capacity
+of the slices are dropped. sizes is set to the number of entries that were
+needed, [residences, jumps], so that the caller can detect this.
+*/
+func trajectorySimulate(NSites int, NElectrodes int, nu float32, kT float32, I_0 float32, R float32,
+        occupation []bool, distances [][]float32, E_constant []float32, transitions_constant [][]float32,
+        electrode_occupation []float64, site_energies []float32, hops int, block_time []float64,
+        residence_keys []uint64, residence_values []float64, jump_keys []uint64, jump_values []float64,
+        sizes []float64, rng *rand.Rand, stats *simulationStats) float64 {
+    N := NSites + NElectrodes
+    transitions := make([]transition, 0, N*N)
+    for i := 0; i < N; i++ {
+        for j := 0; j < N; j++ {
+            if transitions_constant[i][j] > 0 {
+                transitions = append(transitions, transition{i, j, 0})
+            }
+        }
+    }
+
+    for i := 0; i < NSites; i++ {
+        acceptor_interaction := float32(0)
+        for j := 0; j < NSites; j++ {
+            if j != i && !occupation[j] {
+                acceptor_interaction+= 1/distances[i][j]
+            }
+        }
+        site_energies[i] = E_constant[i] - I_0*R*acceptor_interaction
+    }
+    for i := 0; i < NElectrodes; i++ {
+        electrode_occupation[i] = 0.0
+    }
+
+    allProbs := make(map[uint64]*probabilities)
+    seen := make(map[uint64]bool)
+    residences := 0
+    jumps := 0
+    blocks := len(block_time)
+    time := float64(0)
+    for b := 0; b < blocks; b++ {
+        blockHops := hops/blocks
+        if b < hops%blocks {
+            blockHops++
+        }
+        residence := make(map[uint64]float64)
+        jumpCount := make(map[jumpKey]int)
+        block_time[b] = 0
+
+        for ; blockHops > 0; blockHops-- {
+            key64 := getKey(occupation)
+            var probList []float32
+            val, ok := allProbs[key64]
+            if ok {
+                probList = val.probList
+                if stats != nil {
+                    stats.cacheHits++
+                }
+            } else {
+                probList = make([]float32, len(transitions))
+                calcTransitionList(transitions, distances, occupation, site_energies, R, I_0, kT, nu, NSites, N, transitions_constant)
+                for i, trans := range transitions {
+                    if i == 0 {
+                        probList[0] = trans.rate
+                    } else {
+                        probList[i] = probList[i-1] + trans.rate
+                    }
+                }
+                if seen[key64] {
+                    allProbs[key64] = &probabilities{probList}
+                } else {
+                    seen[key64] = true
+                }
+                if stats != nil {
+                    stats.rateRecomputations++
+                }
+            }
+
+            time_step := rng.ExpFloat64() / float64(probList[len(probList)-1])
+            block_time[b] += time_step
+            residence[key64] += time_step
+            event := getRandomEvent(rng, probList)
+            jumpCount[jumpKey{key64, event}]++
+            makeJump(occupation, electrode_occupation, site_energies, distances, R, I_0,
+                NSites, transitions[event].from, transitions[event].to)
+        }
+
+        for key, t := range residence {
+            if residences < len(residence_keys) {
+                residence_keys[residences] = key
+                residence_values[2*residences] = float64(b)
+                residence_values[2*residences+1] = t
+            }
+            residences++
+        }
+        for key, count := range jumpCount {
+            if jumps < len(jump_keys) {
+                jump_keys[jumps] = key.state
+                jump_values[4*jumps] = float64(b)
+                jump_values[4*jumps+1] = float64(transitions[key.event].from)
+                jump_values[4*jumps+2] = float64(transitions[key.event].to)
+                jump_values[4*jumps+3] = float64(count)
+            }
+            jumps++
+        }
+        time += block_time[b]
+    }
+    sizes[0] = float64(residences)
+    sizes[1] = float64(jumps)
+    return time
+}
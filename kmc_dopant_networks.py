@@ -22,13 +22,72 @@ TODO list
 import sys
 import os
 sys.path.insert(0,'./goSimulation')
-from goSimulation.pythonBind import callGoSimulation
+from goSimulation.pythonBind import (callGoSimulation, callGoConductance, 
+                                     callGoSensitivity, callGoTrajectory, 
+                                     callGoControlVariate, callGoStateHistogram,
+                                     resumableFunctions, ReuseCache)
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from numba import jit
-import fenics as fn
+from numba import jit, prange, types
+from numba.typed import Dict
+from potential_grid import LaplaceGrid, MultigridLaplaceGrid, GridFunction
+import device_file
 import logging
 import pickle
 
+# fenics is slow to import and often not available, it is only imported
+# when the fenics backend of V is used (see kmc_dn.init_V).
+fn = None
+
+def _import_fenics():
+    global fn
+    if fn is None:
+        import fenics
+        fn = fenics
+    return fn
+
+
+# Process wide cache of the setup of V (mesh or grid, assembled and 
+# factorised operator, boundary values and potential basis) per geometry,
+# see kmc_dn.init_V. The least recently used geometries are dropped.
+FEM_ATTRIBUTES = ['fn_boundary', 'fn_mesh', 'fn_functionspace', 'fn_bc',
+                  'fn_v', 'fn_a', 'fn_f', 'fn_L', 'fn_A', 'fn_solver', 
+                  'fn_lifting']
+GRID_ATTRIBUTES = ['fd_grid', 'fd_lifting']
+FEM_CACHE_SIZE = 16
+_fem_cache = OrderedDict()
+_fem_lock = threading.RLock()
+
+def clear_fem_cache():
+    '''
+    Drops all cached setups of V, e.g. to free their memory.
+    '''
+    with _fem_lock:
+        _fem_cache.clear()
+
+# Thread pool of go_simulation_async and the locks that serialize the
+# simulations of a single kmc_dn.
+_simulation_executor = None
+_simulation_lock = threading.Lock()
+_instance_locks = weakref.WeakKeyDictionary()
+
+def _get_simulation_executor():
+    global _simulation_executor
+    with _simulation_lock:
+        if _simulation_executor is None:
+            _simulation_executor = ThreadPoolExecutor(
+                max_workers=os.cpu_count(), 
+                thread_name_prefix='go_simulation')
+        return _simulation_executor
+
+def _get_instance_lock(kmc):
+    with _simulation_lock:
+        if kmc not in _instance_locks:
+            _instance_locks[kmc] = threading.Lock()
+        return _instance_locks[kmc]
 
 @jit(nopython=True, cache=True)
 def _simulate_discrete_record(N_acceptors, N_electrodes, nu, kT, I_0, R, 
@@ -41,100 +100,64 @@ def _simulate_discrete_record(N_acceptors, N_electrodes, nu, kT, I_0, R,
     instead of this python function. This is left here as reference.
 
     This function performs hops hopping events, meaning:
-    - Calculate site energies; this is done by adding the acceptor-
+    - Calculate site energies once; this is done by adding the acceptor-
         acceptor interaction to the constant energy per site E_constant.
-    - Calculate transition matrix; uses site_energies and
-        transitions_constant and implements the MA rate.
-    - Pick and perform event; uses the transition matrix
-        and repeat this hops times.
+        After every hop they are updated incrementally, in O(N).
+    - Calculate the cumulative rates of all transitions with a positive
+        transitions_constant; uses site_energies and implements the MA 
+        rate. Like in the go engine, the rates of states that were 
+        visited before are reused.
+    - Pick and perform event; the event is found by bisection of the
+        cumulative rates, and repeat this hops times.
+    transitions and problist are not used anymore, they are kept so that
+    the arguments match those of the go functions.
     '''
     # Initialize current and traffic array
     N_sites = N_acceptors+N_electrodes
     traffic = np.zeros(transitions_constant.shape)
     occupations_in_time = np.zeros(len(occupation))
-    time = 0
+    time = 0.
 
-    for _ in range(hops):
-        # Calculate site_energies
-        for i in range(N_acceptors):
-            acceptor_interaction = 0
-            site_energies[i] = E_constant[i]
-            for j in range(N_acceptors):
-                if j is not i:
-                    acceptor_interaction += (1 - occupation[j])/distances[i, j]
-
-            site_energies[i] += -I_0*R*acceptor_interaction
-
-        # Calculate transitions
-        for i in range(N_sites):
-            for j in range(N_sites):
-                if(not _transition_possible(i, j, N_acceptors, occupation)):
-                    transitions[i, j] = 0
-                else:
-                    if(i < N_acceptors and j < N_acceptors):
-                        dE = site_energies[j] - site_energies[i] \
-                             - I_0*R/distances[i, j]
-                    else:
-                        dE = site_energies[j] - site_energies[i]
+    pair_from, pair_to = _transition_pairs(N_acceptors, transitions_constant)
+    _calc_site_energies(N_acceptors, I_0, R, occupation, distances, 
+                        E_constant, site_energies)
+    cache = Dict.empty(key_type=types.int64, value_type=types.float64[:])
 
-                    # Calculate MA rate
-                    if(dE > 0):
-                        transitions[i, j] = nu*np.exp(-dE/kT)
-                    else:
-                        transitions[i, j] = nu
-
-        # Add constant part of transitions
-        transitions = transitions_constant*transitions
-
-        # pick_event
-        # Transform transitions matrix into cumulative sum
-        for i in range(N_sites):
-            for j in range(N_sites):
-                if(i == 0 and j == 0):
-                    problist[0] = transitions[i, j]
-                else:
-                    problist[(N_sites)*i + j] = transitions[i, j] \
-                                                + problist[(N_sites)*i + j-1]
+    for _ in range(int(hops)):
+        key = _occupation_key(occupation) if N_acceptors <= 62 else -1
+        cumulative_rates = _state_rates(cache, key, N_acceptors, nu, kT, I_0,
+                                        R, occupation, distances, 
+                                        site_energies, transitions_constant,
+                                        pair_from, pair_to)
 
         # Calculate hopping time
-        hop_time = np.random.exponential(scale=1/problist[-1])
-
-        # Normalization of probability list
-        problist = problist/problist[-1]
+        hop_time = np.random.exponential(scale=1/cumulative_rates[-1])
 
         # Find transition index of random event
-        event = np.random.rand()
-        for i in range((N_sites)**2):
-            if(problist[i] >= event):
-                event = i
-                break
-
-        # Convert event to acceptor/electrode indices
-        transition = [int(event/(N_sites)), int(event%(N_sites))]
-
-        # Perform hop
-        if(transition[0] < N_acceptors):  # Hop from acceptor
-            occupation[transition[0]] = False
-        else:  # Hop from electrode
-            electrode_occupation[transition[0] - N_acceptors] -= 1
-        if(transition[1] < N_acceptors):  # Hop to acceptor
-            occupation[transition[1]] = True
-        else:  # Hop to electrode
-            electrode_occupation[transition[1] - N_acceptors] += 1
+        event = np.searchsorted(cumulative_rates, 
+                                np.random.rand()*cumulative_rates[-1])
+        if event >= cumulative_rates.shape[0]:
+            event = cumulative_rates.shape[0] - 1
+        i = pair_from[event]
+        j = pair_to[event]
 
         # Update record
         if record: 
-            traffic[transition[0], transition[1]] += 1
-            for i in range(len(occupation)):
-                if occupation[i]:
-                    occupations_in_time[i]+=hop_time
+            traffic[i, j] += 1
+            for k in range(len(occupation)):
+                if occupation[k]:
+                    occupations_in_time[k]+=hop_time
+
+        # Perform hop
+        _perform_hop(N_acceptors, I_0, R, occupation, electrode_occupation, 
+                     distances, site_energies, i, j)
 
         # Increment time
         time += hop_time
 
     return time, occupation, electrode_occupation, traffic, occupations_in_time
 
-@jit
+@jit(nopython=True, cache=True)
 def _transition_possible(i, j, N, occupation):
     '''
     Returns false if:
@@ -162,6 +185,463 @@ def _transition_possible(i, j, N, occupation):
         else:
             return True
 
+@jit(nopython=True, cache=True)
+def _transition_pairs(N_acceptors, transitions_constant):
+    '''
+    Returns the from and to indices of all transitions with a positive 
+    transitions_constant, leaving out electrode -> electrode transitions.
+    '''
+    N_sites = transitions_constant.shape[0]
+    count = 0
+    for i in range(N_sites):
+        for j in range(N_sites):
+            if (transitions_constant[i, j] > 0 
+                    and (i < N_acceptors or j < N_acceptors)):
+                count += 1
+    pair_from = np.empty(count, dtype=np.int64)
+    pair_to = np.empty(count, dtype=np.int64)
+    count = 0
+    for i in range(N_sites):
+        for j in range(N_sites):
+            if (transitions_constant[i, j] > 0 
+                    and (i < N_acceptors or j < N_acceptors)):
+                pair_from[count] = i
+                pair_to[count] = j
+                count += 1
+    return pair_from, pair_to
+
+@jit(nopython=True, cache=True)
+def _calc_site_energies(N_acceptors, I_0, R, occupation, distances, 
+                        E_constant, site_energies):
+    '''
+    Sets the acceptor part of site_energies to E_constant plus the 
+    acceptor-acceptor interaction of the given occupation.
+    '''
+    for i in range(N_acceptors):
+        acceptor_interaction = 0.
+        for j in range(N_acceptors):
+            if j != i and not occupation[j]:
+                acceptor_interaction += 1/distances[i, j]
+        site_energies[i] = E_constant[i] - I_0*R*acceptor_interaction
+
+@jit(nopython=True, cache=True)
+def _perform_hop(N_acceptors, I_0, R, occupation, electrode_occupation, 
+                 distances, site_energies, i, j):
+    '''
+    Moves a carrier from site i to site j and updates the site energies of 
+    all acceptors incrementally, in O(N) instead of O(N^2).
+    '''
+    if i < N_acceptors:
+        occupation[i] = False
+        for k in range(N_acceptors):
+            if k != i:
+                site_energies[k] -= I_0*R/distances[k, i]
+    else:
+        electrode_occupation[i - N_acceptors] -= 1
+    if j < N_acceptors:
+        occupation[j] = True
+        for k in range(N_acceptors):
+            if k != j:
+                site_energies[k] += I_0*R/distances[k, j]
+    else:
+        electrode_occupation[j - N_acceptors] += 1
+
+@jit(nopython=True, cache=True)
+def _calc_cumulative_rates(N_acceptors, nu, kT, I_0, R, occupation, 
+                           distances, site_energies, transitions_constant, 
+                           pair_from, pair_to, cumulative_rates):
+    '''
+    Fills cumulative_rates with the cumulative MA rates of the transitions
+    in pair_from/pair_to, only possible transitions get a positive rate.
+    '''
+    total = 0.
+    for k in range(pair_from.shape[0]):
+        i = pair_from[k]
+        j = pair_to[k]
+        if _transition_possible(i, j, N_acceptors, occupation):
+            if i < N_acceptors and j < N_acceptors:
+                dE = site_energies[j] - site_energies[i] - I_0*R/distances[i, j]
+            else:
+                dE = site_energies[j] - site_energies[i]
+            if dE > 0:
+                total += nu*np.exp(-dE/kT)*transitions_constant[i, j]
+            else:
+                total += nu*transitions_constant[i, j]
+        cumulative_rates[k] = total
+
+# Like the go engine, the cumulative rates of states that were visited 
+# before are reused. They are kept for at most this many floats in total.
+_MAX_CACHED_RATES = 2**22
+
+@jit(nopython=True, cache=True)
+def _occupation_key(occupation):
+    '''
+    Returns the occupation as an integer, bit i is the occupation of 
+    acceptor i. Only valid for at most 62 acceptors.
+    '''
+    key = 0
+    for i in range(occupation.shape[0]):
+        if occupation[i]:
+            key |= 1 << i
+    return key
+
+@jit(nopython=True, cache=True)
+def _state_rates(cache, key, N_acceptors, nu, kT, I_0, R, occupation, 
+                 distances, site_energies, transitions_constant, pair_from, 
+                 pair_to):
+    '''
+    Returns the cumulative rates of the present state, from cache if the 
+    state was visited before. key < 0 disables the cache.
+    '''
+    if key >= 0 and key in cache:
+        return cache[key]
+    cumulative_rates = np.empty(pair_from.shape[0])
+    _calc_cumulative_rates(N_acceptors, nu, kT, I_0, R, occupation, 
+                           distances, site_energies, transitions_constant,
+                           pair_from, pair_to, cumulative_rates)
+    if key >= 0 and (len(cache) + 1)*pair_from.shape[0] <= _MAX_CACHED_RATES:
+        cache[key] = cumulative_rates
+    return cumulative_rates
+
+@jit(nopython=True, cache=True)
+def _simulate_replica(N_acceptors, nu, kT, I_0, R, occupation, distances, 
+                      E_constant, site_energies, transitions_constant, 
+                      pair_from, pair_to, electrode_occupation, 
+                      occupation_time, hops, record):
+    '''
+    Performs hops hops of a single replica, see _simulate_replicas. 
+    site_energies has to hold the electrode energies, the acceptor energies
+    are calculated here. Returns the simulated time.
+    '''
+    _calc_site_energies(N_acceptors, I_0, R, occupation, distances, 
+                        E_constant, site_energies)
+    cache = Dict.empty(key_type=types.int64, value_type=types.float64[:])
+    time = 0.
+    for _ in range(hops):
+        key = _occupation_key(occupation) if N_acceptors <= 62 else -1
+        cumulative_rates = _state_rates(cache, key, N_acceptors, nu, kT, I_0,
+                                        R, occupation, distances, 
+                                        site_energies, transitions_constant,
+                                        pair_from, pair_to)
+        total = cumulative_rates[-1]
+        hop_time = np.random.exponential(1/total)
+
+        # Bisection for the event
+        event = np.searchsorted(cumulative_rates, np.random.rand()*total)
+        if event >= cumulative_rates.shape[0]:
+            event = cumulative_rates.shape[0] - 1
+
+        if record:
+            for i in range(N_acceptors):
+                if occupation[i]:
+                    occupation_time[i] += hop_time
+        _perform_hop(N_acceptors, I_0, R, occupation, electrode_occupation, 
+                     distances, site_energies, pair_from[event], pair_to[event])
+        time += hop_time
+    return time
+
+@jit(nopython=True, parallel=True, cache=True)
+def _simulate_replicas(N_acceptors, N_electrodes, nu, kT, I_0, R, 
+                       occupations, distances, E_constants, 
+                       electrode_energies, transitions_constant, hops, 
+                       record=False):
+    '''
+    Numba engine that simulates many independent replicas at once, e.g.
+    several voltage settings or repetitions of the same system, without the
+    go library. Every row of occupations (replicas x N_acceptors), 
+    E_constants (replicas x N_acceptors) and electrode_energies 
+    (replicas x N_electrodes) is one replica, the replicas are divided over 
+    the cores with prange. Per hop the site energies are updated 
+    incrementally, only the rates of transitions with a positive 
+    transitions_constant are calculated, rates of states that were visited
+    before are reused and the event is found by bisection of the cumulative
+    rates.
+    Returns per replica the time, final occupation, electrode_occupation
+    and (if record) the time every acceptor was occupied.
+    '''
+    replicas = occupations.shape[0]
+    pair_from, pair_to = _transition_pairs(N_acceptors, transitions_constant)
+    times = np.zeros(replicas)
+    electrode_occupations = np.zeros((replicas, N_electrodes))
+    occupation_times = np.zeros((replicas, N_acceptors))
+    for r in prange(replicas):
+        site_energies = np.empty(N_acceptors + N_electrodes)
+        site_energies[N_acceptors:] = electrode_energies[r]
+        times[r] = _simulate_replica(N_acceptors, nu, kT, I_0, R, 
+                                     occupations[r], distances, 
+                                     E_constants[r], site_energies, 
+                                     transitions_constant, pair_from, pair_to,
+                                     electrode_occupations[r], 
+                                     occupation_times[r], hops, record)
+    return times, occupations, electrode_occupations, occupation_times
+
+def _conductance_from_blocks(block_charge, block_time, kT):
+    '''
+    Einstein-Helfand estimate of the linear conductance matrix from the
+    electrode charges of consecutive blocks of a zero bias simulation,
+        G_pq = -Cov(Q_p, Q_q) / (2 kT T),
+    where the covariance is taken over blocks with the mean current
+    removed. The errors are jackknife estimates, leaving out one block
+    at a time.
+    Returns G and its standard error, both N_electrodes x N_electrodes.
+    '''
+    B = block_time.shape[0]
+    Q = block_charge
+    t = block_time
+
+    def estimate(SQQ, SQt, SQ, St, Stt, B):
+        I = SQ/St[..., None]
+        C = (SQQ - I[..., :, None]*SQt[..., None, :] 
+             - SQt[..., :, None]*I[..., None, :]
+             + Stt[..., None, None]*I[..., :, None]*I[..., None, :])
+        return -C*B/(B-1)/(2*kT*St[..., None, None])
+
+    SQQ = Q.T @ Q
+    SQt = Q.T @ t
+    SQ = Q.sum(axis=0)
+    St = np.array(t.sum())
+    Stt = np.array((t**2).sum())
+    G = estimate(SQQ, SQt, SQ, St, Stt, B)
+
+    # Leave one block out
+    G_jack = estimate(SQQ - np.einsum('bp,bq->bpq', Q, Q),
+                      SQt - Q*t[:, None],
+                      SQ - Q,
+                      St - t,
+                      Stt - t**2, B-1)
+    error = np.sqrt((B-1)/B*((G_jack - G_jack.mean(axis=0))**2).sum(axis=0))
+    return G, error
+
+def _coulomb_ground_state(E_constant, inv_r, I_0R):
+    '''
+    Returns the occupation (bool array) of a Coulomb ground state of the
+    acceptors with the electrodes at energy 0. Starting from all
+    acceptors empty, the move that lowers the energy most is
+    made until none does; the moves are those of the KMC (acceptor to
+    electrode, electrode to acceptor and acceptor to acceptor), so the
+    result is stable against every single hop.
+    '''
+    N = len(E_constant)
+    occupation = np.zeros(N, dtype=bool)
+    energies = E_constant - I_0R*inv_r @ ~occupation
+    for _ in range(N*N + N):
+        leave = np.where(occupation, -energies, np.inf)
+        enter = np.where(occupation, np.inf, energies)
+        hop = energies[None, :] - energies[:, None] - I_0R*inv_r
+        hop[~occupation] = np.inf
+        hop[:, occupation] = np.inf
+        moves = [leave.min(initial=np.inf), enter.min(initial=np.inf), 
+                 hop.min(initial=np.inf)]
+        move = int(np.argmin(moves))
+        if moves[move] >= 0:
+            break
+        if move == 0:
+            i = np.argmin(leave)
+            occupation[i] = False
+            energies -= I_0R*inv_r[:, i]
+        elif move == 1:
+            j = np.argmin(enter)
+            occupation[j] = True
+            energies += I_0R*inv_r[:, j]
+        else:
+            i, j = np.unravel_index(np.argmin(hop), hop.shape)
+            occupation[i] = False
+            occupation[j] = True
+            energies += I_0R*(inv_r[:, j] - inv_r[:, i])
+    return occupation
+
+def _sensitivity_from_blocks(block_charge, block_time, block_score):
+    '''
+    Likelihood ratio estimate of dI_p/dV_k from the electrode charges,
+    durations and scores of consecutive blocks,
+        dI_p/dV_k = sum_b (Q_bp - I_p t_b) S_bk / sum_b t_b.
+    The error is estimated from the spread of the block contributions.
+    Returns the estimate and its standard error, both
+    N_electrodes x N_electrodes.
+    '''
+    T = block_time.sum()
+    I = block_charge.sum(axis=0)/T
+    X = block_charge - block_time[:, None]*I
+    contributions = X[:, :, None]*block_score[:, None, :]
+    D = contributions.sum(axis=0)/T
+    error = np.sqrt(((contributions - block_time[:, None, None]*D)**2).sum(axis=0))/T
+    return D, error
+
+def _jackknife_current_error(block_charge, block_time):
+    '''
+    Jackknife standard error of the currents sum_b Q_bp / sum_b t_b,
+    leaving out one block at a time.
+    '''
+    B = block_time.shape[0]
+    I_jack = ((block_charge.sum(axis=0) - block_charge)
+              /(block_time.sum() - block_time)[:, None])
+    return np.sqrt((B-1)/B*((I_jack - I_jack.mean(axis=0))**2).sum(axis=0))
+
+def _control_variate_from_blocks(block_charge, block_expected, block_time,
+                                 block_expected_time, min_charged_fraction=0.1):
+    '''
+    Control variate estimate of the currents from the counted and expected
+    electrode charges and the durations and expected durations of
+    consecutive blocks (see callGoControlVariate). The controls
+        X_bp = (Q_bp - E_bp, t_b - tau_b)
+    have a mean of exactly zero. The residuals r_bp = Q_bp - I_p t_b of the
+    plain estimate I_p = sum_b Q_bp / sum_b t_b are regressed on them, and
+        I_cv_p = sum_b (Q_bp - beta_bp . X_bp) / sum_b t_b,
+    with beta_bp the least squares coefficients of all blocks except b,
+    so that no block is corrected with coefficients fitted to itself.
+    The errors of both estimates are jackknife estimates. An electrode
+    keeps the plain estimate if the control variate does not lower its
+    error, or if less than min_charged_fraction of the blocks (and less
+    than 10) exchanged charge with it: the error estimates of such an
+    electrode depend on a few blocks and can not be trusted.
+    Returns the estimate, the plain I, the standard error of the 
+    estimate and the variance reduction (1 where I is kept), all per
+    electrode.
+    '''
+    B = block_time.shape[0]
+    T = block_time.sum()
+    I = block_charge.sum(axis=0)/T
+    r = block_charge - block_time[:, None]*I
+    X = np.stack((block_charge - block_expected,
+                  np.broadcast_to((block_time - block_expected_time)[:, None],
+                                  block_charge.shape)), axis=-1)
+    XX = np.einsum('bpi,bpj->bpij', X, X)
+    Xr = X*r[..., None]
+    # Leave one block out. Without any fluctuation of a control (e.g. no
+    # hops to an electrode) the system is singular, pinv then ignores 
+    # that control.
+    beta = np.einsum('bpij,bpj->bpi', 
+                     np.linalg.pinv(XX.sum(axis=0) - XX), Xr.sum(axis=0) - Xr)
+    corrected = block_charge - np.einsum('bpi,bpi->bp', X, beta)
+    I_cv = corrected.sum(axis=0)/T
+
+    error_raw = _jackknife_current_error(block_charge, block_time)
+    error_cv = _jackknife_current_error(corrected, block_time)
+    charged = (block_charge != 0).sum(axis=0)
+    use = ((error_cv < error_raw) 
+           & (charged >= max(10, min_charged_fraction*B)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reduction = np.where(use, error_raw**2/error_cv**2, 1.0)
+    return (np.where(use, I_cv, I), I, np.where(use, error_cv, error_raw),
+            reduction)
+
+def _keys_to_occupation(keys, N):
+    '''
+    Converts state keys of the go simulation (occupation of acceptor i is
+    bit N-1-i) to an array of occupations, one row per key.
+    '''
+    shifts = np.arange(N-1, -1, -1, dtype=np.uint64)
+    return ((keys[:, None] >> shifts) & np.uint64(1)).astype(bool)
+
+def _packed_keys_to_occupation(keys, N):
+    '''
+    Converts packed state keys of the go state histogram (occupation of
+    acceptor i is bit i%64 of word i//64, one row of words per key) to an
+    array of occupations, one row per key.
+    '''
+    keys = np.ascontiguousarray(keys, dtype='<u8')
+    bits = np.unpackbits(keys.view(np.uint8).reshape(len(keys), -1), 
+                         axis=1, bitorder='little')
+    return bits[:, :N].astype(bool)
+
+# Attributes of a kmc_dn that only depend on its geometry and are shared
+# between copies (see Device), and the per candidate attributes (see State).
+DEVICE_ATTRIBUTES = (['distances', 'transitions_constant', 'voltage_gradient',
+                      'potential_basis', '_fn_interpolation', '_vectors'] 
+                     + FEM_ATTRIBUTES + GRID_ATTRIBUTES)
+STATE_ATTRIBUTES = ['electrodes', 'static_electrodes', 'occupation', 
+                    'electrode_occupation', 'site_energies', 'E_constant', 
+                    'eV_constant', 'comp_constant', 'time', 'current', 
+                    'traffic', 'average_occupation', '_transitions', 
+                    '_problist']
+# Attributes that initialize derives from the primary inputs, they are not
+# stored by saveSelf (see kmc_dn.device_data).
+DERIVED_ATTRIBUTES = DEVICE_ATTRIBUTES + ['transitions', 'problist', 
+                                          'vectors', 'site_energies', 
+                                          'E_constant', 'eV_constant', 
+                                          'comp_constant']
+
+class Device():
+    '''
+    The geometry dependent data of a kmc_dn (see DEVICE_ATTRIBUTES): the 
+    pair matrices, the electrostatics and the caches derived from them.
+    A Device is shared by reference between a kmc_dn and its copies (see
+    kmc_dn.copy) and is never changed once it is shared: setting one of
+    its attributes through a kmc_dn first gives that kmc_dn its own 
+    shallow copy (fork), the arrays themselves are only changed in place
+    once this Device made its own copy of them (see own). revision counts
+    the in-place changes, e.g. for caches keyed by the Device.
+    '''
+    def __init__(self):
+        self.shared = False
+        self.owned = set()
+        self.revision = 0
+
+    def fork(self):
+        '''
+        Returns an unshared copy, that still refers to the same arrays.
+        '''
+        device = Device.__new__(Device)
+        device.__dict__.update(self.__dict__)
+        device.shared = False
+        device.owned = set()
+        return device
+
+    def own(self, name):
+        '''
+        Returns array name of this Device for changing it in place, it is
+        copied the first time, as it may be shared with other Devices.
+        '''
+        if name not in self.owned:
+            setattr(self, name, np.array(getattr(self, name)))
+            self.owned.add(name)
+        self.revision = getattr(self, 'revision', 0) + 1
+        return getattr(self, name)
+
+class State():
+    '''
+    The per candidate data of a kmc_dn (see STATE_ATTRIBUTES): voltages,
+    energies, occupation and simulation results. Small, so copies of a
+    kmc_dn each get their own.
+    '''
+    __slots__ = STATE_ATTRIBUTES
+
+    def copy(self):
+        state = State()
+        for name in self.__slots__:
+            if hasattr(self, name):
+                value = getattr(self, name)
+                if isinstance(value, np.ndarray):
+                    value = value.copy()
+                setattr(state, name, value)
+        return state
+
+def _device_property(name):
+    def get(self):
+        try:
+            return getattr(self.__dict__['_device'], name)
+        except KeyError:
+            raise AttributeError(name)
+
+    def set(self, value):
+        device = self._writable_device()
+        setattr(device, name, value)
+        device.owned.discard(name)
+    return property(get, set, doc=f'{name}, stored in the Device.')
+
+def _state_property(name):
+    def get(self):
+        try:
+            return getattr(self.__dict__['_state'], name)
+        except KeyError:
+            raise AttributeError(name)
+
+    def set(self, value):
+        if '_state' not in self.__dict__:
+            self._state = State()
+        setattr(self._state, name, value)
+    return property(get, set, doc=f'{name}, stored in the State.')
+
 class kmc_dn():
     def __init__(self, N, M, xdim, ydim, zdim, mu = 0, I_0=100, a=0.25, **kwargs):
         '''
@@ -210,10 +690,20 @@ class kmc_dn():
             only influence the potential profile V.
             default: np.zeros((0, 4))
         res; float
-            Resolution used for solving the chemical potential profile
-            with fenics. E.g., if (xdim, ydim) = (1, 1) and res = 0.1,
-            the domain would be split into hundred elements.
+            Resolution used for solving the chemical potential profile.
+            E.g., if (xdim, ydim) = (1, 1) and res = 0.1, the domain 
+            would be split into hundred elements.
             default: min[xdim, ydim, zdim]/100
+        potential_backend; string
+            Determines how the chemical potential profile V is solved.
+            Possible options are:
+            'fd'; finite differences with scipy (see potential_grid)
+            'fenics'; finite elements with fenics, which has to be 
+                installed
+            Both use the same grid of nodes and give the same node 
+            values, between the nodes V is interpolated bilinearly 
+            ('fd') or linearly on triangles ('fenics').
+            default: 'fd'
         calc_E_constant; string
             Determines the choice of the calc_E_constant method.
             Possible options are:
@@ -257,7 +747,13 @@ class kmc_dn():
             A dictionary holding strings to define fn_expression.
         fn_expression; string
             A string containing the expression that defines the fenics
-            boundary condition.
+            boundary condition. Also defines the geometry of V for the
+            'fd' backend.
+        fd_grid; LaplaceGrid
+            The grid and factorised operator of the 'fd' backend.
+        fd_lifting; nodes x coefficients float np.array
+            The boundary values of every potential coefficient, see 
+            init_grid_solver.
         fn_boundary; fenics Expression
         fn_mesh; fenics Mesh
         fn_functionspace; fenics FunctionSpace
@@ -298,7 +794,7 @@ class kmc_dn():
             to the transitions array.
         vectors; (N+P)x(N+P)x3 float np.array
             vectors[i, j] is the unit vector pointing from site i to
-            site j.
+            site j. Only calculated when it is first used.
         E_constant; (N,) float np.array
             Contains energy contributions that are constant throughout
             one simulation run and is (by default) equal to the sum of
@@ -320,6 +816,15 @@ class kmc_dn():
             Contains for each hopping site the average occupation as a
             fraction of the simulation time
 
+        Device and State
+        ~~~~~~~~~~~~~~~~
+        The attributes in DEVICE_ATTRIBUTES (pair matrices, 
+        electrostatics) are stored in a Device, the ones in 
+        STATE_ATTRIBUTES (voltages, energies, occupation, results) in a
+        State. kmc_dn.copy() shares the Device and copies the State, so
+        many candidates of e.g. a voltage search take little memory.
+        Reading and setting the attributes works as before.
+
         Class methods
         =============
         Below follows a short description of each method in this class.
@@ -391,6 +896,13 @@ class kmc_dn():
             if(self.dim == 3):
                 self.res = min([self.xdim, self.ydim, self.zdim])/100
 
+        if('potential_backend' in kwargs):
+            self.potential_backend = kwargs['potential_backend']
+        else:
+            self.potential_backend = 'fd'
+        if self.potential_backend not in ['fd', 'fenics']:
+            raise ValueError("potential_backend must be 'fd' or 'fenics'")
+
         # Initialize method kwargs
         if('calc_E_constant' in kwargs):
             if(kwargs['calc_E_constant'] == 'calc_E_constant_V'):
@@ -421,18 +933,16 @@ class kmc_dn():
         All methods are toggleable by boolean values.
         '''
         # Initialize other attributes
-        self.transitions = np.zeros((self.N + self.P,
-                                     self.N + self.P))
         self.transitions_constant = np.zeros((self.N + self.P,
                                      self.N + self.P))
         self.distances = np.zeros((self.N + self.P,
                                    self.N + self.P))
-        self.vectors = np.zeros((self.N + self.P,
-                                 self.N + self.P, 3))
         self.site_energies = np.zeros((self.N + self.P,))
-        self.problist = np.zeros((self.N+self.P)**2)
         self.occupation = np.zeros(self.N, dtype=bool)
         self.electrode_occupation = np.zeros(self.P, dtype=int)
+        self.voltage_gradient = None
+        self._moves = []
+        self._network_cache = None
 
         if(dopant_placement):
             self.place_dopants_random()
@@ -451,6 +961,81 @@ class kmc_dn():
         if(E_constant):
             self.calc_E_constant()
 
+    def copy(self):
+        '''
+        Returns a copy of this kmc_dn, e.g. for a candidate of a voltage
+        search. The Device (pair matrices, electrostatics) is shared, the
+        State (voltages, energies, occupation, results) and the other 
+        attributes are copied. Changing the geometry of either of them
+        (initialize, calc_distances, apply_move, ...) gives that one its 
+        own Device. The copy starts without moves to undo.
+        '''
+        new = kmc_dn.__new__(kmc_dn)
+        for key, value in self.__dict__.items():
+            if key in ('_device', '_state', '_V', '_V_coefficients', '_moves'):
+                continue
+            if isinstance(value, (np.ndarray, list, dict)):
+                value = value.copy()
+            elif getattr(value, '__self__', None) is self:
+                # Bound methods, e.g. calc_E_constant
+                value = getattr(new, value.__func__.__name__)
+            new.__dict__[key] = value
+        if '_device' in self.__dict__:
+            self._device.shared = True
+            new._device = self._device
+        if '_state' in self.__dict__:
+            new._state = self._state.copy()
+        if hasattr(self, 'dim') and self.has_potential_basis():
+            # V is built from the basis when it is used
+            new._V = None
+            new._V_coefficients = new.potential_coefficients()
+        elif isinstance(self.__dict__.get('_V'), np.ndarray):
+            new.V = self._V.copy()
+        elif '_V' in self.__dict__:
+            new.V = self._V
+        return new
+
+    def _writable_device(self):
+        '''
+        Returns the Device of this kmc_dn, forked first if it is shared.
+        '''
+        device = self.__dict__.get('_device')
+        if device is None:
+            device = self._device = Device()
+        elif device.shared:
+            device = self._device = device.fork()
+        return device
+
+    @property
+    def transitions(self):
+        '''
+        Work space of the python simulations, (N+P)x(N+P), allocated on
+        first use.
+        '''
+        size = self.N + self.P
+        if getattr(self, '_transitions', None) is None or self._transitions.shape != (size, size):
+            self._transitions = np.zeros((size, size))
+        return self._transitions
+
+    @transitions.setter
+    def transitions(self, transitions):
+        self._transitions = transitions
+
+    @property
+    def problist(self):
+        '''
+        Work space of the python simulations, (N+P)**2, allocated on first
+        use.
+        '''
+        size = (self.N + self.P)**2
+        if getattr(self, '_problist', None) is None or self._problist.shape != (size,):
+            self._problist = np.zeros(size)
+        return self._problist
+
+    @problist.setter
+    def problist(self, problist):
+        self._problist = problist
+
     def reset(self):
         '''
         Resets all relevant trackers before running a simulation.
@@ -472,7 +1057,8 @@ class kmc_dn():
 
     def go_simulation(self, hops = 1E5, prehops = 0, 
                       goSpecificFunction="wrapperSimulateRecord", 
-                      record=False, prune_threshold=0):
+                      record=False, prune_threshold=0, workers=0,
+                      resume=None, control_variate=False):
         '''
         Perform a simulation with the go implementation.
         
@@ -490,9 +1076,39 @@ class kmc_dn():
             states and skips calculation of rates when possible.
             This is usually faster, if you do not want this, set
             this parameter to 'wrapperSimulate'.
+            After use_reuse_cache() it is replaced by
+            'wrapperSimulateCached', which keeps the stored states
+            between calls.
+            For large systems (N in the hundreds) 'wrapperSimulateParallel'
+            spreads the rate recalculation of a single simulation over
+            several cores, see workers.
         record; bool
             If True, the simulation will also keep track of traffic
             and the time each site is occupied.
+        workers; int
+            Only used by 'wrapperSimulateParallel'. The number of
+            goroutines that recalculate the rates, 0 means one per core
+            (at most 8). Small systems are simulated serially regardless.
+        resume; dict
+            A kmc_dn.simulation_state of an earlier simulation. The
+            simulation then continues from its occupation and random
+            state, and hops are added to its time, electrode_occupation
+            and traffic instead of starting over. prehops is ignored.
+            Only possible for the functions in
+            pythonBind.resumableFunctions, with the same
+            goSpecificFunction and E_constant as the earlier simulation.
+        control_variate; bool
+            If True, the current is estimated with control variates. For
+            every state that is visited the expected charge of the next
+            hop (the mean-field current of that exact occupation) and the
+            expected time are known, their differences with the counted
+            charge and time have zero mean and are subtracted with
+            coefficients that are estimated from blocks of 1000 hops of
+            the same run. Electrodes for which this does not reduce the
+            variance keep the plain estimate (see variance_reduction).
+            Off by default, as it only pays off on electrodes with a lot
+            of traffic. goSpecificFunction is ignored, record and resume
+            are not supported.
 
         Output arguments (see main docstring for definition)
         ----------------
@@ -500,16 +1116,203 @@ class kmc_dn():
         kmc_dn.occupation
         kmc_dn.electrode_occupation
         kmc_dn.current
+        kmc_dn.simulation_state
+            Everything needed to resume the simulation, or None. Its
+            'requested_function' is the goSpecificFunction that was
+            passed, 'goSpecificFunction' the one that was used (see
+            use_reuse_cache).
+        kmc_dn.simulation_stats
+            Counters of the go call (see pythonBind.statNames): hops,
+            wall_time, hops_per_second, cache_hits, rate_recomputations,
+            mallocs and allocated_bytes. Empty for go functions that do
+            not report them. Use pythonBind.goProfile for a full profile.
         if(record):
             kmc_dn.traffic
             kmc_dn.average_occupation
+        if(control_variate):
+            kmc_dn.current_raw
+                The plain estimate of the current, for comparison.
+            kmc_dn.current_error
+                The standard error of kmc_dn.current.
+            kmc_dn.variance_reduction
+                The (jackknife) variance of current_raw divided by that 
+                of current, per electrode. 1 for electrodes that keep 
+                current_raw, see _control_variate_from_blocks.
         '''
+        if control_variate:
+            if record or resume is not None:
+                raise ValueError("record and resume are not supported with "
+                                 "control_variate.")
+            self.makeSimulation(simulateFunction=self._simulate_control_variate,
+                                preHopFunction=callGoSimulation,
+                                hops=hops, prehops=prehops,
+                                goSpecificFunction="wrapperSimulateControlVariate")
+            return
+        requested_function = goSpecificFunction
+        if (goSpecificFunction == "wrapperSimulateRecord"
+                and getattr(self, 'reuse_cache', None) is not None):
+            goSpecificFunction = "wrapperSimulateCached"
         self.makeSimulation(simulateFunction = callGoSimulation, 
                             preHopFunction = callGoSimulation, 
                             hops = hops, prehops = prehops, 
                             goSpecificFunction=goSpecificFunction, 
-                            record=record, prune_threshold=prune_threshold)
+                            record=record, prune_threshold=prune_threshold,
+                            workers=workers, resume=resume)
+        if self.simulation_state is not None:
+            self.simulation_state['requested_function'] = requested_function
     
+    def use_reuse_cache(self, reuse_cache=None, budget=2**30):
+        '''
+        Makes go_simulation keep the transition rates of visited states
+        between calls, in a pythonBind.ReuseCache. Repeated simulations of
+        the same configuration (E_constant, voltages, geometry and 
+        constants), like the tests of a dn_search or the repeats of a 
+        validation, then start with a hot cache instead of recomputing the
+        rates of every state. Any change of the configuration gives a new
+        table in the cache, the least recently used tables are dropped to
+        stay within budget bytes.
+        
+        Input arguments
+        ===============
+        reuse_cache; pythonBind.ReuseCache
+            A cache to share with other kmc_dn objects, a new one of
+            budget bytes is made if None. False disables the cache again.
+        
+        Returns the cache, see its info() for the number of stored states.
+        '''
+        if reuse_cache is False:
+            self.reuse_cache = None
+        elif reuse_cache is None:
+            self.reuse_cache = ReuseCache(budget)
+        else:
+            self.reuse_cache = reuse_cache
+        return self.reuse_cache
+
+    def go_simulation_async(self, *args, **kwargs):
+        '''
+        Runs go_simulation(*args, **kwargs) on a shared thread pool and 
+        returns a concurrent.futures.Future that resolves to this kmc_dn
+        when the simulation is done. The go library runs without the GIL,
+        so many simulations (of different kmc_dn objects) can be in flight
+        while the calling thread does e.g. FEM solves. Simulations of the 
+        same kmc_dn are run one after the other. Do not change the kmc_dn
+        (voltages, E_constant, ...) before its future is done.
+        In asyncio code, await asyncio.wrap_future(future).
+        '''
+        lock = _get_instance_lock(self)
+
+        def run():
+            with lock:
+                self.go_simulation(*args, **kwargs)
+            return self
+        return _get_simulation_executor().submit(run)
+
+    def _simulate_control_variate(self, hops, stats=None, **kwargs):
+        '''
+        simulateFunction of go_simulation with control_variate. Calls
+        callGoControlVariate and returns the electrode occupation that
+        corresponds to the control variate estimate of the current.
+        '''
+        hops = int(hops)
+        blocks = min(max(hops//1000, 10), max(hops, 1))
+        (time, occupation, block_charge, block_expected, block_time,
+         block_expected_time) = callGoControlVariate(
+            kwargs['N_acceptors'], kwargs['N_electrodes'], kwargs['nu'],
+            kwargs['kT'], kwargs['I_0'], kwargs['R'], kwargs['time'],
+            kwargs['occupation'], kwargs['distances'], kwargs['E_constant'],
+            kwargs['site_energies'], kwargs['transitions_constant'],
+            kwargs['electrode_occupation'], hops, blocks, stats=stats)
+        (current, self.current_raw, self.current_error,
+         self.variance_reduction) = _control_variate_from_blocks(
+            block_charge, block_expected, block_time, block_expected_time)
+        return time, occupation, current*time
+
+    def replica_simulation(self, hops = 1E5, replicas = 1, voltages = None,
+                           record = False):
+        '''
+        Simulates many independent replicas at once with the numba engine
+        (_simulate_replicas), which runs on all cores and does not need the
+        go library. All replicas start from kmc_dn.occupation.
+
+        Input arguments
+        ---------------
+        hops; int
+            The amount of hops performed per replica.
+        replicas; int
+            The amount of independent replicas per voltage setting.
+        voltages; array
+            Voltage settings (settings x P) to simulate at once. E_constant
+            is linear in the voltages, so the settings are applied with
+            kmc_dn.voltage_gradient (calculated if needed) instead of
+            solving V again. If None, the present voltages are used.
+        record; bool
+            If True, the time each site is occupied is tracked as well.
+
+        Output arguments
+        ----------------
+        Returns the currents per setting (settings x P), from the charge of
+        all replicas divided by their total time.
+        kmc_dn.replica_time
+            Time per setting and replica (settings x replicas).
+        kmc_dn.replica_electrode_occupation
+            Electrode occupation per setting and replica.
+        kmc_dn.replica_occupation
+            Final occupation per setting and replica.
+        if(record):
+            kmc_dn.replica_average_occupation
+                Average occupation per setting (settings x N).
+        if(voltages is None):
+            kmc_dn.time, kmc_dn.electrode_occupation, kmc_dn.current and
+            kmc_dn.average_occupation (if record) for all replicas 
+            together, and kmc_dn.occupation of the last replica.
+        '''
+        N = self.N
+        if voltages is None:
+            E_constants = np.array(self.E_constant, dtype=float)[None]
+            electrode_energies = np.array(self.site_energies[N:], 
+                                          dtype=float)[None]
+        else:
+            voltages = np.atleast_2d(np.asarray(voltages, dtype=float))
+            if self.voltage_gradient is None:
+                self.calc_voltage_gradient()
+            dV = voltages - self.electrodes[:, 3]
+            E_constants = self.E_constant + dV @ self.voltage_gradient[:N].T
+            electrode_energies = (self.site_energies[N:] 
+                                  + dV @ self.voltage_gradient[N:].T)
+        settings = E_constants.shape[0]
+        occupations = np.tile(np.array(self.occupation, dtype=bool), 
+                              (settings*replicas, 1))
+        
+        (times, occupations, electrode_occupations, 
+         occupation_times) = _simulate_replicas(
+            N, self.P, float(self.nu), float(self.kT), float(self.I_0), 
+            float(self.R), occupations, np.asarray(self.distances, dtype=float), 
+            np.repeat(E_constants, replicas, axis=0), 
+            np.repeat(electrode_energies, replicas, axis=0),
+            np.asarray(self.transitions_constant, dtype=float), int(hops), 
+            record)
+
+        self.replica_time = times.reshape((settings, replicas))
+        self.replica_electrode_occupation = electrode_occupations.reshape(
+            (settings, replicas, self.P))
+        self.replica_occupation = occupations.reshape(
+            (settings, replicas, N))
+        total_time = self.replica_time.sum(axis=1)
+        currents = (self.replica_electrode_occupation.sum(axis=1)
+                    /total_time[:, None])
+        if record:
+            self.replica_average_occupation = (
+                occupation_times.reshape((settings, replicas, N)).sum(axis=1)
+                /total_time[:, None])
+        if voltages is None:
+            self.time = total_time[0]
+            self.electrode_occupation = self.replica_electrode_occupation[0].sum(axis=0)
+            self.current = currents[0]
+            self.occupation = self.replica_occupation[0, -1].copy()
+            if record:
+                self.average_occupation = self.replica_average_occupation[0]
+        return currents
+
     def python_simulation(self, hops = 1E5, prehops = 0, 
                           record = False):
         '''
@@ -543,12 +1346,26 @@ class kmc_dn():
 
     def makeSimulation(self, simulateFunction = None, preHopFunction = None, 
                        prehops = 0, hops = 1E5, record = False, 
-                       goSpecificFunction = None, prune_threshold=0.0):
+                       goSpecificFunction = None, prune_threshold=0.0,
+                       workers=0, resume=None):
         '''
         A wrapper function that allows the user to simulate with either
         python or go. Examples can be found in self.python_simulation()
         and self.go_simulation()
         '''
+        resumable = goSpecificFunction in resumableFunctions
+        if resume is not None:
+            if not resumable or goSpecificFunction != resume['goSpecificFunction']:
+                raise ValueError("Can only resume a simulation with the same "
+                                 "resumable goSpecificFunction, got %s"
+                                 %(goSpecificFunction))
+            if not np.array_equal(resume['E_constant'], self.E_constant):
+                raise ValueError("E_constant changed since the simulation "
+                                 "that is resumed.")
+            if record and resume['traffic'] is None:
+                raise ValueError("Can not record a resumed simulation that "
+                                 "was not recorded from the start.")
+            prehops = 0
         # Initialize simulation methods
         if simulateFunction != None:
             self.simulate_func = simulateFunction
@@ -587,6 +1404,19 @@ class kmc_dn():
         if goSpecificFunction != None:
             args["goSpecificFunction"] = goSpecificFunction
             args["prune_threshold"] = prune_threshold
+            args["workers"] = workers
+            if goSpecificFunction == "wrapperSimulateCached":
+                args["reuse_cache"] = getattr(self, 'reuse_cache', None)
+            self.simulation_stats = {}
+            args["stats"] = self.simulation_stats
+        else:
+            self.simulation_stats = None
+        if resumable:
+            if resume is not None:
+                args["occupation"] = resume['occupation']
+                args["rng_state"] = list(resume['rng'])
+            else:
+                args["rng_state"] = [0.0, 0.0, 0.0]
     
         args["hops"] = hops
 
@@ -599,6 +1429,14 @@ class kmc_dn():
              self.electrode_occupation, 
              self.traffic, occupations_in_time) = self.simulate_func(**args)
 
+            if resume is not None:
+                self.time += resume['time']
+                self.electrode_occupation = (self.electrode_occupation
+                                             + resume['electrode_occupation'])
+                self.traffic = self.traffic + resume['traffic']
+                occupations_in_time = (np.array(occupations_in_time)
+                                       + resume['occupation_time'])
+
             # Calculate quantities
             self.average_occupation= [x / self.time for x in occupations_in_time]
             self.current = self.electrode_occupation/self.time
@@ -613,10 +1451,555 @@ class kmc_dn():
                 (self.time, 
                  self.occupation, 
                  self.electrode_occupation) = self.simulate_func(**args)
+            if resume is not None:
+                self.time += resume['time']
+                self.electrode_occupation = (self.electrode_occupation
+                                             + resume['electrode_occupation'])
 
             # Calculate quantities
             self.current = self.electrode_occupation/self.time
 
+        # Store everything needed to continue this simulation later
+        if resumable:
+            recorded = record and (resume is None or resume['traffic'] is not None)
+            self.simulation_state = {
+                'goSpecificFunction':goSpecificFunction,
+                'E_constant':np.array(self.E_constant, copy=True),
+                'occupation':np.array(self.occupation, copy=True),
+                'rng':list(args["rng_state"]),
+                'time':self.time,
+                'electrode_occupation':np.array(self.electrode_occupation, copy=True),
+                'traffic':np.array(self.traffic, copy=True) if recorded else None,
+                'occupation_time':np.array(occupations_in_time) if recorded else None,
+                'hops':hops + (resume['hops'] if resume is not None else 0)}
+        else:
+            self.simulation_state = None
+
+    def conductance_matrix(self, hops = 1E6, blocks = 100, 
+                           equilibration_blocks = 1):
+        '''
+        Estimates the linear conductance matrix between all electrodes from
+        the current fluctuations of a single go simulation at zero bias
+        (Green-Kubo, in its Einstein-Helfand form). This replaces one
+        biased simulation per electrode pair. The electrode voltages are
+        set to 0 during the simulation and restored afterwards, static
+        electrodes are left as they are.
+
+        conductance[p, q] is the derivative of kmc_dn.current[p] with
+        respect to the voltage of electrode q, so for small voltages V
+        kmc_dn.current is approximately conductance @ V. The diagonal is
+        therefore negative and the rows and columns sum to ~0.
+
+        Input arguments
+        ---------------
+        hops; int
+            The total amount of hops performed.
+        blocks; int
+            The simulation is split in this many blocks of equal amount of
+            hops. Each block should last much longer than the correlation
+            time of the currents, but at least ~30 blocks are needed for
+            meaningful errors.
+        equilibration_blocks; int
+            The amount of first blocks that are discarded.
+
+        Output arguments
+        ----------------
+        kmc_dn.conductance; PxP array
+        kmc_dn.conductance_error; PxP array
+            Jackknife standard error of each element.
+        kmc_dn.occupation
+        kmc_dn.simulation_stats
+        '''
+        if blocks - equilibration_blocks < 2:
+            raise ValueError("At least 2 blocks are needed after equilibration")
+        voltages = self.electrodes[:, 3].copy()
+        self.electrodes[:, 3] = 0
+        self.update_V()
+        self.reset()
+        self.simulation_stats = {}
+        try:
+            (self.time, self.occupation, 
+             block_charge, block_time) = callGoConductance(
+                self.N, self.P, self.nu, self.kT, self.I_0, self.R, 
+                self.time, self.occupation, self.distances, 
+                self.E_constant, self.site_energies, 
+                self.transitions_constant, self.electrode_occupation, 
+                int(hops), blocks, stats=self.simulation_stats)
+        finally:
+            self.electrodes[:, 3] = voltages
+            self.update_V()
+
+        self.conductance, self.conductance_error = _conductance_from_blocks(
+            block_charge[equilibration_blocks:], 
+            block_time[equilibration_blocks:], self.kT)
+        return self.conductance, self.conductance_error
+
+    def resistor_network_conductance(self, max_excitation = 30):
+        '''
+        Maps the system at equilibrium (all electrodes at 0 V) onto its
+        Miller-Abrahams resistor network and reduces it to the electrodes.
+        The site energies are those of E_constant without the electrode
+        voltages, so the network is the linear response around zero bias
+        and does not depend on the present voltages.
+
+        The equilibrium is approximated by the Coulomb ground state (see
+        _coulomb_ground_state) and all states one move away from it (a
+        single acceptor filled or emptied, or a single hop between two
+        acceptors), Boltzmann weighted by their energy. Every pair (i, j)
+        gets the conductance
+            G_ij = <Gamma_ij>/kT,
+        with Gamma_ij the KMC rate of the hop i -> j (including the
+        acceptor-pair Coulomb term) averaged over these states,
+        symmetrised, and the nodal equations of the acceptors are
+        eliminated (Schur complement).
+
+        The result is cached until the geometry changes (initialize,
+        apply_move, undo) or the equilibrium energies do.
+
+        Input arguments
+        ---------------
+        max_excitation; float
+            States more than max_excitation kT above the ground state are
+            left out of the average.
+
+        Output arguments
+        ----------------
+        kmc_dn.network_conductance
+            P x P matrix, network_conductance[p, q] is dI_p/dV_q of the
+            network, like kmc_dn.conductance.
+        '''
+        N = self.N
+        if getattr(self, 'voltage_gradient', None) is None:
+            self.calc_voltage_gradient()
+        E_equilibrium = (self.E_constant 
+                         - self.voltage_gradient[:N] @ self.electrodes[:, 3])
+        parameters = (self.nu, self.kT, self.I_0, self.R, max_excitation)
+        cache = getattr(self, '_network_cache', None)
+        if (cache is not None and cache[0] == parameters
+                and np.array_equal(cache[1], E_equilibrium)):
+            self.network_conductance = cache[2]
+            return self.network_conductance
+        inv_r = np.zeros((N, N))
+        np.divide(1, self.distances[:N, :N], out=inv_r, 
+                  where=~np.eye(N, dtype=bool))
+        I_0R = self.I_0*self.R
+        ground = _coulomb_ground_state(E_equilibrium, inv_r, I_0R)
+
+        # The ground state, single flips and single acceptor hops
+        filled = np.flatnonzero(ground)
+        empty = np.flatnonzero(~ground)
+        hop_from, hop_to = [a.ravel() for a in np.meshgrid(filled, empty, 
+                                                            indexing='ij')]
+        states = np.repeat(ground[None], 1 + N + hop_from.size, axis=0)
+        states[1 + np.arange(N), np.arange(N)] ^= True
+        hops = 1 + N + np.arange(hop_from.size)
+        states[hops, hop_from] = False
+        states[hops, hop_to] = True
+        vacant = (~states).astype(float)
+        energy = (states @ E_equilibrium 
+                  + 0.5*I_0R*np.einsum('si,ij,sj->s', vacant, inv_r, vacant))
+        excitation = (energy - energy.min())/self.kT
+        keep = excitation <= max_excitation
+        states = states[keep]
+        weights = np.exp(-excitation[keep])
+        weights /= weights.sum()
+
+        # Average KMC rates, electrodes are always occupied and empty
+        # for the purpose of a hop (like probTransitionPossible)
+        tc = np.clip(self.transitions_constant, 0, None)
+        coulomb = np.zeros((N + self.P, N + self.P))
+        coulomb[:N, :N] = I_0R*inv_r
+        energies = np.zeros(N + self.P)
+        occupation = np.ones(N + self.P, dtype=bool)
+        vacancy = np.ones(N + self.P, dtype=bool)
+        rates = np.zeros((N + self.P, N + self.P))
+        for state, weight in zip(states, weights):
+            energies[:N] = E_equilibrium - I_0R*inv_r @ ~state
+            occupation[:N] = state
+            vacancy[:N] = ~state
+            barrier = np.clip(energies[None, :] - energies[:, None] - coulomb,
+                              0, None)
+            rates += (weight*occupation[:, None]*vacancy[None, :]
+                      *np.exp(-barrier/self.kT))
+        G = self.nu*tc*rates/self.kT
+        G[N:, N:] = 0
+        np.fill_diagonal(G, 0)
+        G = 0.5*(G + G.T)
+
+        # Nodal (Laplacian) matrix and its reduction to the electrodes
+        L = np.diag(G.sum(axis=1)) - G
+        L_ss = L[:N, :N]
+        L_se = L[:N, N:]
+        try:
+            X = np.linalg.solve(L_ss, L_se)
+        except np.linalg.LinAlgError:
+            X = np.linalg.lstsq(L_ss, L_se, rcond=None)[0]
+        self.network_conductance = -(L[N:, N:] - L[N:, :N] @ X)
+        self._network_cache = (parameters, E_equilibrium, 
+                               self.network_conductance)
+        return self.network_conductance
+
+    def resistor_network_currents(self, voltages = None):
+        '''
+        Electrode currents of the linearised resistor network (see
+        resistor_network_conductance) for many voltage settings at once.
+        The network is the linear response around zero bias, so it is 
+        less accurate for voltages that are large compared to kT.
+
+        Input arguments
+        ---------------
+        voltages; array
+            Electrode voltages, shape (P,) or (settings, P). Defaults to
+            the present voltages.
+
+        Returns the currents, with the same shape as voltages.
+        '''
+        if voltages is None:
+            voltages = self.electrodes[:, 3]
+        G = self.resistor_network_conductance()
+        return np.asarray(voltages) @ G.T
+
+    def resistor_network_simulation(self):
+        '''
+        Sets kmc_dn.current to the currents of the linearised resistor
+        network at the present voltages (see resistor_network_conductance).
+        Only meaningful at low bias: devices with I_0 >> kT hardly conduct
+        at zero bias, their currents at larger voltages are far above the
+        linear response.
+        '''
+        self.current = self.resistor_network_currents()
+
+    def current_sensitivity(self, hops = 1E6, block_hops = 1000, 
+                            equilibration_blocks = 1):
+        '''
+        Simulates at the current voltages with go and estimates, next to 
+        the currents, the derivative of every current to every electrode
+        voltage. The derivatives are likelihood ratio (score function)
+        estimates accumulated during the same run, no perturbed
+        simulations are needed. Static electrodes are not included.
+
+        Input arguments
+        ---------------
+        hops; int
+            The total amount of hops performed.
+        block_hops; int
+            The simulation is split in blocks of this many hops. Only 
+            correlations within a block are taken into account, so a block
+            should last longer than the correlation time of the currents.
+            The variance of the estimate grows with the block length
+            though, so blocks should not be much longer than needed.
+        equilibration_blocks; int
+            The amount of first blocks that are discarded.
+
+        Output arguments
+        ----------------
+        kmc_dn.current_gradient; PxP array
+            current_gradient[p, k] is dI_p/dV_k.
+        kmc_dn.current_gradient_error; PxP array
+            Standard error of each element.
+        kmc_dn.time
+        kmc_dn.occupation
+        kmc_dn.electrode_occupation
+        kmc_dn.current
+        kmc_dn.simulation_stats
+        '''
+        blocks = int(hops/block_hops)
+        if blocks - equilibration_blocks < 2:
+            raise ValueError("At least 2 blocks are needed after equilibration")
+        if getattr(self, 'voltage_gradient', None) is None:
+            self.calc_voltage_gradient()
+        self.reset()
+        self.simulation_stats = {}
+        (_, self.occupation, block_charge, block_time, 
+         block_score) = callGoSensitivity(
+            self.N, self.P, self.nu, self.kT, self.I_0, self.R, 
+            self.time, self.occupation, self.distances, self.E_constant, 
+            self.site_energies, self.transitions_constant, 
+            self.electrode_occupation, blocks*int(block_hops), blocks, 
+            self.voltage_gradient, stats=self.simulation_stats)
+        block_charge = block_charge[equilibration_blocks:]
+        block_time = block_time[equilibration_blocks:]
+        block_score = block_score[equilibration_blocks:]
+
+        self.time = block_time.sum()
+        self.electrode_occupation = block_charge.sum(axis=0)
+        self.current = self.electrode_occupation/self.time
+        (self.current_gradient, 
+         self.current_gradient_error) = _sensitivity_from_blocks(
+            block_charge, block_time, block_score)
+        return self.current_gradient, self.current_gradient_error
+
+    def record_trajectory(self, hops = 1E6, block_hops = 1000, 
+                          max_records = None, equilibration_blocks = 1):
+        '''
+        Simulates with go at the current voltages and records, per block
+        of hops, the time spent in each state and the transitions taken.
+        These are sufficient to estimate the currents at nearby energies
+        by reweighting the trajectory, see self.reweight. Only possible 
+        for N <= 64, because states are stored as 64 bit keys.
+
+        Input arguments
+        ---------------
+        hops; int
+            The total amount of hops performed.
+        block_hops; int
+            Reweighting is done per block of this many hops. Longer blocks
+            make the weights degenerate sooner, shorter blocks ignore
+            more of the correlation between blocks.
+        max_records; int
+            The maximum amount of (block, state) residences and 
+            (block, state, transition) jumps stored, defaults to hops.
+        equilibration_blocks; int
+            The amount of first blocks that are discarded, they are not
+            part of the trajectory, time and currents.
+
+        Output arguments
+        ----------------
+        kmc_dn.trajectory; dict
+        kmc_dn.time
+        kmc_dn.occupation
+        kmc_dn.electrode_occupation
+        kmc_dn.current
+        kmc_dn.simulation_stats
+        '''
+        if self.N > 64:
+            raise ValueError("Trajectories can only be recorded for N <= 64")
+        blocks = int(hops/block_hops)
+        if blocks - equilibration_blocks < 2:
+            raise ValueError("At least 2 blocks are needed after equilibration")
+        if max_records is None:
+            max_records = blocks*int(block_hops)
+        self.reset()
+        self.simulation_stats = {}
+        (_, self.occupation, block_time, 
+         residences, jumps) = callGoTrajectory(
+            self.N, self.P, self.nu, self.kT, self.I_0, self.R, 
+            self.time, self.occupation, self.distances, self.E_constant, 
+            self.site_energies, self.transitions_constant, 
+            self.electrode_occupation, blocks*int(block_hops), blocks, 
+            int(max_records), stats=self.simulation_stats)
+
+        # Drop the equilibration blocks and renumber the others
+        block_time = block_time[equilibration_blocks:]
+        kept = residences[0] >= equilibration_blocks
+        residences = ((residences[0][kept] - equilibration_blocks,)
+                      + tuple(values[kept] for values in residences[1:]))
+        kept = jumps[0] >= equilibration_blocks
+        jumps = ((jumps[0][kept] - equilibration_blocks,)
+                 + tuple(values[kept] for values in jumps[1:]))
+        self.time = block_time.sum()
+
+        self.trajectory = {'E_constant':np.array(self.E_constant, copy=True),
+                           'electrode_energies':np.array(self.site_energies[self.N:], copy=True),
+                           'voltages':self.electrodes[:, 3].copy(),
+                           'block_time':block_time,
+                           'residences':residences,
+                           'jumps':jumps}
+        block_charge = self._trajectory_block_charge()
+        self.electrode_occupation = block_charge.sum(axis=0)
+        self.current = self.electrode_occupation/self.time
+
+    def _trajectory_block_charge(self):
+        '''
+        Charge that entered each electrode per block of self.trajectory.
+        '''
+        blocks = len(self.trajectory['block_time'])
+        block, _, origin, destination, count = self.trajectory['jumps']
+        block_charge = np.zeros((blocks, self.P))
+        for p in range(self.P):
+            flow = count*((destination == self.N + p).astype(float) 
+                          - (origin == self.N + p))
+            block_charge[:, p] = np.bincount(block, weights=flow, 
+                                             minlength=blocks)
+        return block_charge
+
+    def reweight(self, E_constants, electrode_energies = None, 
+                 min_ess_fraction = 0.1):
+        '''
+        Estimates the currents at other energies from self.trajectory
+        (see record_trajectory) by path reweighting. Every block of the 
+        trajectory gets the likelihood ratio of its path under the new
+        energies as weight,
+            ln w_b = sum_jumps ln(a'/a) - sum_states t_s (a'_0 - a_0),
+        and the currents are sum_b w_b Q_b / sum_b w_b t_b. Blocks still
+        start from states of the recorded simulation, which biases the
+        estimate by roughly the correlation time over the block length.
+
+        Input arguments
+        ---------------
+        E_constants; list of N arrays
+            The E_constant vectors to estimate the currents at.
+        electrode_energies; list of P arrays
+            The electrode energies (voltages) belonging to each
+            E_constant, by default the recorded ones.
+        min_ess_fraction; float
+            If the effective sample size is below this fraction of the
+            amount of blocks, reweighting is not reliable and a fresh
+            simulation is advised.
+
+        Output arguments
+        ----------------
+        currents; len(E_constants)xP array
+        ess; array
+            Effective sample size (sum w)^2/sum w^2 for each target, in 
+            blocks.
+        resimulate; bool array
+            True for the targets where ess is too low.
+        '''
+        trajectory = self.trajectory
+        block_time = trajectory['block_time']
+        blocks = len(block_time)
+        res_block, res_key, res_time = trajectory['residences']
+        jump_block, jump_key, origin, destination, count = trajectory['jumps']
+        N = self.N
+        if electrode_energies is None:
+            electrode_energies = [trajectory['electrode_energies']]*len(E_constants)
+        # Row 0 holds the recorded energies
+        energies = np.zeros((len(E_constants) + 1, N + self.P))
+        energies[0, :N] = trajectory['E_constant']
+        energies[0, N:] = trajectory['electrode_energies']
+        for k in range(len(E_constants)):
+            energies[k+1, :N] = E_constants[k]
+            energies[k+1, N:] = electrode_energies[k]
+
+        # Interaction energy of every visited state (0 for electrodes)
+        keys, res_state = np.unique(res_key, return_inverse=True)
+        jump_state = np.searchsorted(keys, jump_key)
+        occupation = _keys_to_occupation(keys, N)
+        inverse_distances = np.zeros((N + self.P, N + self.P))
+        np.divide(1, self.distances[:N, :N], out=inverse_distances[:N, :N],
+                  where=self.distances[:N, :N] > 0)
+        interaction = np.zeros((len(keys), N + self.P))
+        interaction[:, :N] = -self.I_0*self.R*((~occupation) @ inverse_distances[:N, :N])
+        coulomb = self.I_0*self.R*inverse_distances
+
+        # Total rate of every state at every energy, in chunks of states
+        origin_all, destination_all = np.nonzero(self.transitions_constant > 0)
+        between_sites = (origin_all < N) | (destination_all < N)
+        origin_all = origin_all[between_sites]
+        destination_all = destination_all[between_sites]
+        constant = self.nu*self.transitions_constant[origin_all, destination_all]
+        occupied = np.ones((len(keys), N + self.P), dtype=bool)
+        occupied[:, :N] = occupation
+        empty = np.ones((len(keys), N + self.P), dtype=bool)
+        empty[:, :N] = ~occupation
+        total_rate = np.zeros((len(keys), len(energies)))
+        chunk = max(1, 2**22//max(1, len(constant)))
+        for start in range(0, len(keys), chunk):
+            states = slice(start, start + chunk)
+            possible = occupied[states][:, origin_all] & empty[states][:, destination_all]
+            for k in range(len(energies)):
+                site = interaction[states] + energies[k]
+                dE = (site[:, destination_all] - site[:, origin_all] 
+                      - coulomb[origin_all, destination_all])
+                rate = constant*np.exp(-np.maximum(dE, 0)/self.kT)
+                total_rate[states, k] = (rate*possible).sum(axis=1)
+
+        # Log weights per block
+        log_weights = np.zeros((len(energies), blocks))
+        for k in range(1, len(energies)):
+            dE = {}
+            for index, energy in [(0, energies[0]), (k, energies[k])]:
+                site_origin = interaction[jump_state, origin] + energy[origin]
+                site_destination = interaction[jump_state, destination] + energy[destination]
+                dE[index] = site_destination - site_origin - coulomb[origin, destination]
+            log_ratio = -(np.maximum(dE[k], 0) - np.maximum(dE[0], 0))/self.kT
+            log_weights[k] = (np.bincount(jump_block, weights=count*log_ratio, 
+                                          minlength=blocks)
+                              - np.bincount(res_block, minlength=blocks,
+                                            weights=res_time*(total_rate[res_state, k] 
+                                                              - total_rate[res_state, 0])))
+
+        weights = np.exp(log_weights[1:] - log_weights[1:].max(axis=1)[:, None])
+        block_charge = self._trajectory_block_charge()
+        currents = (weights @ block_charge)/(weights @ block_time)[:, None]
+        ess = weights.sum(axis=1)**2/(weights**2).sum(axis=1)
+        resimulate = ess < min_ess_fraction*blocks
+        return currents, ess, resimulate
+
+    def reweight_voltages(self, voltages, min_ess_fraction = 0.1):
+        '''
+        Like reweight, but for a list of electrode voltage vectors (length
+        P). The energies follow from voltage_gradient, so no V has to be
+        solved.
+        '''
+        if getattr(self, 'voltage_gradient', None) is None:
+            self.calc_voltage_gradient()
+        E_constants = []
+        electrode_energies = []
+        for V in voltages:
+            dV = np.asarray(V) - self.trajectory['voltages']
+            E_constants.append(self.trajectory['E_constant'] 
+                               + self.voltage_gradient[:self.N] @ dV)
+            electrode_energies.append(self.trajectory['electrode_energies'] + dV)
+        return self.reweight(E_constants, electrode_energies, 
+                             min_ess_fraction)
+
+    def record_state_histogram(self, hops = 1E6, max_states = 2**20, 
+                               top_k = 10000):
+        '''
+        Simulates with go at the current voltages and counts, for every
+        state (occupation) that is visited, the number of visits and the
+        time spent in it. How concentrated the visits are shows whether
+        state based speedups pay off for this layout: the reuse cache
+        (see use_reuse_cache) and exact solvers work well if a small set
+        of states covers most of the time.
+
+        Input arguments
+        ---------------
+        hops; int
+            The amount of hops performed.
+        max_states; int
+            At most this many different states are tracked, which bounds 
+            the memory use. Visits to states that are seen after that
+            are only counted in total.
+        top_k; int
+            Only the top_k most visited states are returned.
+
+        Output arguments
+        ----------------
+        kmc_dn.state_histogram; dict
+            'keys'; (k, ceil(N/64)) uint64 np.array
+                The packed occupation of the states, acceptor i is bit
+                i%64 of word i//64 (see 'occupations').
+            'occupations'; (k, N) bool np.array
+                The occupation of the states.
+            'counts'; (k,) int np.array
+                The visits of the states, most visited first.
+            'residence_time'; (k,) float np.array
+                The total time spent in the states.
+            'tracked_states'; int
+                The number of different states that were tracked. If it
+                is max_states, more states were visited.
+            'untracked_visits', 'untracked_time'
+                Visits to and time spent in states that were not tracked.
+            'hops', 'time'
+        kmc_dn.time
+        kmc_dn.occupation
+        kmc_dn.electrode_occupation
+        kmc_dn.current
+        kmc_dn.simulation_stats
+        '''
+        self.reset()
+        self.simulation_stats = {}
+        (self.time, self.occupation, self.electrode_occupation, keys, 
+         counts, residence_time, sizes) = callGoStateHistogram(
+            self.N, self.P, self.nu, self.kT, self.I_0, self.R, 
+            self.time, self.occupation, self.distances, self.E_constant, 
+            self.site_energies, self.transitions_constant, 
+            self.electrode_occupation, int(hops), int(max_states), 
+            int(top_k), stats=self.simulation_stats)
+        self.current = self.electrode_occupation/self.time
+        self.state_histogram = {'keys':keys,
+                                'occupations':_packed_keys_to_occupation(keys, self.N),
+                                'counts':counts,
+                                'residence_time':residence_time,
+                                'tracked_states':int(sizes[0]),
+                                'untracked_visits':int(sizes[1]),
+                                'untracked_time':sizes[2],
+                                'hops':int(hops),
+                                'time':self.time}
+        return self.state_histogram
 
     def place_dopants_random(self):
         '''
@@ -657,42 +2040,40 @@ class kmc_dn():
     def calc_distances(self):
         '''
         Calculates the distances between each hopping sites and stores them
-        in the matrix distances.
-        Also stores the unit vector in the hop direction i->j in the matrix vectors.
-        '''
-        for i in range(self.N+self.P):
-            for j in range(self.N+self.P):
-                if(i is not j):
-                    # Distance electrode -> electrode
-                    
-                    if(i >= self.N and j >= self.N):
-                        self.distances[i, j] = self.dist(self.electrodes[i - self.N, :3],
-                                                          self.electrodes[j - self.N, :3])
-                        self.vectors[i, j] = ((self.electrodes[j - self.N, :3]
-                                              - self.electrodes[i - self.N, :3])
-                                              /self.distances[i, j])
-
-                    # Distance electrodes -> acceptor
-                    elif(i >= self.N and j < self.N):
-                        self.distances[i, j] = self.dist(self.electrodes[i - self.N, :3],
-                                                          self.acceptors[j])
-                        self.vectors[i, j] = ((self.acceptors[j]
-                                              - self.electrodes[i - self.N, :3])
-                                              /self.distances[i, j])
-                    # Distance acceptor -> electrode
-                    elif(i < self.N and j >= self.N):
-                        self.distances[i, j] = self.dist(self.acceptors[i],
-                                                          self.electrodes[j - self.N, :3])
-                        self.vectors[i, j] = ((self.electrodes[j - self.N, :3]
-                                              - self.acceptors[i])
-                                              /self.distances[i, j])
-                    # Distance acceptor -> acceptor
-                    elif(i < self.N and j < self.N):
-                        self.distances[i, j] = self.dist(self.acceptors[i],
-                                                          self.acceptors[j])
-                        self.vectors[i, j] = ((self.acceptors[j]
-                                              - self.acceptors[i])
-                                              /self.distances[i, j])
+        in the matrix distances. The unit vectors in the hop directions 
+        (vectors) are only calculated when they are first used.
+        '''
+        sites = self.site_positions()
+        self.distances = np.sqrt(((sites[:, None, :] 
+                                   - sites[None, :, :])**2).sum(axis=2))
+        self._vectors = None
+
+    def site_positions(self):
+        '''
+        Returns the (N+P)x3 coordinates of all hopping sites, the 
+        acceptors followed by the electrodes.
+        '''
+        return np.concatenate((np.reshape(self.acceptors, (self.N, 3)), 
+                               self.electrodes[:, :3]))
+
+    @property
+    def vectors(self):
+        '''
+        vectors[i, j] is the unit vector pointing from site i to site j,
+        calculated from the site positions on first access after 
+        calc_distances.
+        '''
+        if getattr(self, '_vectors', None) is None:
+            sites = self.site_positions()
+            difference = sites[None, :, :] - sites[:, None, :]
+            distances = np.linalg.norm(difference, axis=2)
+            np.fill_diagonal(distances, 1)
+            self._vectors = difference/distances[:, :, None]
+        return self._vectors
+
+    @vectors.setter
+    def vectors(self, vectors):
+        self._vectors = vectors
 
     @staticmethod
     def fn_onboundary(x, on_boundary):
@@ -706,15 +2087,22 @@ class kmc_dn():
     def init_V(self):
         '''
         This function sets up various parameters for the calculation of
-        the chemical potential profile using fenics.
+        the chemical potential profile, with finite differences or 
+        fenics (see potential_backend).
         It is generally assumed that during the simulation of a 'sample'
         the following are unchanged:
         - dopant positions
         - electrode positions/number
-        Note: only 2D support for now
+        Electrodes are patches on the domain border, see electrode_axis.
+        Note: 3D is only supported by the 'fd' backend
         '''
-        # Turn off log messages
-        fn.set_log_level(logging.WARNING)
+        if self.potential_backend == 'fenics':
+            if(self.dim == 3):
+                raise ValueError("The fenics backend only supports 1D and 2D, "
+                                 "use potential_backend='fd'")
+            _import_fenics()
+            # Turn off log messages
+            fn.set_log_level(logging.WARNING)
 
         # Put electrode positions and values in a dict
         self.fn_electrodes = {}
@@ -722,11 +2110,15 @@ class kmc_dn():
             self.fn_electrodes[f'e{i}_x'] = self.electrodes[i, 0]
             if(self.dim > 1):
                 self.fn_electrodes[f'e{i}_y'] = self.electrodes[i, 1]
+            if(self.dim > 2):
+                self.fn_electrodes[f'e{i}_z'] = self.electrodes[i, 2]
             self.fn_electrodes[f'e{i}'] = self.electrodes[i, 3]
         for i in range(self.static_electrodes.shape[0]):
             self.fn_electrodes[f'es{i}_x'] = self.static_electrodes[i, 0]
             if(self.dim > 1):
                 self.fn_electrodes[f'es{i}_y'] = self.static_electrodes[i, 1]
+            if(self.dim > 2):
+                self.fn_electrodes[f'es{i}_z'] = self.static_electrodes[i, 2]
             self.fn_electrodes[f'es{i}'] = self.static_electrodes[i, 3]
 
 
@@ -760,8 +2152,63 @@ class kmc_dn():
                                            f'x[0] <= es{i}_x + {surplus} && '
                                            f'x[1] == es{i}_y ? es{i} : ')
 
+        if(self.dim == 3):
+            surplus = self.xdim/10  # Electrode modelled as square patch
+            names = ([(f'e{i}', self.electrodes[i]) for i in range(self.P)]
+                     + [(f'es{i}', self.static_electrodes[i]) 
+                        for i in range(self.static_electrodes.shape[0])])
+            for name, electrode in names:
+                axis = self.electrode_axis(electrode)
+                conditions = []
+                for d, coordinate in enumerate('xyz'):
+                    if(d == axis):
+                        conditions.append(f'x[{d}] == {name}_{coordinate}')
+                    else:
+                        conditions.append(f'x[{d}] >= {name}_{coordinate} - {surplus}')
+                        conditions.append(f'x[{d}] <= {name}_{coordinate} + {surplus}')
+                self.fn_expression += ' && '.join(conditions) + f' ? {name} : '
+
         self.fn_expression += f'{self.mu}'  # Add constant chemical potential
 
+        # Share the setup with earlier kmc_dn objects of the same geometry
+        if self.potential_backend == 'fenics':
+            attributes = FEM_ATTRIBUTES
+        else:
+            attributes = GRID_ATTRIBUTES
+        key = self.fem_key()
+        with _fem_lock:
+            cached = _fem_cache.get(key)
+            if cached is not None:
+                _fem_cache.move_to_end(key)
+        if cached is not None:
+            for attribute in attributes:
+                setattr(self, attribute, cached[attribute])
+            self.V = None
+            self.potential_basis = {'functionspace':self.potential_space(),
+                                    'fields':cached['fields']}
+            self._V_coefficients = self.potential_coefficients()
+            return
+
+        if self.potential_backend == 'fd':
+            self.init_grid_solver()
+        else:
+            self.init_fn_problem()
+        self.calc_potential_basis()
+
+        cached = {attribute:getattr(self, attribute) 
+                  for attribute in attributes}
+        cached['fields'] = self.potential_basis['fields']
+        with _fem_lock:
+            _fem_cache[key] = cached
+            while len(_fem_cache) > FEM_CACHE_SIZE:
+                _fem_cache.popitem(last=False)
+
+    def init_fn_problem(self):
+        '''
+        Sets up the fenics mesh, function space, boundary condition and
+        variational problem of V and the factorised operator, see 
+        init_fn_solver.
+        '''
         # Define boundary expression
         self.fn_boundary = fn.Expression(self.fn_expression,
                                          degree = 1,
@@ -791,44 +2238,353 @@ class kmc_dn():
         self.fn_f = fn.Constant(0)
         self.fn_L = self.fn_f*self.fn_v*fn.dx
 
-        # Solve V
+        # Assemble and factorise the operator once
         self.V = fn.Function(self.fn_functionspace)
-        fn.solve(self.fn_a == self.fn_L, self.V, self.fn_bc)
+        self.init_fn_solver()
 
-    def update_V(self):
+    def fem_key(self):
         '''
-        This function updates/recalculates V using fenics.
-        Should be called after changing electrode voltages.
+        Returns the key of the setup of V of this geometry in the process
+        wide cache: the backend, dimensions, resolution, boundary 
+        expression and electrode positions. The voltages do not matter.
         '''
-        # Update electrode values in fn_electrodes
-        for i in range(self.P):
-            self.fn_electrodes[f'e{i}'] = self.electrodes[i, 3]
-        for i in range(self.static_electrodes.shape[0]):
-            self.fn_electrodes[f'es{i}'] = self.static_electrodes[i, 3]
+        positions = np.concatenate((self.electrodes[:, :3], 
+                                    self.static_electrodes[:, :3]))
+        return (self.potential_backend, self.dim, self.xdim, self.ydim, 
+                self.zdim, self.res, self.fn_expression, positions.tobytes())
 
-        # Update boundary condition
-        self.fn_boundary = fn.Expression(self.fn_expression,
-                                         degree = 1,
-                                         **self.fn_electrodes)
-        self.fn_bc = fn.DirichletBC(self.fn_functionspace,
-                                    self.fn_boundary,
-                                    self.fn_onboundary)
+    def electrode_axis(self, electrode):
+        '''
+        Returns the axis perpendicular to the border the electrode is on:
+        x if it is at x = 0 or xdim, else y in 2D and in 3D y if it is at
+        y = 0 or ydim, else z. The electrode is the patch of that border
+        within xdim/10 of its position in the other coordinates (a point 
+        in 1D, a line segment in 2D, a square in 3D).
+        '''
+        lengths = [self.xdim, self.ydim, self.zdim]
+        for d in range(self.dim - 1):
+            if(electrode[d] == 0 or electrode[d] == lengths[d]):
+                return d
+        return self.dim - 1
 
-        # Solve V
-        fn.solve(self.fn_a == self.fn_L, self.V, self.fn_bc)
+    def potential_space(self):
+        '''
+        Returns the discretisation of V, the fenics FunctionSpace or the
+        LaplaceGrid (see potential_backend). Data derived from V, like
+        potential_basis, belongs to it.
+        '''
+        if self.potential_backend == 'fenics':
+            return getattr(self, 'fn_functionspace', None)
+        return getattr(self, 'fd_grid', None)
+
+    def init_grid_solver(self):
+        '''
+        Sets up the finite difference backend of V: fd_grid, the grid 
+        (the nodes of the fenics mesh) with the factorised Laplace 
+        operator, and fd_lifting (nodes x coefficients), the boundary 
+        values of every potential coefficient like fn_lifting of 
+        init_fn_solver. The electrodes are the boundary patches of 
+        fn_expression, where the first matching electrode wins and the
+        rest of the boundary is at mu. In 3D the grid solves with 
+        multigrid preconditioned conjugate gradients instead of a 
+        factorisation (see MultigridLaplaceGrid).
+        '''
+        lengths = [self.xdim, self.ydim, self.zdim][:self.dim]
+        cells = [int(length//self.res) for length in lengths]
+        if(self.dim == 3):
+            self.fd_grid = MultigridLaplaceGrid(lengths, cells)
+        else:
+            self.fd_grid = LaplaceGrid(lengths, cells)
+        points = self.fd_grid.points()
+
+        electrodes = np.concatenate((self.electrodes, self.static_electrodes))
+        surplus = self.xdim/10  # As in fn_expression
+        owner = np.full(self.fd_grid.size, -1)
+        for k in reversed(range(electrodes.shape[0])):
+            axis = self.electrode_axis(electrodes[k])
+            patch = points[:, axis] == electrodes[k, axis]
+            for d in range(self.dim):
+                if(d != axis):
+                    patch &= ((points[:, d] >= electrodes[k, d] - surplus)
+                              & (points[:, d] <= electrodes[k, d] + surplus))
+            owner[patch] = k
+
+        boundary = self.fd_grid.boundary
+        lifting = np.zeros((self.fd_grid.size, electrodes.shape[0] + 1))
+        nodes = np.flatnonzero(boundary & (owner >= 0))
+        lifting[nodes, owner[nodes]] = 1
+        lifting[boundary & (owner < 0), -1] = self.mu
+        self.fd_lifting = lifting
+
+    def init_fn_solver(self):
+        '''
+        Assembles the Laplace operator once, with the rows of the boundary
+        dofs replaced by identity rows, and sets up an LU solver for it.
+        The factorisation is done on the first solve and reused, as the
+        operator does not change. Only the boundary values depend on the
+        voltages, they are linear in the potential coefficients (see 
+        potential_coefficients). fn_lifting (dofs x coefficients) holds
+        the boundary values of every coefficient, so the right hand side
+        of any voltages is fn_lifting @ coefficients.
+        '''
+        self.fn_A = fn.assemble(self.fn_a)
+        self.fn_bc.apply(self.fn_A)
+        self.fn_solver = fn.LUSolver(self.fn_A)
+
+        S = self.static_electrodes.shape[0]
+        electrodes = dict(self.fn_electrodes)
+        values = np.zeros((self.fn_functionspace.dim(), self.P + S + 1))
+        for k in range(-1, self.P + S):
+            for i in range(self.P):
+                electrodes[f'e{i}'] = float(i == k)
+            for i in range(S):
+                electrodes[f'es{i}'] = float(self.P + i == k)
+            boundary = fn.Expression(self.fn_expression, degree = 1, 
+                                     **electrodes)
+            boundary_values = fn.DirichletBC(self.fn_functionspace, boundary,
+                                             self.fn_onboundary).get_boundary_values()
+            values[list(boundary_values.keys()), k] = list(boundary_values.values())
+        # Column -1 is all electrodes at 0, i.e. only mu
+        values[:, :-1] -= values[:, -1:]
+        self.fn_lifting = values
+
+    def solve_V_batch(self, coefficients):
+        '''
+        Solves V for several sets of potential coefficients (see 
+        potential_coefficients) at once, coefficients is a 
+        coefficients x m array. Every solve is a forward and back
+        substitution with the factorised operator. Returns the fields as 
+        a dofs (grid nodes) x m array.
+        '''
+        coefficients = np.reshape(coefficients, 
+                                  (len(self.potential_coefficients()), -1))
+        if self.potential_backend == 'fd':
+            return self.fd_grid.solve(self.fd_lifting @ coefficients)
+        rhs = self.fn_lifting @ coefficients
+        fields = np.zeros(rhs.shape)
+        # The solver can be shared with other kmc_dn objects, see init_V
+        with _fem_lock:
+            b = fn.Vector()
+            self.fn_A.init_vector(b, 0)
+            x = fn.Vector()
+            self.fn_A.init_vector(x, 1)
+            for m in range(rhs.shape[1]):
+                b.set_local(rhs[:, m])
+                b.apply('insert')
+                self.fn_solver.solve(x, b)
+                fields[:, m] = x.get_local()
+        return fields
+
+    def solve_V_voltages(self, voltages):
+        '''
+        Solves V for several electrode voltage vectors (m x P) at once, 
+        with the static electrodes at their current voltages. Returns the
+        fields as a dofs x m array, see solve_V_batch.
+        '''
+        voltages = np.atleast_2d(voltages)
+        coefficients = np.tile(self.potential_coefficients()[:, None], 
+                               (1, voltages.shape[0]))
+        coefficients[:self.P] = voltages.T
+        return self.solve_V_batch(coefficients)
+
+    @property
+    def V(self):
+        '''
+        The electrostatic potential, a GridFunction or (1D/2D) a fenics
+        Function, see potential_backend. After update_V the field is only built from the superposition basis 
+        when it is used, e.g. for plotting.
+        '''
+        if getattr(self, '_V_coefficients', None) is not None:
+            values = self.potential_basis['fields'] @ self._V_coefficients
+            if self.potential_backend == 'fd':
+                self._V = GridFunction(self.fd_grid, values)
+            else:
+                if getattr(self, '_V', None) is None:
+                    self._V = fn.Function(self.fn_functionspace)
+                self._V.vector().set_local(values)
+                self._V.vector().apply('insert')
+            self._V_coefficients = None
+        return getattr(self, '_V', None)
+
+    @V.setter
+    def V(self, V):
+        self._V = V
+        self._V_coefficients = None
+
+    def solve_V(self):
+        '''
+        Solves V for the current electrode voltages, without the 
+        superposition basis.
+        '''
+        values = self.solve_V_batch(self.potential_coefficients())[:, 0]
+        self._V_coefficients = None
+        if self.potential_backend == 'fd':
+            self._V = GridFunction(self.fd_grid, values)
+        else:
+            self._V.vector().set_local(values)
+            self._V.vector().apply('insert')
+
+    def potential_coefficients(self):
+        '''
+        Returns the coefficients of the superposition basis of V, the
+        electrode voltages, the static electrode voltages and 1 (for the
+        chemical potential mu at the rest of the boundary).
+        '''
+        return np.concatenate((self.electrodes[:, 3], 
+                               self.static_electrodes[:, 3], [1.0]))
+
+    def calc_potential_basis(self):
+        '''
+        V is linear in the electrode voltages, 
+            V = sum_k V_k phi_k + phi_mu,
+        where phi_k is the potential with electrode k at 1 and all other
+        (static) electrodes and mu at 0, and phi_mu the potential with all
+        electrodes at 0. This calculates these fields (P + static 
+        electrodes + 1 solves) once per geometry and stores them in 
+        potential_basis['fields'] (dofs x coefficients, see 
+        potential_coefficients). update_V then only takes a matrix-vector
+        product.
+        '''
+        fields = self.solve_V_batch(np.eye(len(self.potential_coefficients())))
+        self.potential_basis = {'functionspace':self.potential_space(),
+                                'fields':fields}
+        self._V_coefficients = self.potential_coefficients()
+
+    def has_potential_basis(self):
+        '''
+        Whether potential_basis is calculated for the current geometry.
+        '''
+        basis = getattr(self, 'potential_basis', None)
+        return (basis is not None 
+                and basis['functionspace'] is self.potential_space())
+
+    def potential_basis_acceptors(self):
+        '''
+        Returns the superposition basis of V sampled at the acceptors, 
+        N x coefficients, see calc_potential_basis.
+        '''
+        dofs, weights = self.fn_interpolation()
+        basis = self.potential_basis
+        if basis.get('dofs') is not dofs:
+            # A new dict, the old one can be shared with copies
+            basis = dict(basis, dofs=dofs, 
+                         acceptors=np.einsum('ij,ijk->ik', weights, 
+                                             basis['fields'][dofs]))
+            self.potential_basis = basis
+        return basis['acceptors']
+
+    def update_V(self):
+        '''
+        This function updates V and E_constant for the current electrode
+        voltages. Should be called after changing electrode voltages.
+        The first call per geometry calculates the superposition basis 
+        (see calc_potential_basis), after that it is a matrix-vector 
+        product.
+        '''
+        if not self.has_potential_basis():
+            self.calc_potential_basis()
+        self._V_coefficients = self.potential_coefficients()
 
         # Update constant energy
         self.calc_E_constant()
 
 
+    def calc_voltage_gradient(self):
+        '''
+        Calculates voltage_gradient, the (N+P)xP matrix of derivatives of
+        the acceptor and electrode energies to the electrode voltages.
+        E_constant is linear in the voltages, so column k is eV_constant
+        with electrode k at 1 and all other (static) electrodes at 0,
+        which is column k of the superposition basis of V.
+        '''
+        if not self.has_potential_basis():
+            self.calc_potential_basis()
+        self.voltage_gradient = np.zeros((self.N + self.P, self.P))
+        self.voltage_gradient[self.N:] = np.eye(self.P)
+        self.voltage_gradient[:self.N] = self.potential_basis_acceptors()[:, :self.P]
+
     def calc_transitions_constant(self):
         '''
         Calculates the constant (position dependent part) of the MA rate.
         This function puts the constant rate to 0 for transitions i -> j
         '''
         self.transitions_constant = self.nu*np.exp(-2 * self.distances/self.ab)
-        self.transitions_constant -= np.eye(self.transitions.shape[0])
+        self.transitions_constant -= np.eye(self.N + self.P)
+
+
+    def fn_interpolation(self):
+        '''
+        Returns the interpolation of the discretisation of V (see
+        potential_space) at the acceptor positions as (dofs, weights), 
+        both N x (dofs per cell) arrays, such that V at acceptor i is 
+        sum(weights[i]*V_values[dofs[i]]). Point location is only done 
+        when the acceptors or the discretisation changed, evaluating V at
+        all acceptors is then a single vectorised operation instead of N
+        calls to V.
+        '''
+        cached = getattr(self, '_fn_interpolation', None)
+        acceptors = np.array(self.acceptors[:, :self.dim], copy=True)
+        if (cached is not None 
+                and cached['functionspace'] is self.potential_space()
+                and np.array_equal(cached['acceptors'], acceptors)):
+            return cached['dofs'], cached['weights']
+
+        if self.potential_backend == 'fd':
+            dofs, weights = self.fd_grid.interpolation(acceptors)
+        else:
+            element = self.fn_functionspace.element()
+            dofs = np.zeros((self.N, element.space_dimension()), dtype=int)
+            weights = np.zeros((self.N, element.space_dimension()))
+            for i in range(self.N):
+                dofs[i], weights[i] = self.fn_locate(acceptors[i])
+        self._fn_interpolation = {'functionspace':self.potential_space(),
+                                  'acceptors':acceptors,
+                                  'dofs':dofs, 'weights':weights}
+        return dofs, weights
+
+    def fn_locate(self, position):
+        '''
+        Returns the interpolation of the discretisation of V at a single
+        position (dim coordinates) as (dofs, weights), see 
+        fn_interpolation.
+        '''
+        if self.potential_backend == 'fd':
+            dofs, weights = self.fd_grid.interpolation(position)
+            return dofs[0], weights[0]
+        point = fn.Point(*position)
+        tree = self.fn_mesh.bounding_box_tree()
+        cell_index = tree.compute_first_entity_collision(point)
+        if cell_index >= self.fn_mesh.num_cells():
+            # Slightly outside the mesh, use the nearest cell
+            cell_index, _ = tree.compute_closest_entity(point)
+        cell = fn.Cell(self.fn_mesh, cell_index)
+        weights = self.fn_functionspace.element().evaluate_basis_all(
+                position, cell.get_vertex_coordinates(), cell.orientation())
+        return self.fn_functionspace.dofmap().cell_dofs(cell_index), weights
+
+    def calc_potential_acceptors(self):
+        '''
+        Returns the electrostatic potential V at all acceptor positions.
+        '''
+        if self.has_potential_basis():
+            return self.potential_basis_acceptors() @ self.potential_coefficients()
+        dofs, weights = self.fn_interpolation()
+        if self.potential_backend == 'fd':
+            values = self.V.values
+        else:
+            values = self.V.vector().get_local()
+        return (weights*values[dofs]).sum(axis=1)
 
+    def calc_compensation_acceptors(self):
+        '''
+        Returns the Coulomb energy of every acceptor due to all donors 
+        (compensation charges).
+        '''
+        if(self.M == 0):
+            return np.zeros((self.N,))
+        distances = np.sqrt(((self.acceptors[:, None, :3] 
+                              - self.donors[None, :, :3])**2).sum(axis=2))
+        return self.I_0*self.R*(1/distances).sum(axis=1)
 
     def calc_E_constant_V(self):
         '''
@@ -837,26 +2593,9 @@ class kmc_dn():
         potential V.
         Also fixes the electrode energies in site_energies.
         '''
-        # Initialization
-        self.eV_constant = np.zeros((self.N,))
+        self.eV_constant = self.calc_potential_acceptors()
         self.comp_constant = np.zeros((self.N,))
 
-        for i in range(self.N):
-            # Add electrostatic potential
-            if(self.dim == 1):
-                self.eV_constant[i] += self.V(self.acceptors[i, 0])
-
-            if(self.dim == 2):
-                self.eV_constant[i] += self.V(self.acceptors[i, 0], self.acceptors[i, 1])
-
-            if(self.dim == 3):
-                x = self.acceptors[i, 0]/self.xdim * (self.V.shape[0] - 3) + 1
-                y = self.acceptors[i, 1]/self.ydim * (self.V.shape[1] - 3) + 1
-                z = self.acceptors[i, 2]/self.zdim * (self.V.shape[2] - 3) + 1
-                self.eV_constant[i] += self.e*self.V[int(round(x)),
-                                                    int(round(y)),
-                                                    int(round(z))]
-
         self.E_constant = self.eV_constant
 
         # Calculate electrode energies
@@ -869,34 +2608,126 @@ class kmc_dn():
         V and of Coulomb interaction between the site and compensation charges.
         Also fixes the electrode energies in site_energies.
         '''
-        # Initialization
-        self.eV_constant = np.zeros((self.N,))
-        self.comp_constant = np.zeros((self.N,))
+        self.eV_constant = self.calc_potential_acceptors()
+        self.comp_constant = self.calc_compensation_acceptors()
 
-        for i in range(self.N):
-            # Add electrostatic potential
-            if(self.dim == 1):
-                self.eV_constant[i] += self.V(self.acceptors[i, 0])
-
-            if(self.dim == 2):
-                self.eV_constant[i] += self.V(self.acceptors[i, 0], self.acceptors[i, 1])
+        self.E_constant = self.eV_constant + self.comp_constant
 
-            if(self.dim == 3):
-                x = self.acceptors[i, 0]/self.xdim * (self.V.shape[0] - 3) + 1
-                y = self.acceptors[i, 1]/self.ydim * (self.V.shape[1] - 3) + 1
-                z = self.acceptors[i, 2]/self.zdim * (self.V.shape[2] - 3) + 1
-                self.eV_constant[i] += self.e*self.V[int(round(x)),
-                                                    int(round(y)),
-                                                    int(round(z))]
+        # Calculate electrode energies
+        self.site_energies[self.N:] = self.electrodes[:, 3]
 
-            # Add compensation
-            self.comp_constant[i] += self.I_0*self.R* sum(
-                    1/self.dist(self.acceptors[i], self.donors[k]) for k in range(self.M))
+    #%% Dopant moves
+    def apply_move(self, site, new_pos):
+        '''
+        Moves a single dopant and updates what depends on its position in
+        O(N), instead of initialize. For an acceptor these are its row and
+        column of distances and transitions_constant (and of vectors and 
+        voltage_gradient, if calculated) and its potential, for a donor
+        the compensation energy of every acceptor. E_constant is updated
+        for the current voltages. The first move on a Device copies its
+        pair matrices once (see Device.own). The move can be reverted with
+        undo, e.g. when an annealing step is rejected.
 
+        Input arguments
+        ===============
+        site; int
+            The dopant to move, acceptor site if site < N, else donor 
+            site - N.
+        new_pos; sequence of floats
+            The new coordinates, coordinates that are not given (e.g. z of
+            a 2D device) are kept.
+        '''
+        if not 0 <= site < self.N + self.M:
+            raise ValueError("site must be an acceptor or donor index, "
+                             "0 <= site < N + M")
+        acceptor = site < self.N
+        dopants = self.acceptors if acceptor else self.donors
+        index = site if acceptor else site - self.N
+        position = dopants[index].copy()
+        position[:len(new_pos)] = new_pos
+
+        move = {'site':site, 'position':dopants[index].copy(),
+                'eV_constant':self.eV_constant, 
+                'comp_constant':self.comp_constant, 
+                'E_constant':self.E_constant}
+        dopants[index] = position
+        compensation = (getattr(self.calc_E_constant, '__func__', None) 
+                        is kmc_dn.calc_E_constant_V_comp and self.M > 0)
+        comp_constant = self.comp_constant.copy()
+        if acceptor:
+            device = self._writable_device()
+            difference = self.site_positions() - position
+            distances = np.sqrt((difference**2).sum(axis=1))
+            rows = {'distances':distances}
+            rows['transitions_constant'] = self.nu*np.exp(-2*distances/self.ab)
+            rows['transitions_constant'][site] -= 1
+            if getattr(self, '_vectors', None) is not None:
+                norms = distances.copy()
+                norms[site] = 1
+                rows['_vectors'] = difference/norms[:, None]
+            for name, row in rows.items():
+                array = device.own(name)
+                move[name] = array[site].copy()
+                array[site] = row
+                array[:, site] = -row if name == '_vectors' else row
+
+            if getattr(self, '_fn_interpolation', None) is not None:
+                move['_fn_interpolation'] = self._fn_interpolation
+                move['potential_basis'] = getattr(self, 'potential_basis', None)
+                cached = {key:(value.copy() if isinstance(value, np.ndarray) 
+                               else value) 
+                          for key, value in self._fn_interpolation.items()}
+                cached['acceptors'][site] = position[:self.dim]
+                cached['dofs'][site], cached['weights'][site] = self.fn_locate(
+                        cached['acceptors'][site])
+                self._fn_interpolation = cached
+            self.eV_constant = self.calc_potential_acceptors()
+            if compensation:
+                comp_constant[site] = self.I_0*self.R*(1/np.sqrt(
+                        ((self.donors[:, :3] - position)**2).sum(axis=1))).sum()
+
+            if getattr(self, 'voltage_gradient', None) is not None:
+                move['voltage_gradient'] = self.voltage_gradient
+                if self.has_potential_basis():
+                    self.voltage_gradient = self.voltage_gradient.copy()
+                    self.voltage_gradient[site] = self.potential_basis_acceptors()[site, :self.P]
+                else:
+                    self.voltage_gradient = None
+        elif compensation:
+            old = np.sqrt(((self.acceptors[:, :3] - move['position'])**2).sum(axis=1))
+            new = np.sqrt(((self.acceptors[:, :3] - position)**2).sum(axis=1))
+            comp_constant += self.I_0*self.R*(1/new - 1/old)
+        self.comp_constant = comp_constant
         self.E_constant = self.eV_constant + self.comp_constant
 
-        # Calculate electrode energies
-        self.site_energies[self.N:] = self.electrodes[:, 3]
+        if getattr(self, '_moves', None) is None:
+            self._moves = []
+        self._moves.append(move)
+        self._network_cache = None
+
+    def undo(self):
+        '''
+        Reverts the last apply_move that was not undone yet, restoring the
+        previous values exactly. Moves from before the last initialize or
+        copy can not be undone.
+        '''
+        if not getattr(self, '_moves', None):
+            raise ValueError("There is no move to undo")
+        move = self._moves.pop()
+        site = move.pop('site')
+        if site < self.N:
+            self.acceptors[site] = move.pop('position')
+        else:
+            self.donors[site - self.N] = move.pop('position')
+        for name in ('distances', 'transitions_constant', '_vectors'):
+            if name in move:
+                row = move.pop(name)
+                array = self._writable_device().own(name)
+                array[site] = row
+                array[:, site] = -row if name == '_vectors' else row
+        for name, value in move.items():
+            setattr(self, name, value)
+        self._network_cache = None
 
 
     #%% Load methods
@@ -942,10 +2773,12 @@ class kmc_dn():
 
     def saveSelf(self, fileName, rel_path = False):
         '''
-        Save the entire class object as a .kmc file. Also saves
+        Save the primary inputs and results of this object (see 
+        device_data) as a .kmc device file (see device_file). Also saves
         the current value as the attribute expected_current.
         This function can be used to generate test cases, or simply
-        to save a simulation object for future reference.
+        to save a simulation object for future reference. Many objects
+        can be saved to a single file with save_devices.
         '''
         if hasattr(self, "current"):
             setattr(self, "expected_current", self.current)
@@ -954,28 +2787,54 @@ class kmc_dn():
             abs_file_path = os.path.join(script_dir, fileName)
         else:
             abs_file_path = fileName
-        with open(abs_file_path, "wb") as f:
-            d = {}
-            for key in dir(self):
-                attr = getattr(self, key)
-                if isinstance(attr, (list, tuple, int, float, np.ndarray)):
-                    d[key] = getattr(self, key)
-            pickle.dump(d, f)
+        name = os.path.splitext(os.path.basename(abs_file_path))[0]
+        device_file.write_devices(abs_file_path, [(name, self.device_data())])
     
     def loadSelf(self, fileName, rel_path = False):
         '''
-        Load a .kmc object saved with self.saveSelf()
+        Load a .kmc object saved with self.saveSelf(), either a device 
+        file (the first device in it) or a pickled object of earlier 
+        versions.
         '''
         if rel_path:
             script_dir = os.path.dirname(__file__)
             abs_file_path = os.path.join(script_dir, fileName)
         else:
             abs_file_path = fileName
-        with open(abs_file_path, "rb") as f:
-            d = pickle.load(f)
-            for key in d:
-                setattr(self, key, d[key])
-        self.initialize(dopant_placement=False, charge_placement=False)
+        self.set_device_data(_read_device_file(abs_file_path)[0][1])
+
+    def device_data(self):
+        '''
+        Returns the primary inputs and results of this object as a dict:
+        all list, tuple, int, float and np.array attributes except the
+        ones initialize derives from them (DERIVED_ATTRIBUTES), and the
+        names of potential_backend and calc_E_constant.
+        '''
+        data = {}
+        for key in list(self.__dict__) + STATE_ATTRIBUTES:
+            if key.startswith('_') or key in DERIVED_ATTRIBUTES:
+                continue
+            value = getattr(self, key, None)
+            if isinstance(value, (list, tuple, int, float, np.ndarray)):
+                data[key] = value
+        if hasattr(self, 'potential_backend'):
+            data['potential_backend'] = self.potential_backend
+        if hasattr(self, 'calc_E_constant'):
+            data['calc_E_constant'] = self.calc_E_constant.__name__
+        return data
+
+    def set_device_data(self, data, initialize = True):
+        '''
+        Sets the attributes in data (see device_data) and, unless 
+        initialize is False, initializes this object for them without
+        placing dopants or charges.
+        '''
+        for key, value in data.items():
+            if key == 'calc_E_constant':
+                value = getattr(self, value)
+            setattr(self, key, value)
+        if initialize:
+            self.initialize(dopant_placement=False, charge_placement=False)
 
     #%% Miscellaneous methods
 
@@ -1081,3 +2940,97 @@ class kmc_dn():
         self.time += self.timestep
                 
                 
+
+def _read_device_file(fileName, names = None, mmap = False):
+    '''
+    Reads a device file as a list of (name, attributes), see 
+    device_file.read_devices. A pickled .kmc object of earlier versions
+    is read as a single device named after the file.
+    '''
+    if device_file.is_device_file(fileName):
+        return device_file.read_devices(fileName, names, mmap)
+    with open(fileName, "rb") as f:
+        data = pickle.load(f)
+    return [(os.path.splitext(os.path.basename(fileName))[0], data)]
+
+def save_devices(fileName, dns, names = None):
+    '''
+    Saves several kmc_dn objects (e.g. a test suite) to a single device
+    file, each as by saveSelf.
+
+    Input arguments
+    ===============
+    fileName; string
+        The device file.
+    dns; list of kmc_dn
+        The objects to save.
+    names; list of strings
+        The names of the objects in the index of the file.
+        default: '0', '1', ...
+    '''
+    if names is None:
+        names = [str(i) for i in range(len(dns))]
+    devices = []
+    for name, dn in zip(names, dns):
+        if hasattr(dn, "current"):
+            setattr(dn, "expected_current", dn.current)
+        devices.append((name, dn.device_data()))
+    device_file.write_devices(fileName, devices)
+
+def load_devices(fileName, names = None, mmap = False, initialize = True):
+    '''
+    Loads the kmc_dn objects of a device file, see save_devices. 
+
+    Input arguments
+    ===============
+    fileName; string
+        The device file, or a single pickled .kmc object.
+    names; list of strings
+        Only load these objects, in this order (see 
+        device_file.read_header for the index). default: all objects.
+    mmap; bool
+        Memory map the arrays (copy-on-write) instead of reading them.
+    initialize; bool
+        Initialize the objects (distances, V, E_constant, ...). Without
+        it loading takes milliseconds, but the objects have to be 
+        initialized before simulating.
+
+    Output arguments
+    ================
+    dns; list of kmc_dn
+    '''
+    dns = []
+    for name, data in _read_device_file(fileName, names, mmap):
+        dn = kmc_dn.__new__(kmc_dn)
+        dn.potential_backend = 'fd'
+        dn.calc_E_constant = dn.calc_E_constant_V_comp
+        dn.time = 0
+        dn.set_device_data(data, initialize)
+        dns.append(dn)
+    return dns
+
+def pack_device_files(fileNames, packedFileName, names = None):
+    '''
+    Packs .kmc files (device files or pickled objects of earlier 
+    versions) into a single device file, without the attributes that 
+    initialize derives (DERIVED_ATTRIBUTES). Only the files are read, no
+    kmc_dn is initialized. names defaults to the file names without
+    extension, the devices of a file with several get name/device name.
+    '''
+    if names is None:
+        names = [os.path.splitext(os.path.basename(fileName))[0]
+                 for fileName in fileNames]
+    devices = []
+    for name, fileName in zip(names, fileNames):
+        packed = _read_device_file(fileName)
+        for inner, data in packed:
+            data = {key:value for key, value in data.items() 
+                    if key not in DERIVED_ATTRIBUTES}
+            devices.append((name if len(packed) == 1 else f'{name}/{inner}',
+                            data))
+    device_file.write_devices(packedFileName, devices)
+
+for _name in DEVICE_ATTRIBUTES:
+    setattr(kmc_dn, _name, _device_property(_name))
+for _name in STATE_ATTRIBUTES:
+    setattr(kmc_dn, _name, _state_property(_name))
@@ -10,7 +10,6 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
 import itertools
-import fenics as fn
 import time
 import math
 
@@ -568,8 +567,6 @@ def validate_boltzmann(kmc_dn, hops = 1000, n = 2, points = 100, mu = 1,
                                  kmc_dn.N + kmc_dn.electrodes.shape[0]))
     kmc_dn.distances = np.zeros((kmc_dn.N + kmc_dn.electrodes.shape[0],
                                kmc_dn.N + kmc_dn.electrodes.shape[0]))
-    kmc_dn.vectors = np.zeros((kmc_dn.N + kmc_dn.electrodes.shape[0],
-                             kmc_dn.N + kmc_dn.electrodes.shape[0], 3))
     kmc_dn.site_energies = np.zeros((kmc_dn.N + kmc_dn.electrodes.shape[0],))
     kmc_dn.problist = np.zeros((kmc_dn.N+kmc_dn.P)**2)
     kmc_dn.electrode_occupation = np.zeros(kmc_dn.P, dtype=int)
@@ -652,32 +649,14 @@ def IV(kmc_dn, electrode, voltagelist,
     voltages = len(voltagelist)
     currentlist = np.zeros((kmc_dn.P, voltages))
 
-    # Check if any other electrode is non-zero
-    zero = sum(kmc_dn.electrodes[:, 3]) - kmc_dn.electrodes[electrode, 3]
-    zero = (zero == 0)
-
-    # If all other electrodes are zero, calculate V profile only once!
-    if(zero):
-        V0 = voltagelist[0]
-        kmc_dn.electrodes[electrode, 3] = voltagelist[0]
-        kmc_dn.update_V()
-        eVref = kmc_dn.eV_constant.copy()
-
     for i in range(voltages):
         # Measure time for second voltage to estimate total time
         if(i == 1):
             tic = time.time()
 
-        # If all electrodes zero, only explicitly update E_constant
-        if(zero):
-            kmc_dn.eV_constant = eVref * voltagelist[i]/V0
-            kmc_dn.electrodes[electrode, 3] = voltagelist[i]
-            kmc_dn.E_constant = kmc_dn.eV_constant + kmc_dn.comp_constant
-            kmc_dn.site_energies[kmc_dn.N + electrode] = voltagelist[i]
-        # Otherwise recalculate V
-        else:
-            kmc_dn.electrodes[electrode, 3] = voltagelist[i]
-            kmc_dn.update_V()
+        # update_V only takes a matrix-vector product after the first call
+        kmc_dn.electrodes[electrode, 3] = voltagelist[i]
+        kmc_dn.update_V()
 
         if(discrete):
             kmc_dn.go_simulation(hops = hops, prehops = prehops,
@@ -692,6 +671,42 @@ def IV(kmc_dn, electrode, voltagelist,
             print(f'Estimated time for IV curve: {(time.time()-tic)*voltages} seconds')
     return currentlist
 
+def voltage_map(kmc_dn, electrode_a, electrode_b, axis_a, axis_b,
+                hops = 1E6, block_hops = 1000, min_ess_fraction = 0.1):
+    '''
+    Measures the currents on a grid of voltages on two electrodes, like
+    the single_shot_map experiments. Instead of simulating every grid
+    point, a trajectory is recorded at one point and the currents at the
+    following points are estimated by reweighting it
+    (kmc_dn.reweight_voltages). A new trajectory is recorded as soon as the
+    effective sample size becomes too small. The grid is walked row by row
+    in alternating direction, so consecutive points are neighbours.
+    Returns the currents (len(axis_a) x len(axis_b) x P) and a boolean map
+    of the grid points that were simulated.
+    '''
+    currents = np.zeros((len(axis_a), len(axis_b), kmc_dn.P))
+    simulated = np.zeros((len(axis_a), len(axis_b)), dtype=bool)
+    have_trajectory = False
+    for ii in range(len(axis_a)):
+        order = range(len(axis_b)) if ii % 2 == 0 else reversed(range(len(axis_b)))
+        for jj in order:
+            voltages = kmc_dn.electrodes[:, 3].copy()
+            voltages[electrode_a] = axis_a[ii]
+            voltages[electrode_b] = axis_b[jj]
+            if have_trajectory:
+                current, _, resimulate = kmc_dn.reweight_voltages(
+                        [voltages], min_ess_fraction)
+            if not have_trajectory or resimulate[0]:
+                kmc_dn.electrodes[:, 3] = voltages
+                kmc_dn.update_V()
+                kmc_dn.record_trajectory(hops = hops, block_hops = block_hops)
+                have_trajectory = True
+                simulated[ii, jj] = True
+                currents[ii, jj] = kmc_dn.current
+            else:
+                currents[ii, jj] = current[0]
+    return currents, simulated
+
 def getPosition(kmc_dn, index):
     if index < len(kmc_dn.acceptors):
         return (kmc_dn.acceptors[index][0], kmc_dn.acceptors[index][1])
@@ -0,0 +1,323 @@
+'''
+Finite difference discretisation of the Laplace equation on a box, the
+default alternative to fenics for the electrostatic potential V of kmc_dn
+(see kmc_dn.init_V and the potential_backend keyword argument).
+
+The potential is represented by its values on the nodes of a uniform
+grid. Boundary nodes have Dirichlet values, interior nodes satisfy the
+standard (2*dim + 1)-point stencil. The operator does not depend on the
+voltages, so it is factorised once (scipy.sparse.linalg.splu) and every
+solve is a forward and back substitution. On the uniform grids of fenics'
+IntervalMesh/RectangleMesh this stencil equals the P1 finite element
+operator, so the node values agree with the fenics backend. Between the
+nodes V is interpolated (bi/tri)linearly.
+
+In 3D a direct factorisation fills in too much, MultigridLaplaceGrid
+instead solves with conjugate gradients preconditioned by a geometric
+multigrid V-cycle, whose hierarchy is set up once per grid.
+'''
+
+import itertools
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+
+
+class LaplaceGrid():
+    def __init__(self, lengths, cells):
+        '''
+        =======================
+        LaplaceGrid
+        =======================
+        A uniform grid on the box [0, lengths[0]] x [0, lengths[1]] ...
+        with the factorised finite difference Laplace operator.
+        Node (i, j, ...) has index np.ravel_multi_index((i, j, ...),
+        shape).
+
+        Input arguments
+        ===============
+        lengths; list of floats
+            Size of the box per dimension, e.g. [xdim, ydim].
+        cells; list of ints
+            Number of grid cells per dimension.
+        '''
+        self.lengths = np.array(lengths, dtype=float)
+        self.cells = np.array(cells, dtype=int)
+        self.dim = len(self.cells)
+        self.shape = tuple(self.cells + 1)
+        self.size = int(np.prod(self.shape))
+        self.spacing = self.lengths/self.cells
+        self.axes = [np.linspace(0, length, n + 1)
+                     for length, n in zip(self.lengths, self.cells)]
+
+        boundary = np.zeros(self.shape, dtype=bool)
+        for d in range(self.dim):
+            index = [slice(None)]*self.dim
+            index[d] = [0, -1]
+            boundary[tuple(index)] = True
+        self.boundary = boundary.ravel()
+
+        self.operator = self.laplace_operator()
+        self.setup_solver()
+
+    def setup_solver(self):
+        '''
+        Factorises the operator, see solve.
+        '''
+        self.solver = spla.splu(self.operator)
+
+    def points(self):
+        '''
+        Returns the coordinates of all nodes, size x dim.
+        '''
+        grids = np.meshgrid(*self.axes, indexing='ij')
+        return np.stack([grid.ravel() for grid in grids], axis=1)
+
+    def laplace_operator(self):
+        '''
+        Returns the finite difference Laplace operator as a sparse
+        size x size matrix, with the rows of the boundary nodes replaced
+        by identity rows (Dirichlet values).
+        '''
+        interior = sp.diags((~self.boundary).astype(float))
+        return (interior @ self.laplacian()
+                + sp.diags(self.boundary.astype(float))).tocsc()
+
+    def laplacian(self):
+        '''
+        Returns the (2*dim + 1)-point Laplacian of all nodes as a sparse
+        size x size matrix, without boundary conditions.
+        '''
+        operator = sp.csr_matrix((self.size, self.size))
+        for d in range(self.dim):
+            second = sp.diags([1.0, -2.0, 1.0], [-1, 0, 1],
+                              shape=(self.shape[d], self.shape[d]))
+            term = sp.identity(1)
+            for e in range(self.dim):
+                term = sp.kron(term, second if e == d
+                               else sp.identity(self.shape[e]), format='csr')
+            operator = operator + term/self.spacing[d]**2
+        return operator
+
+    def solve(self, rhs):
+        '''
+        Solves the potential for the right hand side(s) rhs, size or
+        size x m, which is the Dirichlet value for boundary nodes and 0
+        for interior nodes.
+        '''
+        return self.solver.solve(np.asarray(rhs, dtype=float))
+
+    def interpolation(self, points):
+        '''
+        Returns the multilinear interpolation at points (n x dim or more
+        columns, the extra ones are ignored) as (dofs, weights), both
+        n x 2**dim arrays, such that V at point i is
+        sum(weights[i]*values[dofs[i]]). Points outside the box are
+        extrapolated from the nearest cell.
+        '''
+        points = np.atleast_2d(points)[:, :self.dim]
+        scaled = points/self.spacing
+        lower = np.clip(np.floor(scaled).astype(int), 0, self.cells - 1)
+        fraction = scaled - lower
+        dofs = np.zeros((len(points), 2**self.dim), dtype=int)
+        weights = np.zeros((len(points), 2**self.dim))
+        for c, corner in enumerate(itertools.product([0, 1], repeat=self.dim)):
+            corner = np.array(corner, dtype=bool)
+            dofs[:, c] = np.ravel_multi_index(tuple((lower + corner).T),
+                                              self.shape)
+            weights[:, c] = np.prod(np.where(corner, fraction, 1 - fraction),
+                                    axis=1)
+        return dofs, weights
+
+
+class MultigridLaplaceGrid(LaplaceGrid):
+    def __init__(self, lengths, cells, tolerance=1E-10, max_iterations=200,
+                 smoothing_steps=2, coarsest_size=1000):
+        '''
+        =======================
+        MultigridLaplaceGrid
+        =======================
+        A LaplaceGrid that solves with conjugate gradients on the interior
+        nodes, preconditioned by a multigrid V-cycle. The coarse grids 
+        take every other node per dimension, with linear interpolation
+        between them and Galerkin coarse operators. The smoother is 
+        weighted Jacobi, so the V-cycle is symmetric. The hierarchy is
+        set up once, a solve then takes ~10-20 iterations, independent of
+        the grid size.
+
+        Input arguments
+        ===============
+        lengths; list of floats
+            Size of the box per dimension, e.g. [xdim, ydim, zdim].
+        cells; list of ints
+            Number of grid cells per dimension.
+        tolerance; float
+            Relative residual at which conjugate gradients stops.
+        max_iterations; int
+            Maximum number of conjugate gradient iterations.
+        smoothing_steps; int
+            Number of Jacobi steps before and after the coarse grid 
+            correction.
+        coarsest_size; int
+            The coarsest level has at most this many nodes and is solved
+            directly.
+        '''
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.smoothing_steps = smoothing_steps
+        self.coarsest_size = coarsest_size
+        super().__init__(lengths, cells)
+
+    def setup_solver(self):
+        '''
+        Sets up the interior system (the negative Laplacian, symmetric 
+        positive definite) and the multigrid hierarchy.
+        '''
+        self.interior = np.flatnonzero(~self.boundary)
+        laplacian = self.laplacian().tocsr()[self.interior]
+        # Couples the boundary values into the interior equations
+        self.coupling = laplacian[:, self.boundary].tocsr()
+        operator = -laplacian[:, self.interior].tocsr()
+
+        self.levels = []
+        coordinates = list(self.axes)
+        while True:
+            diagonal = operator.diagonal()
+            level = {'operator':operator, 'inverse_diagonal':1/diagonal}
+            self.levels.append(level)
+            coarse = [_coarsen(axis) for axis in coordinates]
+            if (operator.shape[0] <= self.coarsest_size
+                    or all(len(c) == len(axis) for c, axis in zip(coarse, coordinates))):
+                level['solver'] = spla.splu(operator.tocsc())
+                break
+            prolongation = sp.identity(1, format='csr')
+            for axis, coarse_axis in zip(coordinates, coarse):
+                prolongation = sp.kron(prolongation, 
+                                       _prolongation(axis, coarse_axis), 
+                                       format='csr')
+            level['prolongation'] = prolongation
+            level['restriction'] = prolongation.T.tocsr()
+            level['weight'] = 4/(3*_jacobi_radius(operator, diagonal))
+            operator = (level['restriction'] @ operator @ prolongation).tocsr()
+            coordinates = coarse
+
+    def v_cycle(self, residual, index=0):
+        '''
+        Applies the multigrid preconditioner to residual (nodes x m) on
+        level index.
+        '''
+        level = self.levels[index]
+        if 'solver' in level:
+            return level['solver'].solve(residual)
+        operator = level['operator']
+        step = level['weight']*level['inverse_diagonal'][:, None]
+        x = step*residual
+        for _ in range(self.smoothing_steps - 1):
+            x += step*(residual - operator @ x)
+        x += level['prolongation'] @ self.v_cycle(
+                level['restriction'] @ (residual - operator @ x), index + 1)
+        for _ in range(self.smoothing_steps):
+            x += step*(residual - operator @ x)
+        return x
+
+    def solve(self, rhs):
+        '''
+        Solves the potential for the right hand side(s) rhs, size or
+        size x m, which is the Dirichlet value for boundary nodes (the 
+        interior values are ignored). The columns are solved together by
+        independent conjugate gradient iterations.
+        '''
+        rhs = np.asarray(rhs, dtype=float)
+        values = np.reshape(rhs, (self.size, -1)).copy()
+        values[self.interior] = 0
+        b = self.coupling @ values[self.boundary]
+        operator = self.levels[0]['operator']
+
+        x = np.zeros(b.shape)
+        r = b.copy()
+        z = self.v_cycle(r)
+        p = z.copy()
+        rz = (r*z).sum(axis=0)
+        target = self.tolerance*np.linalg.norm(b, axis=0)
+        for iteration in range(self.max_iterations):
+            if np.all(np.linalg.norm(r, axis=0) <= target):
+                break
+            q = operator @ p
+            alpha = np.divide(rz, (p*q).sum(axis=0), 
+                              out=np.zeros_like(rz), where=rz != 0)
+            x += alpha*p
+            r -= alpha*q
+            z = self.v_cycle(r)
+            rz_new = (r*z).sum(axis=0)
+            beta = np.divide(rz_new, rz, out=np.zeros_like(rz), where=rz != 0)
+            p = z + beta*p
+            rz = rz_new
+        else:
+            if np.any(np.linalg.norm(r, axis=0) > target):
+                raise RuntimeError("Multigrid solve did not converge in "
+                                   f"{self.max_iterations} iterations")
+        values[self.interior] = x
+        return values.reshape(rhs.shape)
+
+
+def _coarsen(axis):
+    '''
+    Returns the node coordinates of the coarse grid of axis: every other
+    node and the last one.
+    '''
+    if len(axis) <= 3:
+        return axis
+    return axis[np.unique(np.append(np.arange(0, len(axis), 2), len(axis) - 1))]
+
+def _prolongation(axis, coarse_axis):
+    '''
+    Returns the linear interpolation from the interior nodes of 
+    coarse_axis to the interior nodes of axis, a sparse matrix. The 
+    boundary nodes are 0 (Dirichlet).
+    '''
+    fine = axis[1:-1]
+    right = np.clip(np.searchsorted(coarse_axis, fine), 1, len(coarse_axis) - 1)
+    left = right - 1
+    fraction = (fine - coarse_axis[left])/(coarse_axis[right] - coarse_axis[left])
+    rows = np.concatenate((np.arange(len(fine)), np.arange(len(fine))))
+    columns = np.concatenate((left, right)) - 1
+    weights = np.concatenate((1 - fraction, fraction))
+    # Drop the coarse boundary nodes and zero weights
+    keep = ((columns >= 0) & (columns < len(coarse_axis) - 2) 
+            & (weights != 0))
+    return sp.csr_matrix((weights[keep], (rows[keep], columns[keep])),
+                         shape=(len(fine), len(coarse_axis) - 2))
+
+def _jacobi_radius(operator, diagonal, iterations=20):
+    '''
+    Estimates the largest eigenvalue of diag(operator)^-1 operator with
+    power iteration, for the weight of the Jacobi smoother.
+    '''
+    x = np.random.default_rng(0).random(operator.shape[0])
+    radius = 1
+    for _ in range(iterations):
+        y = (operator @ x)/diagonal
+        radius = np.linalg.norm(y)/np.linalg.norm(x)
+        x = y/np.linalg.norm(y)
+    return radius
+
+
+class GridFunction():
+    '''
+    A potential on a LaplaceGrid, values holds the node values. Like a
+    fenics Function it can be evaluated at a point, e.g. V(x, y).
+    '''
+    def __init__(self, grid, values):
+        self.grid = grid
+        self.values = values
+
+    def __call__(self, *x):
+        dofs, weights = self.grid.interpolation(np.ravel(x)[None, :])
+        return (weights*self.values[dofs]).sum()
+
+    def array(self):
+        '''
+        Returns the node values with the shape of the grid.
+        '''
+        return self.values.reshape(self.grid.shape)
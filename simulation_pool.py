@@ -0,0 +1,279 @@
+'''
+A pool of persistent worker processes that runs simulations of kmc_dn
+objects in parallel, with any engine (go_simulation, python_simulation,
+replica_simulation, resistor_network_simulation, ...).
+
+The geometry of a layout (distances, transitions_constant and
+voltage_gradient) is put in shared memory once, so only the small per-job
+state (energies, occupation, voltages) is pickled per job. Only the
+max_layouts most recently used layouts are kept, older ones are freed
+once no job uses them anymore. Workers keep the go library and the numba
+functions loaded between jobs. multiprocessing.shared_memory needs
+python 3.8+.
+
+Example:
+    with SimulationPool(4) as pool:
+        futures = [pool.submit(dn, 'go_simulation', hops=1E5) for dn in dns]
+        for dn, future in zip(dns, futures):
+            SimulationPool.apply_result(dn, future.result())
+'''
+
+import os
+import copy
+import hashlib
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Arrays that are shared per layout and the scalars/arrays that are sent
+# with every job.
+SHARED_ATTRIBUTES = ['distances', 'transitions_constant', 'voltage_gradient']
+JOB_ATTRIBUTES = ['N', 'P', 'nu', 'kT', 'I_0', 'R', 'ab', 'time', 'occupation',
+                  'E_constant', 'site_energies', 'electrode_occupation',
+                  'electrodes', 'static_electrodes']
+# Attributes that are sent back after a job, if the job set them.
+RESULT_ATTRIBUTES = ['time', 'occupation', 'electrode_occupation', 'current',
+                     'traffic', 'average_occupation', 'simulation_state',
+                     'simulation_stats', 'current_raw', 'current_error',
+                     'variance_reduction', 'network_conductance',
+                     'replica_time', 'replica_electrode_occupation',
+                     'replica_occupation', 'replica_average_occupation']
+
+# Per worker process: shared memory blocks that are already attached, 
+# least recently used first, and how many of them are kept attached.
+_attached = OrderedDict()
+_max_attached = None
+
+
+def _init_worker(cwd, max_attached):
+    '''
+    Initializer of the worker processes. The go library is loaded relative
+    to the working directory, so that is set first.
+    '''
+    global _max_attached
+    _max_attached = max_attached
+    os.chdir(cwd)
+    import kmc_dopant_networks
+    from goSimulation.pythonBind import getLibrary
+    try:
+        getLibrary()
+    except OSError:
+        # Only the python engines can be used
+        pass
+
+
+def _attach(name, shape):
+    '''
+    Returns a numpy view on the shared memory block name, attaching it if
+    this worker did not do so before.
+    '''
+    if name not in _attached:
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    _attached.move_to_end(name)
+    return np.ndarray(shape, dtype=np.float64, buffer=_attached[name].buf)
+
+
+def _detach_unused(keep):
+    '''
+    Detaches the least recently used shared memory blocks of this worker,
+    except the ones in keep, until at most _max_attached are attached.
+    '''
+    for name in list(_attached):
+        if len(_attached) <= _max_attached:
+            break
+        if name in keep:
+            continue
+        try:
+            _attached[name].close()
+        except BufferError:
+            # Still referenced, e.g. by a returned array
+            continue
+        del _attached[name]
+
+
+def _run_job(layout, state, func, kwargs):
+    '''
+    Runs a single job in a worker: builds a kmc_dn with the shared layout
+    and the job state, without solving V, and calls func on it.
+    '''
+    import kmc_dopant_networks as kmc_dn
+    dn = kmc_dn.kmc_dn.__new__(kmc_dn.kmc_dn)
+    dn.voltage_gradient = None
+    for key, (name, shape) in layout.items():
+        setattr(dn, key, _attach(name, shape))
+    if _max_attached is not None:
+        _detach_unused({name for name, _ in layout.values()})
+    for key, value in state.items():
+        setattr(dn, key, value)
+    dn.transitions = np.zeros((dn.N + dn.P, dn.N + dn.P))
+    dn.problist = np.zeros((dn.N + dn.P)**2)
+    returned = getattr(dn, func)(**kwargs)
+    result = {key: getattr(dn, key) for key in RESULT_ATTRIBUTES
+              if hasattr(dn, key)}
+    result['returned'] = returned
+    return result
+
+
+class SimulationPool():
+    def __init__(self, processes=None, max_layouts=32):
+        '''
+        =======================
+        SimulationPool
+        =======================
+        Runs simulations of kmc_dn objects on a pool of persistent worker
+        processes. Results are returned as concurrent.futures.Future
+        objects.
+
+        Input arguments
+        ===============
+        processes; int
+            Number of worker processes, defaults to the number of cores.
+        max_layouts; int
+            Number of layouts (geometries) that are kept in shared memory.
+            Layouts of pending jobs are kept regardless.
+        '''
+        self.processes = processes if processes is not None else os.cpu_count()
+        self.max_layouts = max_layouts
+        self.executor = ProcessPoolExecutor(
+                max_workers=self.processes, initializer=_init_worker,
+                initargs=(os.getcwd(), max_layouts*len(SHARED_ATTRIBUTES)))
+        # fingerprint: {'arrays', 'blocks', 'futures'}, least recently
+        # used first
+        self.layouts = OrderedDict()
+        # Device: (revision, arrays, fingerprint), see _fingerprint
+        self.fingerprints = weakref.WeakKeyDictionary()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _share(array):
+        '''
+        Copies array to a new shared memory block and returns the block.
+        '''
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=np.float64, buffer=shm.buf)[...] = array
+        return shm
+
+    def _fingerprint(self, dn, arrays):
+        '''
+        Returns the sha1 of the shared arrays of dn. It is cached per 
+        Device of dn, until the Device changes them in place (revision) or
+        replaces them.
+        '''
+        device = dn.__dict__.get('_device')
+        if device is not None:
+            revision = getattr(device, 'revision', 0)
+            cached = self.fingerprints.get(device)
+            if (cached is not None and cached[0] == revision
+                    and cached[1].keys() == arrays.keys()
+                    and all(cached[1][key] is arrays[key] for key in arrays)):
+                return cached[2]
+        fingerprint = hashlib.sha1()
+        for key in sorted(arrays):
+            array = np.ascontiguousarray(arrays[key], dtype=np.float64)
+            fingerprint.update(key.encode())
+            fingerprint.update(str(array.shape).encode())
+            fingerprint.update(array.tobytes())
+        fingerprint = fingerprint.hexdigest()
+        if device is not None:
+            self.fingerprints[device] = (revision, arrays, fingerprint)
+        return fingerprint
+
+    def _layout(self, dn):
+        '''
+        Returns the fingerprint and the shared memory description of the
+        geometry of dn, the geometry is put in shared memory the first time
+        it is seen. voltage_gradient is calculated first if needed, so 
+        that the workers do not need the electrostatics.
+        '''
+        if getattr(dn, 'voltage_gradient', None) is None:
+            dn.calc_voltage_gradient()
+        arrays = {key: getattr(dn, key) for key in SHARED_ATTRIBUTES}
+        fingerprint = self._fingerprint(dn, arrays)
+        if fingerprint not in self.layouts:
+            blocks = {key: self._share(array) for key, array in arrays.items()}
+            self.layouts[fingerprint] = {
+                    'arrays': {key: (blocks[key].name, np.shape(arrays[key]))
+                               for key in arrays},
+                    'blocks': list(blocks.values()),
+                    'futures': []}
+        self.layouts.move_to_end(fingerprint)
+        self._evict()
+        return fingerprint, self.layouts[fingerprint]['arrays']
+
+    def _evict(self):
+        '''
+        Frees the least recently used layouts without pending jobs until
+        at most max_layouts are left, the most recent one is always kept.
+        '''
+        for fingerprint in list(self.layouts)[:-1]:
+            if len(self.layouts) <= self.max_layouts:
+                break
+            layout = self.layouts[fingerprint]
+            layout['futures'] = [future for future in layout['futures']
+                                 if not future.done()]
+            if layout['futures']:
+                continue
+            for shm in layout['blocks']:
+                shm.close()
+                shm.unlink()
+            del self.layouts[fingerprint]
+
+    def submit(self, dn, func="go_simulation", **kwargs):
+        '''
+        Submits func(**kwargs) of dn, e.g. submit(dn, 'go_simulation',
+        hops=1E5), and returns a Future. Its result is a dict with the
+        attributes in RESULT_ATTRIBUTES that the simulation set and the
+        return value of func under 'returned', see apply_result. dn itself
+        is not changed, apart from calculating its voltage_gradient. The 
+        state of dn (energies, occupation, voltages) is taken at the moment
+        of submission.
+        '''
+        # The executor pickles the job later, on its own thread, so the
+        # arrays are copied now: dn may change (e.g. its voltages) before.
+        state = {key: copy.deepcopy(getattr(dn, key)) for key in JOB_ATTRIBUTES
+                 if hasattr(dn, key)}
+        fingerprint, layout = self._layout(dn)
+        future = self.executor.submit(_run_job, layout, state, func, kwargs)
+        self.layouts[fingerprint]['futures'].append(future)
+        return future
+
+    @staticmethod
+    def apply_result(dn, result):
+        '''
+        Sets the attributes of a job result on dn, as if the simulation
+        had run on dn itself. Returns the return value of the simulation.
+        '''
+        for key, value in result.items():
+            if key != 'returned':
+                setattr(dn, key, value)
+        return result['returned']
+
+    def map(self, dns, func="go_simulation", **kwargs):
+        '''
+        Runs func(**kwargs) for every dn in dns, waits for all of them and
+        applies the results to the dns. Returns the return values.
+        '''
+        futures = [self.submit(dn, func, **kwargs) for dn in dns]
+        return [SimulationPool.apply_result(dn, future.result())
+                for dn, future in zip(dns, futures)]
+
+    def close(self):
+        '''
+        Shuts the workers down and frees the shared memory.
+        '''
+        self.executor.shutdown()
+        for layout in self.layouts.values():
+            for shm in layout['blocks']:
+                shm.close()
+                shm.unlink()
+        self.layouts = OrderedDict()
+        self.fingerprints = weakref.WeakKeyDictionary()
@@ -158,7 +158,15 @@ def testRandFunctions():
 
 def testOverlap():
     kmc = getRandomKMC(300, N, M)
-    kmc.go_simulation(hops=1000000, goSpecificFunction="analyzeStateOverlap")
+    first = kmc.record_state_histogram(hops=1000000, top_k=2**20)
+    counts = {key.tobytes():count for key, count in zip(first['keys'], first['counts'])}
+    print("Number of states in original: %d"%(first['tracked_states']))
+    for j in range(10):
+        other = kmc.record_state_histogram(hops=1000000, top_k=2**20)
+        overlap = sum(min(count, counts.get(key.tobytes(), 0)) 
+                      for key, count in zip(other['keys'], other['counts']))
+        print("The number of keys in new try:%d\n%d: The overlap for %d hops was %d\n"
+              %(other['tracked_states'], j, 1000000, overlap))
 
 #for _ in range(10):
 #    runOneTest(hops)
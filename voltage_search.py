@@ -88,18 +88,18 @@ class voltage_search(dn_search):
         for i in range(self.N):
             dn.electrodes[i+2][3] = random.random()*self.voltage_range*2 - self.voltage_range
 
-    def evaluate_error_diff(self, dn):
+    def evaluate_error_diff(self, dn, extend=False):
         # Error function that takes into account only separation.
         lowest_true = 1
         highest_false = -1
-        for test in self.tests:
+        for j, test in enumerate(self.tests):
             for i in range(len(test[0])):
                 if test[0][i]:
                     dn.electrodes[i][3] = dn.true_voltage
                 else:
                     dn.electrodes[i][3] = 0
             dn.update_V()
-            getattr(dn, self.simulation_func)(**self.simulation_args)
+            self.simulate_test(dn, j, extend)
             if test[1]:#expected result is True, so we adjust lowest_true value.
                 if lowest_true > dn.current[self.output_electrode]:
                     lowest_true = dn.current[self.output_electrode]
@@ -108,16 +108,16 @@ class voltage_search(dn_search):
                     highest_false = dn.current[self.output_electrode]
         return highest_false - lowest_true
 
-    def evaluate_error_corr(self, dn):
+    def evaluate_error_corr(self, dn, extend=False):
         # Error function that takes into account both separation and correlation.
         lowest_true = 1
         highest_false = -1
         values = []
-        for test in self.tests:
+        for j, test in enumerate(self.tests):
             for i in range(len(test[0])):
                 dn.electrodes[i][3] = test[0][i]
             dn.update_V()
-            getattr(dn, self.simulation_func)(**self.simulation_args)
+            self.simulate_test(dn, j, extend)
             values.append(dn.current[self.output_electrode])
             if test[1]:#expected result is True, so we adjust lowest_true value.
                 if lowest_true > dn.current[self.output_electrode]:
@@ -157,10 +157,10 @@ class voltage_search(dn_search):
             parr.runSimulation()
 
 
-    def evaluate_error_corr_parallel(self, dn):
+    def evaluate_error_corr_parallel(self, dn, extend=False):
         # Error function that takes into account separation and correlation.
         # The simulations necessary to evaluate the error are done in parallel 
-        # before calling this.
+        # before calling this, so extend has no effect here.
         lowest_true = 1
         highest_false = -1
         values = []
@@ -195,17 +195,13 @@ class voltage_search(dn_search):
             electrode_voltage = self.dn.electrodes[option[0]][3] + option[1]
 
             if math.fabs(electrode_voltage) < self.voltage_range:
-                newDn = kmc_dn.kmc_dn(self.dn.N, self.dn.M, self.dn.xdim, 
-                    self.dn.ydim, 0, electrodes = self.dn.electrodes, 
-                    acceptors=self.dn.acceptors, donors=self.dn.donors, copy_from=self.dn)
+                newDn = self.dn.copy()
                 newDn.electrodes[option[0]][3] = electrode_voltage
                 yield newDn, option[0], (0, 0)
 
     # Override function for both searches
     def getRandomDn(self):
-        newDn = kmc_dn.kmc_dn(self.dn.N, self.dn.M, self.dn.xdim, self.dn.ydim, 
-                self.dn.zdim, electrodes=self.dn.electrodes, acceptors=self.dn.acceptors, 
-                donors=self.dn.donors, copy_from = self.dn)
+        newDn = self.dn.copy()
         newDn.tests = self.tests
         self.init_random_voltages(newDn)
         return newDn
@@ -253,15 +249,70 @@ class voltage_search(dn_search):
 
 
     def getAdjustedDn(self, dn, adjustment):
-        newDn = kmc_dn.kmc_dn(dn.N, dn.M, dn.xdim, dn.ydim, 
-                self.dn.zdim, electrodes=dn.electrodes, acceptors=dn.acceptors, 
-                donors=dn.donors, copy_from = dn)
+        newDn = dn.copy()
         newDn.true_voltage = dn.true_voltage + adjustment[0]
         for i in range(self.N):
             newDn.electrodes[i+2][3] = newDn.electrodes[i+2][3] + adjustment[i+1]
         self.checkRange(newDn)
         return newDn
 
+    def evaluate_gradient(self, dn, block_hops=1000):
+        # Separation (as in evaluate_error_corr) and its gradient to the
+        # control voltages, from one simulation per test with likelihood
+        # ratio sensitivities (kmc_dn.current_sensitivity).
+        lowest_true = (1, None)
+        highest_false = (-1, None)
+        for test in self.tests:
+            for i in range(len(test[0])):
+                dn.electrodes[i][3] = test[0][i]
+            dn.update_V()
+            dn.current_sensitivity(hops=self.simulation_args['hops'], block_hops=block_hops)
+            current = dn.current[self.output_electrode]
+            gradient = dn.current_gradient[self.output_electrode, 2:2+self.N]
+            if test[1]:
+                if lowest_true[0] > current:
+                    lowest_true = (current, gradient)
+            else:
+                if highest_false[0] < current:
+                    highest_false = (current, gradient)
+        separation = highest_false[0] - lowest_true[0]
+        gradient = np.zeros(self.N)
+        if highest_false[1] is not None:
+            gradient += highest_false[1]
+        if lowest_true[1] is not None:
+            gradient -= lowest_true[1]
+        return separation, gradient
+
+    def gradient_search(self, time_budget, a, file_prefix, block_hops=1000):
+        # Steepest descent on the separation of the output currents. Every
+        # step costs one simulation per test, the control voltages move by
+        # at most a per step.
+        self.dn = self.getRandomDn()
+        self.init_search()
+        start_time = time.time()
+        time_difference = time.time() - start_time
+        validation_step = time_budget / 10
+        next_validation = validation_step
+        while time_difference < time_budget:
+            time_difference = time.time() - start_time
+            separation, gradient = self.evaluate_gradient(self.dn, block_hops)
+            largest = np.abs(gradient).max()
+            if largest > 0:
+                for i in range(self.N):
+                    self.dn.electrodes[i+2][3] -= a*gradient[i]/largest
+                self.checkRange(self.dn)
+            print ("%.3g, %.3g"%(separation, largest))
+            volts = [e[3] for e in self.dn.electrodes]
+            print (volts)
+            if time_difference > next_validation:
+                next_validation += validation_step
+                tmp_error = self.evaluate_error(self.dn)
+                self.appendValidationData(tmp_error, time_difference)
+        self.dn.saveSelf("resultDump%s.kmc"%(file_prefix))
+        tmp_error = self.evaluate_error(self.dn)
+        self.appendValidationData(tmp_error, time_difference)
+        return tmp_error, self.current_strategy, self.validations
+
     # Trial to implement SPSA, so far not validated to work.
     def SPSA_search(self, time_budget, a, c, A, alfa, gamma, file_prefix):
         k = 1